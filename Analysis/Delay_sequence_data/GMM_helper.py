@@ -8,7 +8,7 @@ from sklearn.metrics import silhouette_score
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-from clustering_helper import average_variability_metrics
+from clustering_helper import FeatureSpec, RowIndex, average_variability_metrics, load_sensor_features, estimate_silhouette_score, prepare_silhouette_distances
 
 
 def tune_gmm(data, n_components_range=range(1, 15), criterion='AIC'):
@@ -76,24 +76,31 @@ def tune_gmm(data, n_components_range=range(1, 15), criterion='AIC'):
 
 
 
-def train_GMM(df, n_components=5, random_state=42, visualization_method='PCA', plot_3d=False):
+def train_GMM(df, n_components=5, random_state=42, visualization_method='PCA', plot_3d=False, silhouette_method='exact'):
     """
     Train a Gaussian Mixture Model (GMM) on the given dataframe, predict clusters, and visualize the results.
 
     Parameters:
-    df (DataFrame): The DataFrame containing the features to cluster.
+    df (DataFrame or FeatureSpec): The DataFrame containing the features to cluster, or a spec whose
+                                   features are read from the feature cache (see `load_sensor_features`).
     n_components (int): The number of clusters/components for the GMM.
     random_state (int): Random state for reproducibility.
     visualization_method (str): The method for visualization ('PCA' or 'TSNE').
     plot_3d (bool): Whether to generate a 3D plot. If False, a 2D plot will be generated.
+    silhouette_method (str): 'exact', 'sampled' or 'simplified' (see `estimate_silhouette_score`).
 
     Returns:
-    DataFrame: The original DataFrame with an additional column for cluster labels.
+    DataFrame: The original DataFrame with the cluster labels, the posterior membership of every
+               component ('membership_<k>') and the 'confidence' (membership of the assigned cluster).
     GaussianMixture: The fitted GMM model.
     """
 
-    # Standardize the features
-    df = df.copy()
+    if isinstance(df, FeatureSpec):
+        df = load_sensor_features(df)
+
+    # Standardize the features. Only new columns are added to `df` below, so a shallow copy
+    # keeps the caller's frame unchanged without copying the feature values.
+    df = df.copy(deep=False)
     sensor_ids = df.index if 'Sensor ID' not in df.columns else df['Sensor ID']
     scaler = StandardScaler()
     features_scaled = scaler.fit_transform(df.drop(columns=['Sensor ID']))
@@ -102,12 +109,18 @@ def train_GMM(df, n_components=5, random_state=42, visualization_method='PCA', p
     gmm = GaussianMixture(n_components=n_components, random_state=random_state)
     gmm.fit(features_scaled)
 
-    # Predict cluster labels
-    cluster_labels = gmm.predict(features_scaled)
+    # Predict cluster labels and keep the posterior membership of every component
+    membership = gmm.predict_proba(features_scaled)
+    cluster_labels = membership.argmax(axis=1)
     df['cluster'] = cluster_labels
+    df['confidence'] = membership.max(axis=1)
+    for k in range(n_components):
+        df[f'membership_{k}'] = membership[:, k]
 
     # Calculate Silhouette Score
-    silhouette_avg = silhouette_score(features_scaled, cluster_labels)
+    silhouette_avg, silhouette_low, silhouette_high = estimate_silhouette_score(
+        features_scaled, cluster_labels, method=silhouette_method, random_state=random_state
+    )
     
 
     print("============ Distribution of Sensors in each Cluster ============")
@@ -119,7 +132,10 @@ def train_GMM(df, n_components=5, random_state=42, visualization_method='PCA', p
 
     print(f"BIC: {bic}")
     print(f"AIC: {aic}")
-    print(f"Silhouette Score: {silhouette_avg:.4f}")
+    if silhouette_method == 'sampled':
+        print(f"Silhouette Score: {silhouette_avg:.4f} (95% CI {silhouette_low:.4f} - {silhouette_high:.4f})")
+    else:
+        print(f"Silhouette Score: {silhouette_avg:.4f}")
 
     # Visualize the clustering results using PCA or t-SNE
     if visualization_method.upper() == 'PCA':
@@ -167,12 +183,20 @@ def train_GMM(df, n_components=5, random_state=42, visualization_method='PCA', p
 
 
 
-def search_gmm_weighted_avg(df, data, n_components_range=range(2, 20)):
-    for i in n_components_range:
-        # Standardize the features
-        scaler = StandardScaler()
-        features_scaled = scaler.fit_transform(df)
+def search_gmm_weighted_avg(df, data, n_components_range=range(2, 20), silhouette_method='exact', sample_size=1000):
+    # Standardize the features once; the scaling does not depend on the number of components
+    scaler = StandardScaler()
+    features_scaled = scaler.fit_transform(df)
+
+    # Distances from the sample pool are reused for every number of components
+    distance_cache = None
+    if silhouette_method == 'sampled':
+        distance_cache = prepare_silhouette_distances(features_scaled, sample_size=sample_size, random_state=42)
 
+    # Index the raw rows once for the variability metrics of every number of clusters
+    rows = RowIndex(data, columns=['Ping Time (us)'])
+
+    for i in n_components_range:
         # Fit a Gaussian Mixture Model
         gmm = GaussianMixture(n_components=i, random_state=42)
         gmm.fit(features_scaled)
@@ -182,9 +206,9 @@ def search_gmm_weighted_avg(df, data, n_components_range=range(2, 20)):
         df['cluster'] = cluster_labels
 
         # Compute silhouette score
-        sil_score = silhouette_score(features_scaled, cluster_labels)
+        sil_score, _, _ = estimate_silhouette_score(features_scaled, cluster_labels, method=silhouette_method, distance_cache=distance_cache)
 
         # Compute your custom metrics
-        results_df, weighted_avg_outliers_score, weighted_avg_std_ping_time_score = average_variability_metrics(df, data)
+        results_df, weighted_avg_outliers_score, weighted_avg_std_ping_time_score = average_variability_metrics(df, rows)
 
         print(f"{i}-Weighted average of variability score: {weighted_avg_std_ping_time_score} Outlier score: {weighted_avg_outliers_score} Silhouette Score: {sil_score:.4f}")
@@ -7,7 +7,7 @@ from sklearn.metrics import silhouette_score
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-from clustering_helper import average_variability_metrics
+from clustering_helper import FeatureSpec, RowIndex, average_variability_metrics, load_sensor_features, estimate_silhouette_score, prepare_silhouette_distances, read_rows
 
 def tune_and_visualize_kmeans(data, n_clusters_range=range(1, 11), plot_3d=False):
     """
@@ -97,24 +97,30 @@ from sklearn.metrics import silhouette_score
 import plotly.express as px
 from joblib import dump, load
 
-def train_KMeans(df, n_clusters=5, random_state=42, visualization_method='PCA', plot_3d=False):
+def train_KMeans(df, n_clusters=5, random_state=42, visualization_method='PCA', plot_3d=False, silhouette_method='exact'):
     """
     Train a KMeans model on the given dataframe, predict clusters, and visualize the results.
 
     Parameters:
-    df (DataFrame): The DataFrame containing the features to cluster.
+    df (DataFrame or FeatureSpec): The DataFrame containing the features to cluster, or a spec whose
+                                   features are read from the feature cache (see `load_sensor_features`).
     n_clusters (int): The number of clusters for KMeans.
     random_state (int): Random state for reproducibility.
     visualization_method (str): The method for visualization ('PCA' or 'TSNE').
     plot_3d (bool): Whether to generate a 3D plot. If False, a 2D plot will be generated.
+    silhouette_method (str): 'exact', 'sampled' or 'simplified' (see `estimate_silhouette_score`).
 
     Returns:
     DataFrame: The original DataFrame with an additional column for cluster labels.
     KMeans: The fitted KMeans model.
     """
 
-    # Standardize the features
-    df = df.copy()
+    if isinstance(df, FeatureSpec):
+        df = load_sensor_features(df)
+
+    # Standardize the features. Only new columns are added to `df` below, so a shallow copy
+    # keeps the caller's frame unchanged without copying the feature values.
+    df = df.copy(deep=False)
     sensor_ids = df.index if 'Sensor ID' not in df.columns else df['Sensor ID']
     scaler = StandardScaler()
     features_scaled = scaler.fit_transform(df.drop(columns=['Sensor ID']))
@@ -129,7 +135,9 @@ def train_KMeans(df, n_clusters=5, random_state=42, visualization_method='PCA',
     df['cluster'] = cluster_labels
 
     # Calculate Silhouette Score
-    silhouette_avg = silhouette_score(features_scaled, cluster_labels)
+    silhouette_avg, silhouette_low, silhouette_high = estimate_silhouette_score(
+        features_scaled, cluster_labels, method=silhouette_method, random_state=random_state
+    )
     
 
     print("============ Distribution of Sensors in each Cluster ============")
@@ -138,11 +146,14 @@ def train_KMeans(df, n_clusters=5, random_state=42, visualization_method='PCA',
     # Evaluate the model using inertia
     inertia = kmeans.inertia_
     print(f"Inertia: {inertia}")
-    print(f"Silhouette Score: {silhouette_avg:.4f}")
+    if silhouette_method == 'sampled':
+        print(f"Silhouette Score: {silhouette_avg:.4f} (95% CI {silhouette_low:.4f} - {silhouette_high:.4f})")
+    else:
+        print(f"Silhouette Score: {silhouette_avg:.4f}")
 
     # Assuming 'all_cleaned_df' is your cleaned DataFrame with all necessary data
     file_path = '../processed_data/all_data_v4-1-1_cleaned_sensor211.csv'
-    all_cleaned_df = pd.read_csv(file_path)
+    all_cleaned_df = read_rows(file_path)
     all_cleaned_df = all_cleaned_df.drop("Unnamed: 0",axis=1)
     results_df, weighted_avg_count_outliers_score, weighted_avg_std_ping_time_score = average_variability_metrics(df, all_cleaned_df)
     print("Custom Scores:")
@@ -202,7 +213,7 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
 from sklearn.metrics import silhouette_score
 
-def search_kmeans_weighted_avg(df, data, n_components_range=range(2, 20)):
+def search_kmeans_weighted_avg(df, data, n_components_range=range(2, 20), silhouette_method='exact', sample_size=1000):
     """
     Perform KMeans clustering with a range of components (clusters), 
     calculate weighted average outlier and standard deviation scores, 
@@ -212,16 +223,26 @@ def search_kmeans_weighted_avg(df, data, n_components_range=range(2, 20)):
     df (DataFrame): DataFrame containing the features for clustering.
     data (DataFrame): Additional data to calculate the variability and outlier metrics.
     n_components_range (range): Range of cluster numbers to try for KMeans.
+    silhouette_method (str): 'exact', 'sampled' or 'simplified' (see `estimate_silhouette_score`).
+    sample_size (int): Sample pool size for the 'sampled' silhouette, shared across all cluster numbers.
 
     Returns:
     None: Prints the weighted average scores and silhouette score for each number of clusters.
     """
 
-    for i in n_components_range:
-        # Standardize the features
-        scaler = StandardScaler()
-        features_scaled = scaler.fit_transform(df)
+    # Standardize the features once; the scaling does not depend on the number of clusters
+    scaler = StandardScaler()
+    features_scaled = scaler.fit_transform(df)
+
+    # Distances from the sample pool are reused for every number of clusters
+    distance_cache = None
+    if silhouette_method == 'sampled':
+        distance_cache = prepare_silhouette_distances(features_scaled, sample_size=sample_size, random_state=42)
 
+    # Index the raw rows once for the variability metrics of every number of clusters
+    rows = RowIndex(data, columns=['Ping Time (us)'])
+
+    for i in n_components_range:
         # Fit a KMeans model
         kmeans = KMeans(n_clusters=i, n_init='auto', random_state=42)
         kmeans.fit(features_scaled)
@@ -231,10 +252,10 @@ def search_kmeans_weighted_avg(df, data, n_components_range=range(2, 20)):
         df['cluster'] = cluster_labels
 
         # Calculate silhouette score
-        sil_score = silhouette_score(features_scaled, cluster_labels)
+        sil_score, _, _ = estimate_silhouette_score(features_scaled, cluster_labels, method=silhouette_method, distance_cache=distance_cache)
 
         # Calculate custom metrics
-        results_df, weighted_avg_outliers_score, weighted_avg_std_ping_time_score = average_variability_metrics(df, data)
+        results_df, weighted_avg_outliers_score, weighted_avg_std_ping_time_score = average_variability_metrics(df, rows)
         
         # Print weighted average variability and outlier scores
         print(f"{i}-Weighted average of variability score: {weighted_avg_std_ping_time_score} Outlier score: {weighted_avg_outliers_score} Silhouette Score: {sil_score:.4f}")
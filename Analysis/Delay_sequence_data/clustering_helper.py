@@ -1,9 +1,25 @@
+import os
+import sys
+
 import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
+repo_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if repo_dir not in sys.path:
+    sys.path.append(repo_dir)
+
+from raw_query import KEY_FACTOR, RowIndex  # noqa: E402
+from dataset_store import DatasetStore  # noqa: E402
+from execution_backend import map_sensors, range_delay_cells  # noqa: E402
+from feature_cache import features_from_store  # noqa: E402
+from feature_spec import ALL_BAND, FeatureSpec  # noqa: E402
+from row_dtypes import read_rows  # noqa: E402
+
+VARIABILITY_COLUMNS = ['Sensor ID', 'Delay (us)', 'Range (cm)', 'Ping Time (us)']
+
 
 def identify_outliers(series):
     Q1 = series.quantile(0.25)
@@ -13,50 +29,64 @@ def identify_outliers(series):
     upper_bound = Q3 + 1.5 * IQR
     return ((series < lower_bound) | (series > upper_bound)).sum()
 
-def average_variability_metrics(df_cluster, all_cleaned_df):
+def cluster_variability(all_cleaned_df_target):
+    """
+    Outlier counts and ping time standard deviation of the rows of one cluster's sensors.
+
+    Parameters:
+    all_cleaned_df_target (DataFrame): The cleaned rows of the cluster's sensors.
+
+    Returns:
+    dict: 'max_count_outliers', 'avg_count_outliers' and 'avg_std_ping_time'.
+    """
+    # Group by 'Delay (us)' and 'Range (cm)', then calculate the number of outliers in 'Ping Time (us)'
+    grouped_outliers = all_cleaned_df_target.groupby(['Delay (us)', 'Range (cm)'])['Ping Time (us)'].apply(identify_outliers).reset_index(name='outliers')
+
+    # Group by sensor ID, delay, and range, then calculate the standard deviation of ping time
+    grouped_std = all_cleaned_df_target.groupby(['Sensor ID', 'Delay (us)', 'Range (cm)']).agg(
+        std_ping_time=('Ping Time (us)', 'std')
+    ).reset_index()
+
+    # Average and maximum number of outliers, and average std ping time, for the cluster
+    return {'max_count_outliers': grouped_outliers['outliers'].max(),
+            'avg_count_outliers': grouped_outliers['outliers'].mean(),
+            'avg_std_ping_time': grouped_std['std_ping_time'].mean()}
+
+
+def average_variability_metrics(df_cluster, all_cleaned_df, backend=None):
     """
     Calculate the average number of outliers and average standard deviation of ping time for each cluster,
     and the weighted averages of these values.
 
     Parameters:
     df_cluster (DataFrame): The DataFrame containing sensor ID and their respective clusters.
-    all_cleaned_df (DataFrame): The DataFrame containing the cleaned data.
+    all_cleaned_df (DataFrame, RowIndex or DatasetStore): The cleaned data. Pass a `RowIndex` when calling
+                                                          this repeatedly on the same data, so it is only indexed once.
+    backend (str or backend, optional): Execution backend (see `execution_backend.py`) computing the
+                                        clusters in parallel. Required for a `DatasetStore`.
 
     Returns:
     DataFrame: A DataFrame with columns for cluster, average number of outliers, and average std ping time.
     float: The weighted average of the average number of outliers across clusters.
     float: The weighted average of the average standard deviation of ping time across clusters.
     """
+    clusters = df_cluster["cluster"].unique()
+    # Get the sensor IDs of each cluster
+    cluster_sensors = [df_cluster[df_cluster["cluster"] == target]["Sensor ID"].unique() for target in clusters]
+
+    if backend is not None or isinstance(all_cleaned_df, DatasetStore):
+        # One partition per cluster, read and computed by the backend's workers
+        metrics = map_sensors(cluster_variability, all_cleaned_df, backend=backend, groups=cluster_sensors,
+                              columns=VARIABILITY_COLUMNS)
+    else:
+        # Each cluster's rows are found by binary search on the indexed data instead of a scan
+        rows = all_cleaned_df if isinstance(all_cleaned_df, RowIndex) else RowIndex(all_cleaned_df, columns=['Ping Time (us)'])
+        metrics = [cluster_variability(rows.frame(sensors=sensors, columns=VARIABILITY_COLUMNS)) for sensors in cluster_sensors]
 
     # List to store the results
-    results = []
-
-    # Iterate over each cluster
-    for target in df_cluster["cluster"].unique():
-        # Get the sensor IDs for the current cluster
-        cluster_sensors = df_cluster[df_cluster["cluster"] == target]["Sensor ID"].unique()
-
-        # Filter the all_cleaned_df for the current cluster sensors
-        all_cleaned_df_target = all_cleaned_df[all_cleaned_df['Sensor ID'].isin(cluster_sensors)]
-
-        # Group by 'Delay (us)' and 'Range (cm)', then calculate the number of outliers in 'Ping Time (us)'
-        grouped_outliers = all_cleaned_df_target.groupby(['Delay (us)', 'Range (cm)'])['Ping Time (us)'].apply(identify_outliers).reset_index(name='outliers')
-        
-        # Calculate the average number of outliers for the current cluster
-        avg_count_outliers = grouped_outliers['outliers'].mean()
-        max_count_outliers = grouped_outliers['outliers'].max()
+    results = [dict(cluster=target, **metric, count=len(sensors))
+               for target, sensors, metric in zip(clusters, cluster_sensors, metrics)]
 
-        # Group by sensor ID, delay, and range, then calculate the standard deviation of ping time
-        grouped_std = all_cleaned_df_target.groupby(['Sensor ID', 'Delay (us)', 'Range (cm)']).agg(
-            std_ping_time=('Ping Time (us)', 'std')
-        ).reset_index()
-
-        # Calculate the average std ping time for the current cluster
-        avg_std_ping_time = grouped_std['std_ping_time'].mean()
-
-        # Append the results to the list
-        results.append({'cluster': target, 'max_count_outliers':max_count_outliers, 'avg_count_outliers': avg_count_outliers, 'avg_std_ping_time': avg_std_ping_time, 'count': len(cluster_sensors)})
-    
     # Convert the results list to a DataFrame
     results_df = pd.DataFrame(results)
     
@@ -72,12 +102,90 @@ def average_variability_metrics(df_cluster, all_cleaned_df):
 
     return results_df, weighted_avg_count_outliers_score, weighted_avg_std_ping_time_score
 
-def visualize_lineplot_ping_time_with_variability(df, target = []):
+
+def load_sensor_features(spec, version='data_v4.1.1'):
+    """
+    Features of every sensor of a dataset version, read from the feature cache. Only the sensors
+    whose recordings are new or changed are computed.
+
+    Parameters:
+    spec (FeatureSpec): The features.
+    version (str): Dataset version.
+
+    Returns:
+    DataFrame: The spec's columns followed by 'Sensor ID', one row per sensor.
+    """
+    return features_from_store(DatasetStore([version]), spec, version)
+
+
+def cap_sensors(sensor_ids, max_sensors=None, random_state=42):
+    """
+    Downsample a list of sensor IDs to at most `max_sensors`, keeping their original order.
+
+    Parameters:
+    sensor_ids (array-like): Sensor IDs to draw from.
+    max_sensors (int, optional): Maximum number of sensors to keep. If None, all sensors are kept.
+    random_state (int): Random state for reproducibility.
+
+    Returns:
+    ndarray: The kept sensor IDs.
+    """
+    sensor_ids = np.asarray(sensor_ids)
+    if max_sensors is None or len(sensor_ids) <= max_sensors:
+        return sensor_ids
+    rng = np.random.default_rng(random_state)
+    keep = np.sort(rng.choice(len(sensor_ids), size=max_sensors, replace=False))
+    return sensor_ids[keep]
+
+
+def batched_sensor_trace(sensor_df, name='Sensors', use_webgl=False):
+    """
+    Build a single trace holding every sensor of a subplot, with sensors separated by NaN gaps.
+
+    Parameters:
+    sensor_df (DataFrame): Grouped summary with 'Sensor ID', 'Range (cm)', 'mean_ping_time' and 'std_ping_time'.
+    name (str): Name of the trace.
+    use_webgl (bool): Whether to emit a WebGL `Scattergl` trace instead of `Scatter`.
+
+    Returns:
+    Scatter or Scattergl: One trace for all sensors; hovering a point shows its sensor ID.
+    """
+    sensor_df = sensor_df.sort_values(['Sensor ID', 'Range (cm)'], kind='stable')
+    sensor_ids = sensor_df['Sensor ID'].to_numpy()
+
+    # Insert a NaN row wherever the sensor changes so the lines are not joined across sensors
+    breaks = np.flatnonzero(sensor_ids[1:] != sensor_ids[:-1]) + 1
+    x = np.insert(sensor_df['Range (cm)'].to_numpy(dtype=float), breaks, np.nan)
+    y = np.insert(sensor_df['mean_ping_time'].to_numpy(dtype=float), breaks, np.nan)
+    error = np.insert(sensor_df['std_ping_time'].to_numpy(dtype=float), breaks, np.nan)
+    text = np.insert(sensor_ids.astype(object), breaks, None)
+
+    trace_type = go.Scattergl if use_webgl else go.Scatter
+    return trace_type(
+        x=x,
+        y=y,
+        mode='lines+markers',
+        name=name,
+        text=text,
+        hovertemplate='Sensor %{text}<br>Range: %{x} cm<br>Mean Ping Time: %{y} us<extra></extra>',
+        error_y=dict(
+            type='data',
+            array=error,
+            visible=True
+        )
+    )
+
+
+def visualize_lineplot_ping_time_with_variability(df, target = [], batch_traces=False, max_sensors=None, use_webgl=False):
     """
     Visualize the effect of range on ping time for each delay separately with variability.
 
     Parameters:
     df (DataFrame): The DataFrame containing the data.
+    target (list): List of target sensor IDs to visualize.
+    batch_traces (bool): Whether to draw all sensors of a plot as one NaN-separated trace instead of one trace per sensor.
+    max_sensors (int, optional): Maximum number of sensors drawn per plot; larger sets are downsampled.
+    use_webgl (bool): Whether to use WebGL `Scattergl` traces.
     """
     # Group by sensor ID, delay, and range, then calculate the mean and standard deviation of ping time
     grouped_df = df.groupby(['Sensor ID', 'Delay (us)', 'Range (cm)']).agg(
@@ -85,33 +193,32 @@ def visualize_lineplot_ping_time_with_variability(df, target = []):
         std_ping_time=('Ping Time (us)', 'std')
     ).reset_index()
 
-    target_df = grouped_df[grouped_df['Sensor ID'].isin(target)]
-    # Get unique delays
-    unique_delays = target_df['Delay (us)'].unique()
-
-    for delay in unique_delays:
-        subset_df = target_df[target_df['Delay (us)'] == delay]
+    target_df = grouped_df[grouped_df['Sensor ID'].isin(cap_sensors(target, max_sensors))]
+    trace_type = go.Scattergl if use_webgl else go.Scatter
 
+    for delay, subset_df in target_df.groupby('Delay (us)', sort=False):
         fig = px.line(
 
         )
 
         # Adding error bars
-        for sensor_id in subset_df['Sensor ID'].unique():
-            sensor_data = subset_df[subset_df['Sensor ID'] == sensor_id]
-            fig.add_trace(
-                go.Scatter(
-                    x=sensor_data['Range (cm)'],
-                    y=sensor_data['mean_ping_time'],
-                    mode='lines+markers',
-                    name=f'Sensor {sensor_id}',
-                    error_y=dict(
-                        type='data',
-                        array=sensor_data['std_ping_time'],
-                        visible=True
+        if batch_traces:
+            fig.add_trace(batched_sensor_trace(subset_df, use_webgl=use_webgl))
+        else:
+            for sensor_id, sensor_data in subset_df.groupby('Sensor ID', sort=False):
+                fig.add_trace(
+                    trace_type(
+                        x=sensor_data['Range (cm)'],
+                        y=sensor_data['mean_ping_time'],
+                        mode='lines+markers',
+                        name=f'Sensor {sensor_id}',
+                        error_y=dict(
+                            type='data',
+                            array=sensor_data['std_ping_time'],
+                            visible=True
+                        )
                     )
                 )
-            )
 
         # Plot reference line
         ranges = np.linspace(subset_df['Range (cm)'].min(), subset_df['Range (cm)'].max(), 100)
@@ -136,13 +243,16 @@ def visualize_lineplot_ping_time_with_variability(df, target = []):
         fig.show()
 
 
-def visualize_lineplot_ping_time_with_variability_simple(df, target=[]):
+def visualize_lineplot_ping_time_with_variability_simple(df, target=[], batch_traces=False, max_sensors=None, use_webgl=False):
     """
     Visualize the effect of range on ping time for each delay separately with variability.
 
     Parameters:
     df (DataFrame): The DataFrame containing the data.
     target (list): List of target sensor IDs to visualize.
+    batch_traces (bool): Whether to draw all sensors of a subplot as one NaN-separated trace instead of one trace per sensor.
+    max_sensors (int, optional): Maximum number of sensors drawn per subplot; larger sets are downsampled.
+    use_webgl (bool): Whether to use WebGL `Scattergl` traces.
     """
     # Group by sensor ID, delay, and range, then calculate the mean and standard deviation of ping time
     grouped_df = df.groupby(['Sensor ID', 'Delay (us)', 'Range (cm)']).agg(
@@ -150,9 +260,10 @@ def visualize_lineplot_ping_time_with_variability_simple(df, target=[]):
         std_ping_time=('Ping Time (us)', 'std')
     ).reset_index()
 
-    target_df = grouped_df[grouped_df['Sensor ID'].isin(target)]
+    target_df = grouped_df[grouped_df['Sensor ID'].isin(cap_sensors(target, max_sensors))]
     # Get unique delays
     unique_delays = target_df['Delay (us)'].unique()
+    trace_type = go.Scattergl if use_webgl else go.Scatter
 
     # Define the number of columns for subplots
     num_columns = 2  # 2 columns for the grid
@@ -161,30 +272,31 @@ def visualize_lineplot_ping_time_with_variability_simple(df, target=[]):
     # Create subplots
     fig = make_subplots(rows=num_rows, cols=num_columns, subplot_titles=[f'Delay: {delay} us' for delay in unique_delays])
 
-    for i, delay in enumerate(unique_delays):
-        subset_df = target_df[target_df['Delay (us)'] == delay]
-
+    # Split the summary by delay once instead of masking it for every delay and sensor
+    for i, (delay, subset_df) in enumerate(target_df.groupby('Delay (us)', sort=False)):
         # Get the row and column position for the subplot
         row = (i // num_columns) + 1
         col = (i % num_columns) + 1
 
         # Adding error bars
-        for sensor_id in subset_df['Sensor ID'].unique():
-            sensor_data = subset_df[subset_df['Sensor ID'] == sensor_id]
-            fig.add_trace(
-                go.Scatter(
-                    x=sensor_data['Range (cm)'],
-                    y=sensor_data['mean_ping_time'],
-                    mode='lines+markers',
-                    name=f'Sensor {sensor_id}',
-                    error_y=dict(
-                        type='data',
-                        array=sensor_data['std_ping_time'],
-                        visible=True
-                    )
-                ),
-                row=row, col=col
-            )
+        if batch_traces:
+            fig.add_trace(batched_sensor_trace(subset_df, use_webgl=use_webgl), row=row, col=col)
+        else:
+            for sensor_id, sensor_data in subset_df.groupby('Sensor ID', sort=False):
+                fig.add_trace(
+                    trace_type(
+                        x=sensor_data['Range (cm)'],
+                        y=sensor_data['mean_ping_time'],
+                        mode='lines+markers',
+                        name=f'Sensor {sensor_id}',
+                        error_y=dict(
+                            type='data',
+                            array=sensor_data['std_ping_time'],
+                            visible=True
+                        )
+                    ),
+                    row=row, col=col
+                )
 
         # Plot reference line
         ranges = np.linspace(subset_df['Range (cm)'].min(), subset_df['Range (cm)'].max(), 100)
@@ -211,24 +323,87 @@ def visualize_lineplot_ping_time_with_variability_simple(df, target=[]):
 
 
 
-def visualize_cluster(df,cluster = 0, simple = True):
+def visualize_cluster(df,cluster = 0, simple = True, batch_traces=False, max_sensors=None, use_webgl=False):
     # Load the dataset
     file_path = '../processed_data/all_data_v4-1-1_cleaned_sensor211.csv'
-    all_cleaned_df = pd.read_csv(file_path)
+    all_cleaned_df = read_rows(file_path)
     all_cleaned_df = all_cleaned_df.drop("Unnamed: 0",axis=1)
     
     cluster_sensors = df[df["cluster"]==cluster]["Sensor ID"].unique()
     if simple:
-        visualize_lineplot_ping_time_with_variability_simple(all_cleaned_df,cluster_sensors)
+        visualize_lineplot_ping_time_with_variability_simple(all_cleaned_df,cluster_sensors,batch_traces,max_sensors,use_webgl)
     else:
-        visualize_lineplot_ping_time_with_variability(all_cleaned_df,cluster_sensors)
+        visualize_lineplot_ping_time_with_variability(all_cleaned_df,cluster_sensors,batch_traces,max_sensors,use_webgl)
+
+class SummaryIndex:
+    """
+    Grouped ping time summary sorted by (Sensor ID, Delay (us), Range (cm)), with an offset table.
+
+    The rows of one sensor at one delay are a contiguous slice, in range order, found by binary
+    search instead of a boolean mask over the whole summary, so building an N-sensor grid is
+    linear in the rows drawn.
+
+    Parameters:
+    grouped_df (DataFrame): Summary with 'Sensor ID', 'Range (cm)', 'Delay (us)', 'mean_ping_time'
+                            and 'std_ping_time' (one row per sensor, range and delay).
+    """
+
+    def __init__(self, grouped_df):
+        self.frame = grouped_df.sort_values(['Sensor ID', 'Delay (us)', 'Range (cm)'], kind='stable').reset_index(drop=True)
+        keys = self.frame['Sensor ID'].to_numpy(dtype=np.int64) * KEY_FACTOR + self.frame['Delay (us)'].to_numpy(dtype=np.int64)
+        # Offset table: first row of every (sensor, delay) and the row after its last one
+        self.keys, self.starts = np.unique(keys, return_index=True)
+        self.stops = np.append(self.starts[1:], len(keys))
+
+    @classmethod
+    def from_rows(cls, df, sensors=None):
+        """
+        Summarize raw rows per sensor, range and delay, optionally only for some sensors.
+
+        Parameters:
+        df (DataFrame or RowIndex): Raw rows with 'Ping Time (us)'.
+        sensors (list, optional): Sensor IDs to summarize. Defaults to all.
+
+        Returns:
+        SummaryIndex: The indexed summary.
+        """
+        if isinstance(df, RowIndex) or sensors is not None:
+            rows = df if isinstance(df, RowIndex) else RowIndex(df, columns=['Ping Time (us)'])
+            df = rows.frame(sensors=sensors, columns=['Sensor ID', 'Range (cm)', 'Delay (us)', 'Ping Time (us)'])
+        grouped_df = df.groupby(['Sensor ID', 'Range (cm)', 'Delay (us)']).agg(
+            mean_ping_time=('Ping Time (us)', 'mean'),
+            std_ping_time=('Ping Time (us)', 'std')
+        ).reset_index()
+        return cls(grouped_df)
+
+    def _bounds(self, sensor_id, delay=None):
+        if delay is not None:
+            position = np.searchsorted(self.keys, sensor_id * KEY_FACTOR + delay)
+            if position < len(self.keys) and self.keys[position] == sensor_id * KEY_FACTOR + delay:
+                return self.starts[position], self.stops[position]
+            return 0, 0
+        first, last = np.searchsorted(self.keys, [sensor_id * KEY_FACTOR, (sensor_id + 1) * KEY_FACTOR])
+        return (self.starts[first], self.stops[last - 1]) if last > first else (0, 0)
+
+    def slice(self, sensor_id, delay=None):
+        """Rows of one sensor (at one delay, if given) as a contiguous slice of the summary."""
+        start, stop = self._bounds(sensor_id, delay)
+        return self.frame.iloc[start:stop]
+
+    def select(self, sensors, delay=None):
+        """Rows of several sensors (at one delay, if given), in the order of `sensors`."""
+        bounds = [self._bounds(sensor_id, delay) for sensor_id in sensors]
+        if not bounds:
+            return self.frame.iloc[:0]
+        return self.frame.iloc[np.concatenate([np.arange(start, stop) for start, stop in bounds])]
+
 
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-def visualize_lineplot_ping_time_with_variability_by_cluster(df, cluster_sensors, delay=None):
+def visualize_lineplot_ping_time_with_variability_by_cluster(df, cluster_sensors, delay=None, batch_traces=False, max_sensors=None, use_webgl=False):
     """
     Visualize the effect of range on ping time for each cluster with variability, optionally filtering by delay.
 
@@ -236,16 +411,12 @@ def visualize_lineplot_ping_time_with_variability_by_cluster(df, cluster_sensors
     df (DataFrame): The DataFrame containing the data.
     cluster_sensors (dict): Dictionary where keys are cluster labels and values are lists of sensor IDs in each cluster.
     delay (int, optional): If specified, only data for this delay will be plotted. Otherwise, all delays are plotted.
+    batch_traces (bool): Whether to draw all sensors of a subplot as one NaN-separated trace instead of one trace per sensor.
+    max_sensors (int, optional): Maximum number of sensors drawn per cluster; larger clusters are downsampled.
+    use_webgl (bool): Whether to use WebGL `Scattergl` traces.
     """
-    # Group by sensor ID, range, and delay, then calculate the mean and standard deviation of ping time
-    grouped_df = df.groupby(['Sensor ID', 'Range (cm)', 'Delay (us)']).agg(
-        mean_ping_time=('Ping Time (us)', 'mean'),
-        std_ping_time=('Ping Time (us)', 'std')
-    ).reset_index()
-
-    # Filter by the specified delay if provided
-    if delay is not None:
-        grouped_df = grouped_df[grouped_df['Delay (us)'] == delay]
+    # Mean and standard deviation of ping time per sensor, range and delay, indexed by sensor and delay
+    summary = SummaryIndex.from_rows(df)
 
     # Define the number of columns for subplots
     num_clusters = len(cluster_sensors)
@@ -255,30 +426,36 @@ def visualize_lineplot_ping_time_with_variability_by_cluster(df, cluster_sensors
     # Create subplots
     fig = make_subplots(rows=num_rows, cols=num_columns, subplot_titles=[f'Cluster {cluster}' for cluster in cluster_sensors.keys()])
 
+    trace_type = go.Scattergl if use_webgl else go.Scatter
+
     for i, (cluster, sensors) in enumerate(cluster_sensors.items()):
-        cluster_df = grouped_df[grouped_df['Sensor ID'].isin(sensors)]
+        sensors = cap_sensors(sensors, max_sensors)
+        cluster_df = summary.select(sensors, delay)
 
         # Get the row and column position for the subplot
         row = (i // num_columns) + 1
         col = (i % num_columns) + 1
 
         # Adding error bars
-        for sensor_id in sensors:
-            sensor_data = cluster_df[cluster_df['Sensor ID'] == sensor_id]
-            fig.add_trace(
-                go.Scatter(
-                    x=sensor_data['Range (cm)'],
-                    y=sensor_data['mean_ping_time'],
-                    mode='lines+markers',
-                    name=f'Sensor {sensor_id}',
-                    error_y=dict(
-                        type='data',
-                        array=sensor_data['std_ping_time'],
-                        visible=True
-                    )
-                ),
-                row=row, col=col
-            )
+        if batch_traces:
+            fig.add_trace(batched_sensor_trace(cluster_df, use_webgl=use_webgl), row=row, col=col)
+        else:
+            for sensor_id in sensors:
+                sensor_data = summary.slice(sensor_id, delay)
+                fig.add_trace(
+                    trace_type(
+                        x=sensor_data['Range (cm)'],
+                        y=sensor_data['mean_ping_time'],
+                        mode='lines+markers',
+                        name=f'Sensor {sensor_id}',
+                        error_y=dict(
+                            type='data',
+                            array=sensor_data['std_ping_time'],
+                            visible=True
+                        )
+                    ),
+                    row=row, col=col
+                )
 
         # Plot reference line
         ranges = np.linspace(cluster_df['Range (cm)'].min(), cluster_df['Range (cm)'].max(), 100)
@@ -303,10 +480,10 @@ def visualize_lineplot_ping_time_with_variability_by_cluster(df, cluster_sensors
 
     fig.show()
 
-def visualize_cluster_delay(df, delay_pos=4):
+def visualize_cluster_delay(df, delay_pos=4, batch_traces=False, max_sensors=None, use_webgl=False):
     # Load the dataset
     file_path = '../processed_data/all_data_v4-1-1_cleaned_sensor211.csv'
-    all_cleaned_df = pd.read_csv(file_path)
+    all_cleaned_df = read_rows(file_path)
     all_cleaned_df = all_cleaned_df.drop("Unnamed: 0", axis=1)
     
     # Dictionary to store sensors grouped by cluster
@@ -314,7 +491,7 @@ def visualize_cluster_delay(df, delay_pos=4):
 
     delays = [3000,6000,8000,10000,16800]
 
-    visualize_lineplot_ping_time_with_variability_by_cluster(all_cleaned_df, cluster_sensors, delays[delay_pos])
+    visualize_lineplot_ping_time_with_variability_by_cluster(all_cleaned_df, cluster_sensors, delays[delay_pos], batch_traces, max_sensors, use_webgl)
 
 
 
@@ -323,7 +500,7 @@ import numpy as np
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-def visualize_lineplot_ping_time_with_variability_side_by_side(df, cluster_sensors, delays):
+def visualize_lineplot_ping_time_with_variability_side_by_side(df, cluster_sensors, delays, batch_traces=False, max_sensors=None, use_webgl=False):
     """
     Visualize the effect of range on ping time for selected clusters and delays side-by-side with variability.
 
@@ -331,12 +508,12 @@ def visualize_lineplot_ping_time_with_variability_side_by_side(df, cluster_senso
     df (DataFrame): The DataFrame containing the data.
     cluster_sensors (dict): Dictionary where keys are cluster labels and values are lists of sensor IDs in each cluster.
     delays (list): List of delays to compare across clusters.
+    batch_traces (bool): Whether to draw all sensors of a subplot as one NaN-separated trace instead of one trace per sensor.
+    max_sensors (int, optional): Maximum number of sensors drawn per cluster; larger clusters are downsampled.
+    use_webgl (bool): Whether to use WebGL `Scattergl` traces.
     """
-    # Group by sensor ID, range, and delay, then calculate the mean and standard deviation of ping time
-    grouped_df = df.groupby(['Sensor ID', 'Range (cm)', 'Delay (us)']).agg(
-        mean_ping_time=('Ping Time (us)', 'mean'),
-        std_ping_time=('Ping Time (us)', 'std')
-    ).reset_index()
+    # Mean and standard deviation of ping time per sensor, range and delay, indexed by sensor and delay
+    summary = SummaryIndex.from_rows(df)
 
     # Determine number of rows and columns for subplots
     num_clusters = len(cluster_sensors)
@@ -352,34 +529,38 @@ def visualize_lineplot_ping_time_with_variability_side_by_side(df, cluster_senso
         subplot_titles=[f'Cluster {cluster} - Delay {delay} us' for delay in delays for cluster in cluster_sensors.keys()]
     )
 
+    trace_type = go.Scattergl if use_webgl else go.Scatter
+
     for i, cluster in enumerate(cluster_sensors.keys()):
-        sensors = cluster_sensors[cluster]
-        cluster_df = grouped_df[grouped_df['Sensor ID'].isin(sensors)]
-        
+        sensors = cap_sensors(cluster_sensors[cluster], max_sensors)
+
         for j, delay in enumerate(delays):
-            delay_df = cluster_df[cluster_df['Delay (us)'] == delay]
+            delay_df = summary.select(sensors, delay)
 
             # Get the row and column position for the subplot
             row = j + 1
             col = i + 1
 
             # Adding error bars
-            for sensor_id in sensors:
-                sensor_data = delay_df[delay_df['Sensor ID'] == sensor_id]
-                fig.add_trace(
-                    go.Scatter(
-                        x=sensor_data['Range (cm)'],
-                        y=sensor_data['mean_ping_time'],
-                        mode='lines+markers',
-                        name=f'Sensor {sensor_id} (Delay {delay} us)',
-                        error_y=dict(
-                            type='data',
-                            array=sensor_data['std_ping_time'],
-                            visible=True
-                        )
-                    ),
-                    row=row, col=col
-                )
+            if batch_traces:
+                fig.add_trace(batched_sensor_trace(delay_df, use_webgl=use_webgl), row=row, col=col)
+            else:
+                for sensor_id in sensors:
+                    sensor_data = summary.slice(sensor_id, delay)
+                    fig.add_trace(
+                        trace_type(
+                            x=sensor_data['Range (cm)'],
+                            y=sensor_data['mean_ping_time'],
+                            mode='lines+markers',
+                            name=f'Sensor {sensor_id} (Delay {delay} us)',
+                            error_y=dict(
+                                type='data',
+                                array=sensor_data['std_ping_time'],
+                                visible=True
+                            )
+                        ),
+                        row=row, col=col
+                    )
 
             # Plot reference line
             ranges = np.linspace(delay_df['Range (cm)'].min(), delay_df['Range (cm)'].max(), 100)
@@ -404,7 +585,7 @@ def visualize_lineplot_ping_time_with_variability_side_by_side(df, cluster_senso
 
     fig.show()
 
-def visualize_cluster_delay_side_by_side(df, clusters_to_compare, delays=[3000, 6000, 8000, 10000, 16800]):
+def visualize_cluster_delay_side_by_side(df, clusters_to_compare, delays=[3000, 6000, 8000, 10000, 16800], batch_traces=False, max_sensors=None, use_webgl=False):
     """
     Compare multiple clusters across all specified delays side by side.
 
@@ -412,17 +593,20 @@ def visualize_cluster_delay_side_by_side(df, clusters_to_compare, delays=[3000,
     df (DataFrame): The DataFrame containing the data, including clustering information.
     clusters_to_compare (list): List of cluster labels to compare side-by-side.
     delays (list): List of delays to compare.
+    batch_traces (bool): Whether to draw all sensors of a subplot as one NaN-separated trace.
+    max_sensors (int, optional): Maximum number of sensors drawn per cluster.
+    use_webgl (bool): Whether to use WebGL `Scattergl` traces.
     """
     # Load the dataset
     file_path = '../processed_data/all_data_v4-1-1_cleaned_sensor211.csv'
-    all_cleaned_df = pd.read_csv(file_path)
+    all_cleaned_df = read_rows(file_path)
     all_cleaned_df = all_cleaned_df.drop("Unnamed: 0",axis=1)
 
     # Dictionary to store sensors grouped by cluster
     cluster_sensors = {cluster: df[df["cluster"] == cluster]["Sensor ID"].unique() for cluster in clusters_to_compare}
 
     # Visualize side-by-side comparisons for the selected clusters and delays
-    visualize_lineplot_ping_time_with_variability_side_by_side(all_cleaned_df, cluster_sensors, delays)
+    visualize_lineplot_ping_time_with_variability_side_by_side(all_cleaned_df, cluster_sensors, delays, batch_traces, max_sensors, use_webgl)
 
 
 import pandas as pd
@@ -430,27 +614,24 @@ import numpy as np
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-def visualize_sensors_delay_side_by_side(sensors_to_compare, delays=[3000, 6000, 8000, 10000, 16800]):
+def visualize_sensors_delay_side_by_side(sensors_to_compare, delays=[3000, 6000, 8000, 10000, 16800], summary=None):
     """
     Compare multiple sensors across all specified delays side by side.
 
     Parameters:
     sensors_to_compare (list): List of sensor IDs to compare side-by-side.
     delays (list): List of delays to compare.
+    summary (SummaryIndex, optional): Indexed summary of the dataset. Built from the cleaned dataset
+                                      for the compared sensors only when not given.
     """
-    # Load the dataset
-    file_path = '../processed_data/all_data_v4-1-1_cleaned_sensor211.csv'
-    all_cleaned_df = pd.read_csv(file_path)
-    all_cleaned_df = all_cleaned_df.drop("Unnamed: 0", axis=1)
+    if summary is None:
+        # Load the dataset
+        file_path = '../processed_data/all_data_v4-1-1_cleaned_sensor211.csv'
+        all_cleaned_df = read_rows(file_path)
+        all_cleaned_df = all_cleaned_df.drop("Unnamed: 0", axis=1)
 
-    # Group by sensor ID, range, and delay, then calculate the mean and standard deviation of ping time
-    grouped_df = all_cleaned_df.groupby(['Sensor ID', 'Range (cm)', 'Delay (us)']).agg(
-        mean_ping_time=('Ping Time (us)', 'mean'),
-        std_ping_time=('Ping Time (us)', 'std')
-    ).reset_index()
-
-    # Filter the data to include only the sensors of interest
-    grouped_df = grouped_df[grouped_df['Sensor ID'].isin(sensors_to_compare)]
+        # Mean and standard deviation of ping time per range and delay of the sensors of interest
+        summary = SummaryIndex.from_rows(all_cleaned_df, sensors=sensors_to_compare)
 
     # Determine number of rows and columns for subplots
     num_sensors = len(sensors_to_compare)
@@ -471,10 +652,8 @@ def visualize_sensors_delay_side_by_side(sensors_to_compare, delays=[3000, 6000,
     )
 
     for i, sensor_id in enumerate(sensors_to_compare):
-        sensor_df = grouped_df[grouped_df['Sensor ID'] == sensor_id]
-        
         for j, delay in enumerate(delays):
-            delay_df = sensor_df[sensor_df['Delay (us)'] == delay]
+            delay_df = summary.slice(sensor_id, delay)
 
             # Get the row and column position for the subplot
             row = j + 1
@@ -536,24 +715,12 @@ def find_and_visualize_closest_sensors(target_sensor_id, n=5, metric='euclidean'
     - metric (str): Distance metric to use ('euclidean' or 'cosine').
     - delays (list): List of delays to compare.
     """
-    # Load the dataset
-    file_path = '../processed_data/all_data_v4-1-1_cleaned_sensor211.csv'
-    all_cleaned_df = pd.read_csv(file_path)
-    all_cleaned_df = all_cleaned_df.drop("Unnamed: 0", axis=1)
-    
-    # Group by sensor ID, range, and delay, then calculate the mean and standard deviation of ping time
-    grouped_df = all_cleaned_df.groupby(['Sensor ID', 'Range (cm)', 'Delay (us)']).agg(
-        mean_ping_time=('Ping Time (us)', 'mean'),
-        std_ping_time=('Ping Time (us)', 'std')
-    ).reset_index()
-    
-    # Pivot the data to create feature vectors for each sensor
-    pivot_df = grouped_df.pivot_table(
-        index='Sensor ID', 
-        columns=['Delay (us)', 'Range (cm)'], 
-        values='mean_ping_time'
-    ).fillna(0)
-    
+    # Mean ping time of every sensor at every range and delay, from the feature cache
+    store = DatasetStore(['data_v4.1.1'])
+    cells = sorted(range_delay_cells(store), key=lambda cell: (cell[1], cell[0]))
+    spec = FeatureSpec([(range_cm, delay, 'mean', ALL_BAND) for range_cm, delay in cells], name='mean_all')
+    pivot_df = load_sensor_features(spec).set_index('Sensor ID')
+
     # Ensure the target sensor exists in the data
     if target_sensor_id not in pivot_df.index:
         print(f"Sensor ID {target_sensor_id} not found in the data.")
@@ -589,9 +756,10 @@ def find_and_visualize_closest_sensors(target_sensor_id, n=5, metric='euclidean'
     
     # Include the target sensor in the visualization
     sensors_to_visualize = [target_sensor_id] + closest_sensor_ids
-    
-    # Use the existing visualization function
-    visualize_sensors_delay_side_by_side(sensors_to_visualize, delays)
+
+    # Only the rows of the visualized sensors are read
+    df = store.load(sensors=sensors_to_visualize, versions=['data_v4.1.1'], columns=['Sensor ID', 'Range (cm)', 'Delay (us)', 'Ping Time (us)'])
+    visualize_sensors_delay_side_by_side(sensors_to_visualize, delays, summary=SummaryIndex.from_rows(df))
 
 
 from sklearn.preprocessing import StandardScaler
@@ -600,8 +768,7 @@ from sklearn.manifold import TSNE
 
 def visulaize_clustering_all(df,random_state=42, visualization_method='PCA', plot_3d=False):
 
-    # Standardize the features
-    df = df.copy()
+    # Standardize the features (`df` is only read)
     sensor_ids = df.index if 'Sensor ID' not in df.columns else df['Sensor ID']
     scaler = StandardScaler()
     features_scaled = scaler.fit_transform(df.drop(columns=['Sensor ID']))
@@ -676,7 +843,7 @@ def visualize_aggregated_ping_time_with_variability(df, cluster=0, file_path='..
     file_path (str): The path to the full dataset for aggregation.
     """
     # Load and prepare data
-    all_cleaned_df = pd.read_csv(file_path).drop("Unnamed: 0", axis=1)
+    all_cleaned_df = read_rows(file_path).drop("Unnamed: 0", axis=1)
     cluster_sensors = df[df["cluster"] == cluster]["Sensor ID"].unique()
     cluster_df = all_cleaned_df[all_cleaned_df['Sensor ID'].isin(cluster_sensors)]
     
@@ -741,4 +908,148 @@ def visualize_aggregated_ping_time_with_variability(df, cluster=0, file_path='..
         template="plotly_white"
     )
 
-    fig.show()
\ No newline at end of file
+    fig.show()
+
+
+from scipy.stats import norm
+from sklearn.metrics import silhouette_score
+
+
+def prepare_silhouette_distances(features_scaled, sample_size=1000, random_state=42):
+    """
+    Precompute the distance structure used by the sampled silhouette estimate.
+
+    A fixed pool of rows is drawn once and its distances to every row are stored, so a sweep
+    over the number of clusters only needs a per-cluster reduction of this matrix for each k
+    instead of a new O(n^2) pass.
+
+    Parameters:
+    features_scaled (ndarray): The standardized feature matrix (n_samples x n_features).
+    sample_size (int): Number of rows in the sample pool. If it covers all rows, the estimate is exact.
+    random_state (int): Random state for reproducibility.
+
+    Returns:
+    dict: The sample pool indices ('sample_index'), their distances to all rows ('distances')
+          and the random generator used to top up small strata ('rng').
+    """
+    features_scaled = np.asarray(features_scaled, dtype=np.float64)
+    n_samples = features_scaled.shape[0]
+    rng = np.random.default_rng(random_state)
+
+    if sample_size is None or sample_size >= n_samples:
+        sample_index = np.arange(n_samples)
+    else:
+        sample_index = np.sort(rng.choice(n_samples, size=sample_size, replace=False))
+
+    distances = cdist(features_scaled[sample_index], features_scaled).astype(np.float32)
+
+    return {'sample_index': sample_index, 'distances': distances, 'rng': rng}
+
+
+def _silhouette_from_cluster_sums(cluster_sums, own_labels, counts):
+    # cluster_sums[i, c] is the summed distance from sample i to every member of cluster c
+    rows = np.arange(len(own_labels))
+    own_counts = counts[own_labels]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = cluster_sums[rows, own_labels] / (own_counts - 1)
+        mean_to_others = cluster_sums / counts
+    mean_to_others[rows, own_labels] = np.inf
+    b = mean_to_others.min(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = (b - a) / np.maximum(a, b)
+    # Singleton clusters score 0, as in sklearn.metrics.silhouette_samples
+    s[own_counts <= 1] = 0
+    return np.nan_to_num(s)
+
+
+def estimate_silhouette_score(features_scaled, cluster_labels, method='exact', distance_cache=None,
+                              sample_size=1000, min_per_cluster=5, confidence=0.95, random_state=42):
+    """
+    Score a clustering with the exact, a stratified-sample or a centroid-based silhouette.
+
+    Parameters:
+    features_scaled (ndarray): The standardized feature matrix (n_samples x n_features).
+    cluster_labels (array-like): Cluster label of each row.
+    method (str): 'exact' (sklearn, O(n^2)), 'sampled' (stratified sample with a confidence interval)
+                  or 'simplified' (distances to cluster centroids, O(n*k)).
+    distance_cache (dict, optional): Output of `prepare_silhouette_distances`, shared across a sweep over k.
+                                     Built on the fly for the 'sampled' method if not given.
+    sample_size (int): Sample pool size used when `distance_cache` is built on the fly.
+    min_per_cluster (int): Minimum number of sampled rows per cluster; small strata are topped up.
+    confidence (float): Confidence level of the interval returned for the 'sampled' method.
+    random_state (int): Random state for reproducibility.
+
+    Returns:
+    float: The silhouette score (or its estimate).
+    float: Lower bound of the confidence interval (equal to the score for 'exact' and 'simplified').
+    float: Upper bound of the confidence interval (equal to the score for 'exact' and 'simplified').
+    """
+    features_scaled = np.asarray(features_scaled, dtype=np.float64)
+    _, labels = np.unique(np.asarray(cluster_labels), return_inverse=True)
+    n_clusters = labels.max() + 1
+    counts = np.bincount(labels, minlength=n_clusters).astype(np.float64)
+
+    if method == 'exact':
+        score = silhouette_score(features_scaled, labels)
+        return score, score, score
+
+    if method == 'simplified':
+        one_hot = np.zeros((len(labels), n_clusters))
+        one_hot[np.arange(len(labels)), labels] = 1
+        centroids = one_hot.T @ features_scaled / counts[:, None]
+        distances = cdist(features_scaled, centroids)
+
+        rows = np.arange(len(labels))
+        a = distances[rows, labels]
+        distances[rows, labels] = np.inf
+        b = distances.min(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = np.nan_to_num((b - a) / np.maximum(a, b))
+        s[counts[labels] <= 1] = 0
+        score = s.mean()
+        return score, score, score
+
+    if method != 'sampled':
+        raise ValueError("method should be either 'exact', 'sampled' or 'simplified'.")
+
+    if distance_cache is None:
+        distance_cache = prepare_silhouette_distances(features_scaled, sample_size, random_state)
+
+    sample_index = distance_cache['sample_index']
+    distances = distance_cache['distances']
+
+    # Top up clusters that the fixed pool under-represents so every stratum is estimated
+    in_pool = np.zeros(len(labels), dtype=bool)
+    in_pool[sample_index] = True
+    pool_counts = np.bincount(labels[sample_index], minlength=n_clusters)
+    extra_index = []
+    for cluster in np.flatnonzero(pool_counts < np.minimum(min_per_cluster, counts)):
+        candidates = np.flatnonzero((labels == cluster) & ~in_pool)
+        n_extra = int(min(min_per_cluster, counts[cluster]) - pool_counts[cluster])
+        extra_index.append(distance_cache['rng'].choice(candidates, size=n_extra, replace=False))
+    if extra_index:
+        extra_index = np.concatenate(extra_index)
+        sample_index = np.concatenate([sample_index, extra_index])
+        distances = np.vstack([distances, cdist(features_scaled[extra_index], features_scaled).astype(np.float32)])
+
+    one_hot = np.zeros((len(labels), n_clusters), dtype=np.float32)
+    one_hot[np.arange(len(labels)), labels] = 1
+    cluster_sums = (distances @ one_hot).astype(np.float64)
+    sample_labels = labels[sample_index]
+    s = _silhouette_from_cluster_sums(cluster_sums, sample_labels, counts)
+
+    # Stratified estimate: clusters are the strata, weighted by their share of the fleet
+    stratum_size = np.bincount(sample_labels, minlength=n_clusters).astype(np.float64)
+    stratum_mean = np.bincount(sample_labels, weights=s, minlength=n_clusters) / stratum_size
+    stratum_ss = np.bincount(sample_labels, weights=(s - stratum_mean[sample_labels]) ** 2, minlength=n_clusters)
+    stratum_var = np.divide(stratum_ss, stratum_size - 1, out=np.zeros(n_clusters), where=stratum_size > 1)
+
+    weights = counts / counts.sum()
+    finite_population_correction = 1 - stratum_size / counts
+    score = np.sum(weights * stratum_mean)
+    variance = np.sum(weights ** 2 * stratum_var / stratum_size * finite_population_correction)
+    half_width = norm.ppf(0.5 + confidence / 2) * np.sqrt(variance)
+
+    return score, score - half_width, score + half_width
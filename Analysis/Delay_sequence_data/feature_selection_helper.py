@@ -0,0 +1,267 @@
+"""
+Batch evaluation of candidate feature sets.
+
+The full feature cube (every range x delay x statistic x quartile band, see `feature_spec.py`)
+is computed once per sensor in a single pass over the cleaned rows and standardized once. The
+correlation and mutual information between all pairs of features are computed once from the
+standardized cube, so each candidate subset is scored by indexing into them. Only the
+clustering score has to be computed per subset; the subsets are scored in parallel worker
+processes that receive the standardized cube once.
+
+Usage (from Analysis/Delay_sequence_data):
+    python feature_selection_helper.py --clusters 13 --jobs 4
+"""
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans
+
+from clustering_helper import estimate_silhouette_score
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(os.path.dirname(script_dir))
+if repo_dir not in sys.path:
+    sys.path.append(repo_dir)
+
+from feature_spec import BANDS, STATISTICS, Feature, FeatureSpec, compute_features  # noqa: E402
+
+DATA_FILE = os.path.join(script_dir, '..', 'processed_data', 'all_data_v4-1-1_cleaned_sensor211.csv')
+FINAL_SPEC_FILE = os.path.join(script_dir, 'best_models', 'final', 'feature_spec_final_mi.json')
+
+
+def full_feature_spec(df, statistics=STATISTICS, bands=BANDS):
+    """
+    Spec of every (range, delay) cell present in `df`, with every statistic and band.
+
+    Parameters:
+    df (DataFrame): Rows with 'Range (cm)' and 'Delay (us)'.
+    statistics (tuple): Statistics to include.
+    bands (tuple): Quartile bands to include.
+
+    Returns:
+    FeatureSpec: The features ordered by band, statistic, range and delay.
+    """
+    cells = df[['Range (cm)', 'Delay (us)']].drop_duplicates().sort_values(['Range (cm)', 'Delay (us)'])
+    cells = list(cells.itertuples(index=False, name=None))
+    return FeatureSpec([Feature(int(range_cm), int(delay), statistic, band)
+                        for band in bands for statistic in statistics for range_cm, delay in cells], name='full')
+
+
+def _quantile_bins(features_scaled, n_bins):
+    # Equal-frequency bin of every value, per column. Ties share a bin, so constant columns get one bin.
+    ranks = pd.DataFrame(features_scaled).rank(method='min').to_numpy() - 1
+    return np.minimum((ranks * n_bins / len(features_scaled)).astype(np.int64), n_bins - 1)
+
+
+def mutual_information_matrix(features_scaled, n_bins=8, block_size=64):
+    """
+    Pairwise mutual information of all columns, from equal-frequency bins.
+
+    All joint histograms are computed together as products of one-hot bin indicators, in
+    blocks of `block_size` columns to bound the memory used.
+
+    Parameters:
+    features_scaled (ndarray): The standardized feature matrix (n_samples x n_features).
+    n_bins (int): Number of bins per feature.
+    block_size (int): Number of columns whose joint histograms are computed at once.
+
+    Returns:
+    ndarray: Mutual information in nats (n_features x n_features).
+    """
+    n_samples, n_features = features_scaled.shape
+    bins = _quantile_bins(features_scaled, n_bins)
+    one_hot = np.zeros((n_samples, n_features * n_bins), dtype=np.float32)
+    one_hot[np.arange(n_samples)[:, None], np.arange(n_features) * n_bins + bins] = 1
+    marginals = one_hot.sum(axis=0).reshape(n_features, n_bins) / n_samples
+
+    mi = np.empty((n_features, n_features))
+    for start in range(0, n_features, block_size):
+        stop = min(start + block_size, n_features)
+        joint = (one_hot[:, start * n_bins:stop * n_bins].T @ one_hot) / n_samples
+        joint = joint.reshape(stop - start, n_bins, n_features, n_bins)
+        expected = marginals[start:stop, :, None, None] * marginals[None, None, :, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.where(joint > 0, joint * np.log(joint / expected), 0)
+        mi[start:stop] = terms.sum(axis=(1, 3))
+    return mi
+
+
+# Standardized cube of the worker processes, set once by `_init_worker`
+_worker_features = None
+
+
+def _init_worker(features_scaled):
+    global _worker_features
+    _worker_features = features_scaled
+
+
+def _cluster_score(job):
+    indices, n_clusters, random_state = job
+    subset = _worker_features[:, indices]
+    kmeans = KMeans(n_clusters=n_clusters, n_init='auto', random_state=random_state).fit(subset)
+    silhouette, _, _ = estimate_silhouette_score(subset, kmeans.labels_)
+    return silhouette, kmeans.inertia_ / len(subset)
+
+
+class FeatureCube:
+    """
+    Standardized full feature cube of a dataset, with the pairwise feature statistics.
+
+    Parameters:
+    df (DataFrame): Cleaned rows with 'Sensor ID', 'Range (cm)', 'Delay (us)' and 'Ping Time (us)'.
+    spec (FeatureSpec, optional): Features of the cube. Defaults to `full_feature_spec(df)`.
+    n_bins (int): Number of bins per feature for the mutual information.
+    """
+
+    def __init__(self, df, spec=None, n_bins=8):
+        self.spec = spec or full_feature_spec(df)
+        self.features = compute_features(df, self.spec)
+        self.sensor_ids = self.features['Sensor ID'].to_numpy()
+        self.columns = self.spec.columns
+        self.column_index = {column: i for i, column in enumerate(self.columns)}
+
+        values = self.features[self.columns].to_numpy(dtype=np.float64)
+        std = values.std(axis=0)
+        # Constant columns (e.g. a band that is always empty) are centered but not scaled, as StandardScaler does
+        self.features_scaled = (values - values.mean(axis=0)) / np.where(std > 0, std, 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.correlation = np.nan_to_num(np.corrcoef(self.features_scaled, rowvar=False))
+        self.mutual_information = mutual_information_matrix(self.features_scaled, n_bins)
+
+    def indices(self, columns):
+        return np.array([self.column_index[column] for column in columns])
+
+    def drop_correlated(self, columns=None, threshold=0.8):
+        """
+        Drop the later feature of every highly positively correlated pair, like
+        `drop_highly_correlated_features` in `US_delay_sequence_feature_engineering.ipynb`.
+
+        Parameters:
+        columns (list, optional): Features to filter, in order. Defaults to the whole cube.
+        threshold (float): Correlation above which the later feature of a pair is dropped.
+
+        Returns:
+        list: The remaining features.
+        """
+        columns = list(columns or self.columns)
+        correlation = self.correlation[np.ix_(self.indices(columns), self.indices(columns))]
+        dropped = np.triu(correlation > threshold, k=1).any(axis=0)
+        return [column for column, drop in zip(columns, dropped) if not drop]
+
+    def rank_by_coverage(self, columns=None):
+        """
+        Rank features by their mean mutual information with the whole cube.
+
+        Parameters:
+        columns (list, optional): Features to rank. Defaults to the whole cube.
+
+        Returns:
+        Series: Mean mutual information of each feature, in decreasing order.
+        """
+        columns = list(columns or self.columns)
+        coverage = self.mutual_information[self.indices(columns)].mean(axis=1)
+        return pd.Series(coverage, index=columns).sort_values(ascending=False)
+
+    def _subset_statistics(self, indices):
+        correlation = np.abs(self.correlation[np.ix_(indices, indices)])
+        mi = self.mutual_information[np.ix_(indices, indices)]
+        pairs = np.triu_indices(len(indices), k=1)
+        return {
+            'features': len(indices),
+            'mean_abs_corr': correlation[pairs].mean() if len(indices) > 1 else 0.0,
+            'max_abs_corr': correlation[pairs].max() if len(indices) > 1 else 0.0,
+            'mi_redundancy': mi[pairs].mean() if len(indices) > 1 else 0.0,
+            # How well the subset represents the cube: best MI of every cube feature with the subset
+            'mi_coverage': self.mutual_information[indices].max(axis=0).mean(),
+        }
+
+    def evaluate(self, candidates, n_clusters=13, n_jobs=None, random_state=42):
+        """
+        Score many candidate feature sets.
+
+        Parameters:
+        candidates (dict): Name mapped to a FeatureSpec or a list of feature names of the cube.
+        n_clusters (int): Number of KMeans clusters of the clustering score.
+        n_jobs (int, optional): Number of worker processes for the clustering scores. Defaults to the
+                                number of CPUs; 1 scores in this process.
+        random_state (int): Random state of KMeans.
+
+        Returns:
+        DataFrame: One row per candidate with 'features', 'mean_abs_corr', 'max_abs_corr',
+                   'mi_redundancy', 'mi_coverage', 'silhouette' and 'inertia' (per sensor),
+                   sorted by silhouette.
+        """
+        names = list(candidates)
+        subsets = [self.indices(candidates[name].columns if isinstance(candidates[name], FeatureSpec) else candidates[name])
+                   for name in names]
+        jobs = [(indices, n_clusters, random_state) for indices in subsets]
+
+        n_jobs = n_jobs or os.cpu_count()
+        if n_jobs == 1 or len(jobs) == 1:
+            _init_worker(self.features_scaled)
+            scores = list(map(_cluster_score, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                     initargs=(self.features_scaled,)) as executor:
+                scores = list(executor.map(_cluster_score, jobs, chunksize=max(1, len(jobs) // (4 * n_jobs))))
+
+        results = pd.DataFrame([dict(self._subset_statistics(indices), silhouette=silhouette, inertia=inertia)
+                                for indices, (silhouette, inertia) in zip(subsets, scores)], index=names)
+        return results.sort_values('silhouette', ascending=False)
+
+    def to_spec(self, columns, name=None):
+        """FeatureSpec of some cube features, to train and serve a model on them."""
+        return FeatureSpec.from_columns(columns, name=name, fill_value=self.spec.fill_value)
+
+
+def default_candidates(cube, sizes=(5, 10, 15, 20), thresholds=(0.6, 0.7, 0.8, 0.9)):
+    """
+    Candidate feature sets following the notebooks: the current model's features, correlation
+    filters of the middle-band means and of the whole cube, and the top features of each filter
+    by mutual information coverage.
+
+    Parameters:
+    cube (FeatureCube): The cube the candidates are drawn from.
+    sizes (tuple): Numbers of top features kept from each filter.
+    thresholds (tuple): Correlation thresholds of the filters.
+
+    Returns:
+    dict: Name mapped to a list of features.
+    """
+    candidates = {}
+    if os.path.exists(FINAL_SPEC_FILE):
+        candidates['final_mi'] = FeatureSpec.load(FINAL_SPEC_FILE).columns
+    mean_middle = [column for column in cube.columns if column.endswith('_mean_middle')]
+    for pool_name, pool in (('mean_middle', mean_middle), ('all', cube.columns)):
+        for threshold in thresholds:
+            kept = cube.drop_correlated(pool, threshold)
+            ranked = list(cube.rank_by_coverage(kept).index)
+            for size in sizes:
+                if size <= len(ranked):
+                    candidates[f"{pool_name}_corr{threshold}_top{size}"] = ranked[:size]
+    return candidates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default=DATA_FILE, help='Cleaned dataset CSV')
+    parser.add_argument('--clusters', type=int, default=13)
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--top', type=int, default=15, help='Number of candidates printed')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data, usecols=['Sensor ID', 'Range (cm)', 'Delay (us)', 'Ping Time (us)'])
+    cube = FeatureCube(df)
+    candidates = default_candidates(cube)
+    results = cube.evaluate(candidates, n_clusters=args.clusters, n_jobs=args.jobs)
+    print(f"{len(cube.columns)} features, {len(cube.sensor_ids)} sensors, {len(candidates)} candidates")
+    with pd.option_context('display.width', 200):
+        print(results.head(args.top).to_string(float_format='{:.4f}'.format))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(os.path.dirname(script_dir))
+if repo_dir not in sys.path:
+    sys.path.append(repo_dir)
+
+from raw_query import RowIndex  # noqa: E402
+from row_dtypes import read_rows  # noqa: E402
+
+# Bump when the rendering code changes so every cached figure is redrawn
+RENDER_VERSION = 1
+
+# Plotly's default colorway, so the exported figures match the interactive ones
+PLOTLY_COLORS = ['#636EFA', '#EF553B', '#00CC96', '#AB63FA', '#FFA15A', '#19D3F3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52']
+
+# Comparison grids from the characterization notebook (sensor_characterization_mi), regenerated
+# with the cluster figures under the names the thesis uses in `Figures/Thesis`
+THESIS_FIGURES = [
+    {'name': 'Figure_4.1.1_close_sensors', 'kind': 'sensor_comparison', 'sensors': [92, 58, 6, 20]},
+    {'name': 'Figure_4.1.2_further_sensors', 'kind': 'sensor_comparison', 'sensors': [68, 55, 161, 2]},
+    {'name': 'Figure_4.1.3_outliers', 'kind': 'cluster_comparison', 'clusters': [10, 9, 4, 7, 8]},
+    {'name': 'Figure_4.1.4_axis_below', 'kind': 'cluster_comparison', 'clusters': [2, 3, 12]},
+]
+
+
+def summarize_ping_time(df, by):
+    """
+    Calculate the mean and standard deviation of ping time per group.
+
+    Parameters:
+    df (DataFrame): The DataFrame containing the raw data.
+    by (list): Columns to group by.
+
+    Returns:
+    DataFrame: Grouped summary with 'mean_ping_time' and 'std_ping_time' columns.
+    """
+    return df.groupby(by).agg(
+        mean_ping_time=('Ping Time (us)', 'mean'),
+        std_ping_time=('Ping Time (us)', 'std')
+    ).reset_index()
+
+
+def content_hash(summary_df, spec):
+    """
+    Hash the data behind a figure together with its spec and the renderer version.
+
+    Parameters:
+    summary_df (DataFrame): The summary the figure is drawn from.
+    spec (dict): The figure spec.
+
+    Returns:
+    str: Hex digest identifying the figure content.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'spec': spec, 'render_version': RENDER_VERSION}, sort_keys=True, default=str).encode())
+    digest.update(pd.util.hash_pandas_object(summary_df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _save(fig, output_path):
+    FigureCanvasAgg(fig)
+    fig.savefig(output_path, dpi=100)
+    return output_path
+
+
+def _plot_errorbar(ax, data, color, label=None):
+    ax.errorbar(data['Range (cm)'], data['mean_ping_time'], yerr=data['std_ping_time'], color=color,
+                marker='o', markersize=4, capsize=3, label=label)
+
+
+def _plot_reference_line(ax, data):
+    if data.empty:
+        return
+    ranges = np.linspace(data['Range (cm)'].min(), data['Range (cm)'].max(), 100)
+    ax.plot(ranges, 57 * ranges, color='red', linestyle='--')
+
+
+def render_cluster_figure(aggregated_df, cluster, output_path):
+    """
+    Render the aggregated ping time vs range figure of one cluster to a PNG file, without a GUI.
+
+    Mirrors `visualize_aggregated_ping_time_with_variability`: one subplot per delay with the
+    mean and standard deviation across the cluster's sensors and the 57 us/cm reference line.
+
+    Parameters:
+    aggregated_df (DataFrame): Summary grouped by 'Delay (us)' and 'Range (cm)'.
+    cluster (int): The cluster number, used in the title.
+    output_path (str): Path of the PNG file to write.
+
+    Returns:
+    str: The path of the written figure.
+    """
+    unique_delays = aggregated_df['Delay (us)'].unique()
+    num_columns = 2
+    num_rows = -(-len(unique_delays) // num_columns)
+
+    fig = Figure(figsize=(12, 8))
+    fig.suptitle(f"Aggregated Ping Time vs Range for Cluster {cluster} Across Delays", x=0.05, ha='left')
+    for i, delay in enumerate(unique_delays):
+        ax = fig.add_subplot(num_rows, num_columns, i + 1)
+        subset_df = aggregated_df[aggregated_df['Delay (us)'] == delay]
+        # Every second plotly color, as the reference line takes the other half of the colorway
+        _plot_errorbar(ax, subset_df, PLOTLY_COLORS[(2 * i) % len(PLOTLY_COLORS)])
+        _plot_reference_line(ax, subset_df)
+        ax.set_title(f'Delay: {delay} us')
+        ax.grid(True, alpha=0.3)
+    fig.tight_layout()
+
+    return _save(fig, output_path)
+
+
+def render_comparison_figure(grouped_df, columns, delays, title, output_path):
+    """
+    Render a side-by-side grid (delays x columns) of per-sensor ping time vs range, without a GUI.
+
+    Parameters:
+    grouped_df (DataFrame): Summary grouped by 'Sensor ID', 'Range (cm)' and 'Delay (us)'.
+    columns (dict): Column title prefix mapped to the sensor IDs drawn in that column.
+    delays (list): Delays drawn as rows.
+    title (str): Figure title.
+    output_path (str): Path of the PNG file to write.
+
+    Returns:
+    str: The path of the written figure.
+    """
+    fig = Figure(figsize=(4 * len(columns), 3 * len(delays)))
+    fig.suptitle(title, x=0.05, ha='left')
+    for i, (column_title, sensors) in enumerate(columns.items()):
+        column_df = grouped_df[grouped_df['Sensor ID'].isin(sensors)]
+        for j, delay in enumerate(delays):
+            ax = fig.add_subplot(len(delays), len(columns), j * len(columns) + i + 1)
+            delay_df = column_df[column_df['Delay (us)'] == delay]
+            for k, (sensor_id, sensor_data) in enumerate(delay_df.groupby('Sensor ID', sort=False)):
+                _plot_errorbar(ax, sensor_data, PLOTLY_COLORS[k % len(PLOTLY_COLORS)])
+            _plot_reference_line(ax, delay_df)
+            ax.set_title(f'{column_title} - Delay {delay} us', fontsize=10)
+            ax.grid(True, alpha=0.3)
+    fig.tight_layout()
+
+    return _save(fig, output_path)
+
+
+def _render(job):
+    kind, summary_df, spec, output_path = job
+    if kind == 'cluster':
+        return render_cluster_figure(summary_df, spec['cluster'], output_path)
+    if spec['kind'] == 'cluster_comparison':
+        columns = {f"Cluster {cluster}": spec['sensors_by_cluster'][str(cluster)] for cluster in spec['clusters']}
+        title = "Side-by-Side Comparison of Clusters Across All Delays"
+    else:
+        columns = {f"Sensor {sensor}": [sensor] for sensor in spec['sensors']}
+        title = "Side-by-Side Comparison of Sensors Across Delays"
+    return render_comparison_figure(summary_df, columns, spec['delays'], title, output_path)
+
+
+def export_figures(df_cluster, all_cleaned_df, figure_dir=None, thesis_dir=None, thesis_figures=THESIS_FIGURES,
+                   delays=[3000, 6000, 8000, 10000, 16800], n_jobs=None, force=False):
+    """
+    Regenerate the per-cluster characteristic figures and the thesis comparison figures headlessly.
+
+    Figures are rendered in parallel across processes. A figure is only redrawn when the hash of
+    the data it is drawn from changes (or its file is missing); the hashes are kept in
+    `figure_cache.json` inside `figure_dir`.
+
+    Parameters:
+    df_cluster (DataFrame): The DataFrame containing sensor ID and their respective clusters.
+    all_cleaned_df (DataFrame): The DataFrame containing the cleaned data.
+    figure_dir (str, optional): Output folder of the `cluster_<n>.png` figures. Defaults to `characteristic_figure`.
+    thesis_dir (str, optional): Output folder of the thesis figures. Defaults to `Figures/Thesis`.
+    thesis_figures (list): Specs of the comparison figures to regenerate.
+    delays (list): Delays drawn in the figures.
+    n_jobs (int, optional): Number of worker processes. Defaults to the number of CPUs.
+    force (bool): Whether to redraw every figure regardless of the cache.
+
+    Returns:
+    dict: Figure name mapped to the path of its PNG file.
+    """
+    figure_dir = figure_dir or os.path.join(script_dir, 'characteristic_figure')
+    thesis_dir = thesis_dir or os.path.join(script_dir, 'Figures', 'Thesis')
+    os.makedirs(figure_dir, exist_ok=True)
+    os.makedirs(thesis_dir, exist_ok=True)
+
+    cache_file = os.path.join(figure_dir, 'figure_cache.json')
+    cache = {}
+    if os.path.exists(cache_file) and not force:
+        with open(cache_file) as f:
+            cache = json.load(f)
+
+    sensors_by_cluster = df_cluster.groupby('cluster')['Sensor ID'].apply(list).to_dict()
+    jobs = []
+
+    # Per-cluster aggregated figures, each cluster's rows found on the indexed data instead of by a scan
+    rows = RowIndex(all_cleaned_df, columns=['Ping Time (us)'])
+    for cluster, sensors in sensors_by_cluster.items():
+        cluster_df = rows.frame(sensors=sensors, delays=delays)
+        aggregated_df = summarize_ping_time(cluster_df, ['Delay (us)', 'Range (cm)'])
+        spec = {'cluster': int(cluster)}
+        jobs.append(('cluster', aggregated_df, spec, os.path.join(figure_dir, f"cluster_{cluster}.png")))
+
+    # Thesis comparison figures
+    grouped_df = summarize_ping_time(all_cleaned_df, ['Sensor ID', 'Range (cm)', 'Delay (us)'])
+    for thesis_spec in thesis_figures:
+        spec = dict(thesis_spec, delays=thesis_spec.get('delays', delays))
+        if spec['kind'] == 'cluster_comparison':
+            spec['sensors_by_cluster'] = {str(c): [int(s) for s in sensors_by_cluster.get(c, [])] for c in spec['clusters']}
+            sensors = [s for c in spec['clusters'] for s in sensors_by_cluster.get(c, [])]
+        else:
+            sensors = spec['sensors']
+        summary_df = grouped_df[grouped_df['Sensor ID'].isin(sensors)]
+        jobs.append(('thesis', summary_df.reset_index(drop=True), spec, os.path.join(thesis_dir, f"{spec['name']}.png")))
+
+    paths = {}
+    stale = []
+    for job in jobs:
+        kind, summary_df, spec, output_path = job
+        name = os.path.splitext(os.path.basename(output_path))[0]
+        digest = content_hash(summary_df, spec)
+        paths[name] = output_path
+        if cache.get(name) == digest and os.path.exists(output_path):
+            continue
+        cache[name] = digest
+        stale.append(job)
+
+    print(f"Rendering {len(stale)} of {len(jobs)} figures ({len(jobs) - len(stale)} unchanged).")
+    if stale:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(_render, stale))
+
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+    return paths
+
+
+if __name__ == '__main__':
+    df_cluster = pd.read_csv(os.path.join(script_dir, 'best_models/final/df_mi_cluster_13.csv'))
+    all_cleaned_df = read_rows(os.path.join(script_dir, '../processed_data/all_data_v4-1-1_cleaned_sensor211.csv'))
+    all_cleaned_df = all_cleaned_df.drop("Unnamed: 0", axis=1)
+    for name, path in export_figures(df_cluster, all_cleaned_df).items():
+        print(f"{name}: {path}")
@@ -0,0 +1,287 @@
+"""
+Per-sample anomaly scoring of the raw ping times of each (sensor, range, delay) cell.
+
+Every sample is scored against the samples recorded just before it in the same cell:
+- 'dropout': no echo (NewPing returns a ping time of 0),
+- 'capped': the reading saturated at 65535 us,
+- 'robust_z': (ping time - median) / (1.4826 * MAD) of the last `window` valid samples of the
+  cell, NaN until `min_periods` valid samples were seen. The scale is floored at the 4 us
+  resolution of the ping times, so a run of identical readings does not make every later
+  deviation infinite,
+- 'outlier': |robust_z| > `z_threshold`,
+- 'burst': part of a run of at least `burst_length` consecutive anomalous samples (dropout,
+  capped or outlier).
+
+The score only depends on earlier samples, so `AnomalyScorer` (streaming, one row at a time,
+a bounded window per cell) and `score_samples` (batch, vectorized over chunks of rows) give the
+same results. `cell_anomaly_rates` summarizes the flags per cell, and `anomaly_features` turns
+them into per-sensor feature columns named like the model features ('13_3000_dropout_rate').
+
+Usage (from the repository root), to score a processed dataset one sensor at a time:
+    python anomaly_scoring.py data_v4.1.1
+"""
+import argparse
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from feature_spec import CELL_KEY_FACTOR
+
+NO_ECHO = 0
+CAPPED_PING_TIME = 65535
+PING_TIME_RESOLUTION_US = 4.0
+MAD_TO_STD = 1.4826
+
+CELL_COLUMNS = ['Sensor ID', 'Range (cm)', 'Delay (us)']
+RATE_STATISTICS = ('dropout_rate', 'capped_rate', 'outlier_rate', 'burst_rate')
+
+
+def _robust_z(values, windows, min_periods):
+    # Robust z-score of each value against its row of `windows` (NaN-padded, NaNs sort last)
+    windows = np.sort(windows, axis=1)
+    counts = np.count_nonzero(~np.isnan(windows), axis=1)
+    rows = np.arange(len(windows))
+    lower, upper = np.maximum(counts - 1, 0) // 2, counts // 2
+    median = (windows[rows, lower] + windows[rows, upper]) / 2
+    deviations = np.sort(np.abs(windows - median[:, None]), axis=1)
+    mad = (deviations[rows, lower] + deviations[rows, upper]) / 2
+    scale = np.maximum(MAD_TO_STD * mad, PING_TIME_RESOLUTION_US)
+    return np.where(counts >= min_periods, (values - median) / scale, np.nan)
+
+
+def _burst_flags(anomalous, group_codes, burst_length):
+    # Whether each sample is part of a run of `burst_length` anomalous samples in its cell
+    starts = np.ones(len(anomalous), dtype=bool)
+    starts[1:] = (anomalous[1:] != anomalous[:-1]) | (group_codes[1:] != group_codes[:-1])
+    run_ids = np.cumsum(starts) - 1
+    run_lengths = np.bincount(run_ids)
+    return anomalous & (run_lengths[run_ids] >= burst_length)
+
+
+def score_samples(df, window=25, min_periods=10, z_threshold=3.5, burst_length=3, chunk_size=65536):
+    """
+    Score every sample of a dataset in batch.
+
+    Samples are scored in their order in `df` within each cell (the recording order).
+
+    Parameters:
+    df (DataFrame): Rows with 'Sensor ID', 'Range (cm)', 'Delay (us)' and 'Ping Time (us)'.
+    window (int): Number of earlier valid samples of the cell a sample is compared with.
+    min_periods (int): Valid samples needed before samples of a cell are scored.
+    z_threshold (float): |robust z| above which a sample is an outlier.
+    burst_length (int): Length of a run of anomalous samples that counts as a burst.
+    chunk_size (int): Number of samples whose windows are gathered at once, to bound memory.
+
+    Returns:
+    DataFrame: Indexed like `df`, with 'robust_z', 'dropout', 'capped', 'outlier' and 'burst'.
+    """
+    cell_keys = (df['Sensor ID'].to_numpy(dtype=np.int64) * CELL_KEY_FACTOR + df['Range (cm)'].to_numpy(dtype=np.int64)) \
+        * CELL_KEY_FACTOR + df['Delay (us)'].to_numpy(dtype=np.int64)
+    group_codes_unsorted = pd.factorize(cell_keys)[0]
+    order = np.argsort(group_codes_unsorted, kind='stable')
+    group_codes = group_codes_unsorted[order]
+    ping_times = df['Ping Time (us)'].to_numpy(dtype=np.float64)[order]
+
+    dropout = ping_times == NO_ECHO
+    capped = ping_times >= CAPPED_PING_TIME
+    valid = ~(dropout | capped)
+
+    # Windows are drawn from the valid samples only, compacted so that the previous `window`
+    # valid samples of a cell are contiguous
+    valid_index = np.flatnonzero(valid)
+    valid_values = ping_times[valid_index]
+    valid_groups = group_codes[valid_index]
+    robust_z_valid = np.empty(len(valid_index))
+    offsets = np.arange(window, 0, -1)
+    for start in range(0, len(valid_index), chunk_size):
+        positions = np.arange(start, min(start + chunk_size, len(valid_index)))
+        sources = positions[:, None] - offsets[None, :]
+        same_cell = (sources >= 0) & (valid_groups[np.maximum(sources, 0)] == valid_groups[positions][:, None])
+        windows = np.where(same_cell, valid_values[np.maximum(sources, 0)], np.nan)
+        robust_z_valid[positions] = _robust_z(valid_values[positions], windows, min_periods)
+
+    robust_z = np.full(len(ping_times), np.nan)
+    robust_z[valid_index] = robust_z_valid
+    outlier = np.abs(robust_z) > z_threshold
+    burst = _burst_flags(dropout | capped | outlier, group_codes, burst_length)
+
+    # Back to the order of `df` by position, so duplicate index labels keep one row each
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+    return pd.DataFrame({'robust_z': robust_z.take(inverse), 'dropout': dropout.take(inverse),
+                         'capped': capped.take(inverse), 'outlier': outlier.take(inverse),
+                         'burst': burst.take(inverse)}, index=df.index)
+
+
+def cell_anomaly_rates(df, scores):
+    """
+    Share of dropout, capped, outlier and burst samples per (sensor, range, delay).
+
+    Parameters:
+    df (DataFrame): The scored rows.
+    scores (DataFrame): Output of `score_samples` for `df`.
+
+    Returns:
+    DataFrame: 'Sensor ID', 'Range (cm)', 'Delay (us)', 'samples' and the rates.
+    """
+    flags = scores[['dropout', 'capped', 'outlier', 'burst']].astype(float)
+    flags.columns = list(RATE_STATISTICS)
+    grouped = pd.concat([df[CELL_COLUMNS], flags], axis=1).groupby(CELL_COLUMNS)
+    rates = grouped.mean()
+    rates.insert(0, 'samples', grouped.size())
+    return rates.reset_index()
+
+
+def anomaly_features(rates, statistics=RATE_STATISTICS):
+    """
+    Per-sensor feature columns from the per-cell anomaly rates.
+
+    Parameters:
+    rates (DataFrame): Output of `cell_anomaly_rates` or `AnomalyScorer.cell_rates`.
+    statistics (tuple): Rates to turn into features.
+
+    Returns:
+    DataFrame: One row per sensor with '<range>_<delay>_<rate>' columns followed by 'Sensor ID'.
+    """
+    wide = rates.pivot(index='Sensor ID', columns=['Range (cm)', 'Delay (us)'], values=list(statistics))
+    wide.columns = [f"{range_cm}_{delay}_{statistic}" for statistic, range_cm, delay in wide.columns]
+    wide = wide.fillna(0)
+    wide['Sensor ID'] = wide.index
+    return wide.reset_index(drop=True)
+
+
+class _CellState:
+    __slots__ = ('window', 'run', 'pending', 'samples', 'dropout', 'capped', 'outlier', 'burst')
+
+    def __init__(self, window):
+        self.window = deque(maxlen=window)
+        self.run = 0  # length of the current run of anomalous samples
+        self.pending = 0  # anomalous samples of the current run not counted as burst yet
+        self.samples = self.dropout = self.capped = self.outlier = self.burst = 0
+
+
+class AnomalyScorer:
+    """
+    Streaming version of `score_samples`, fed with rows while they are recorded.
+
+    Only the last `window` valid ping times and a few counters are kept per cell.
+
+    Parameters:
+    window (int): Number of earlier valid samples of the cell a sample is compared with.
+    min_periods (int): Valid samples needed before samples of a cell are scored.
+    z_threshold (float): |robust z| above which a sample is an outlier.
+    burst_length (int): Length of a run of anomalous samples that counts as a burst.
+    """
+
+    def __init__(self, window=25, min_periods=10, z_threshold=3.5, burst_length=3):
+        self.window = window
+        self.min_periods = min_periods
+        self.z_threshold = z_threshold
+        self.burst_length = burst_length
+        self.cells = {}  # (sensor ID, range, delay) -> _CellState
+
+    def add(self, sensor_id, range_cm, delay, ping_time):
+        """
+        Score one sample.
+
+        Returns:
+        dict: 'robust_z', 'dropout', 'capped', 'outlier' and 'burst' of the sample. 'burst' is
+              set once the run reaches `burst_length`; the earlier samples of the run are counted
+              as burst samples in the cell rates at that point.
+        """
+        key = (int(sensor_id), int(range_cm), int(delay))
+        state = self.cells.get(key)
+        if state is None:
+            state = self.cells[key] = _CellState(self.window)
+        ping_time = float(ping_time)
+        dropout = ping_time == NO_ECHO
+        capped = ping_time >= CAPPED_PING_TIME
+
+        robust_z = np.nan
+        if not (dropout or capped):
+            if len(state.window) >= self.min_periods:
+                window = np.array(state.window)
+                median = np.median(window)
+                scale = max(MAD_TO_STD * np.median(np.abs(window - median)), PING_TIME_RESOLUTION_US)
+                robust_z = (ping_time - median) / scale
+            state.window.append(ping_time)
+        outlier = bool(abs(robust_z) > self.z_threshold)
+
+        state.samples += 1
+        state.dropout += dropout
+        state.capped += capped
+        state.outlier += outlier
+        burst = False
+        if dropout or capped or outlier:
+            state.run += 1
+            state.pending += 1
+            if state.run >= self.burst_length:
+                state.burst += state.pending
+                state.pending = 0
+                burst = True
+        else:
+            state.run = state.pending = 0
+        return {'robust_z': robust_z, 'dropout': dropout, 'capped': capped, 'outlier': outlier, 'burst': burst}
+
+    def add_row(self, row):
+        """Score a row as written by `record_data` (strings or numbers)."""
+        return self.add(row['Sensor ID'], float(row['Range (cm)']), float(row['Delay (us)']), row['Ping Time (us)'])
+
+    def cell_rates(self):
+        """
+        Per-cell rates of the samples seen so far, like `cell_anomaly_rates`.
+
+        Returns:
+        DataFrame: 'Sensor ID', 'Range (cm)', 'Delay (us)', 'samples' and the rates.
+        """
+        records = [
+            {'Sensor ID': sensor_id, 'Range (cm)': range_cm, 'Delay (us)': delay, 'samples': state.samples,
+             'dropout_rate': state.dropout / state.samples, 'capped_rate': state.capped / state.samples,
+             'outlier_rate': state.outlier / state.samples, 'burst_rate': state.burst / state.samples}
+            for (sensor_id, range_cm, delay), state in sorted(self.cells.items())
+        ]
+        return pd.DataFrame(records, columns=CELL_COLUMNS + ['samples', *RATE_STATISTICS])
+
+
+def score_store(store, versions=None, **scoring_args):
+    """
+    Per-cell anomaly rates of stored datasets, loading one sensor part at a time.
+
+    Parameters:
+    store (DatasetStore): The dataset store.
+    versions (list, optional): Versions to score. Defaults to all.
+    **scoring_args: Passed to `score_samples`.
+
+    Returns:
+    DataFrame: Output of `cell_anomaly_rates` with a 'Dataset Version' column.
+    """
+    from dataset_store import VERSION_COLUMN
+
+    frames = []
+    for version in versions or store.versions:
+        for sensor in store.manifests[version]['sensors']:
+            df = store.load(sensors=[sensor], versions=[version], columns=CELL_COLUMNS + ['Ping Time (us)'])
+            frames.append(cell_anomaly_rates(df, score_samples(df, **scoring_args)).assign(**{VERSION_COLUMN: version}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    from dataset_store import DatasetStore
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('versions', nargs='*', default=None)
+    parser.add_argument('--window', type=int, default=25)
+    parser.add_argument('--z-threshold', type=float, default=3.5)
+    args = parser.parse_args()
+
+    store = DatasetStore(args.versions or None)
+    rates = score_store(store, window=args.window, z_threshold=args.z_threshold)
+    per_sensor = rates.groupby(['Dataset Version', 'Sensor ID'])[list(RATE_STATISTICS)].mean()
+    print(per_sensor.describe().to_string())
+    print("\nSensors with the most anomalous samples:")
+    print(per_sensor.sum(axis=1).sort_values(ascending=False).head(10).to_string())
+
+
+if __name__ == '__main__':
+    main()
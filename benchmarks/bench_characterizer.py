@@ -0,0 +1,346 @@
+"""
+Benchmark the hot paths of the sensor characterization pipeline.
+
+Each stage runs in a forked child process so its wall time and peak RSS are measured in
+isolation. The child inherits the parent's peak RSS, so memory regressions are gated on the
+growth of the peak during the stage. Stages run on the real `data_v4.1.1` tree and on synthetic fleets drawn from the
+per-(range, delay) distributions observed in that tree. Fleets larger than `--chunk-rows` rows
+(the default 100k-sensor fleet has 375M) are generated and benchmarked in chunks of whole
+sensors: the wall times of a stage are summed over the chunks and its peak RSS (and growth) is
+the largest of any chunk. Results are appended to a JSON-lines file and compared against a stored baseline.
+
+Usage (from the repository root):
+    python benchmarks/bench_characterizer.py --fleets 1000 10000 --save-baseline
+    python benchmarks/bench_characterizer.py --fleets 1000 10000 --tolerance 0.25
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, os.path.join(repo_dir, 'Analysis', 'Delay_sequence_data'))
+
+from ultrasonic_characterizer import (get_all_files_in_directory, merge_csv_files, split_quartiles,
+                                      create_range_delay_feature, feature_engineering_quartile_means,
+                                      predict_KMeans)
+from clustering_helper import average_variability_metrics
+
+
+DATA_DIR = os.path.join(repo_dir, 'ultra_sonic_sensor', 'fully_automate', 'data_v4.1.1')
+RESULTS_FILE = os.path.join(repo_dir, 'benchmarks', 'results.jsonl')
+BASELINE_FILE = os.path.join(repo_dir, 'benchmarks', 'baseline.json')
+
+MODEL_RANGES = [13, 18, 23]
+MODEL_DELAYS = [16800, 10000, 8000, 6000, 3000]
+
+# Memory growth below this is allocator noise, not a regression
+RSS_SLACK_MB = 16
+
+
+def _rss_mb():
+    # Current resident set size of this process, in MB (Linux)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _run_stage(func, args, conn):
+    start_rss = _rss_mb()
+    start = time.perf_counter()
+    func(*args)
+    wall = time.perf_counter() - start
+    conn.send({'wall_s': wall, 'peak_rss_mb': _peak_rss_mb(), 'peak_rss_delta_mb': _peak_rss_mb() - start_rss})
+    conn.close()
+
+
+def measure(func, args, rows):
+    """
+    Run one stage in a forked child process and measure it.
+
+    Parameters:
+    func (callable): The stage to run.
+    args (tuple): Arguments passed to the stage; inherited by the child without pickling.
+    rows (int): Number of input rows, used for the throughput.
+
+    Returns:
+    dict: Wall time, peak RSS, peak RSS growth during the stage and rows/s.
+    """
+    context = mp.get_context('fork')
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=_run_stage, args=(func, args, child_conn))
+    process.start()
+    child_conn.close()
+    result = parent_conn.recv()
+    process.join()
+    result['rows'] = int(rows)
+    result['rows_per_s'] = rows / result['wall_s'] if result['wall_s'] > 0 else float('inf')
+    return result
+
+
+def observed_cell_distributions(df):
+    """
+    Summarize the real data per (range, delay) cell for the synthetic fleet generator.
+
+    Parameters:
+    df (DataFrame): Raw rows of the real tree.
+
+    Returns:
+    DataFrame: Per cell, the mean and spread of the per-sensor means, the typical within-sensor
+               spread and the rate of outlying samples.
+    """
+    per_sensor = df.groupby(['Range (cm)', 'Delay (us)', 'Sensor ID'])['Ping Time (us)'].agg(['mean', 'median', 'std'])
+    per_sensor['std'] = per_sensor['std'].fillna(0)
+
+    deviation = df['Ping Time (us)'] - df.groupby(['Range (cm)', 'Delay (us)', 'Sensor ID'])['Ping Time (us)'].transform('median')
+    df = df.assign(outlier=deviation.abs() > 100)
+
+    cells = per_sensor.groupby(['Range (cm)', 'Delay (us)']).agg(
+        sensor_mean=('median', 'mean'),
+        sensor_spread=('median', 'std'),
+        within_std=('std', 'median'),
+    )
+    cells['outlier_rate'] = df.groupby(['Range (cm)', 'Delay (us)'])['outlier'].mean()
+    return cells.fillna(0).reset_index()
+
+
+def synthetic_fleet(cells, n_sensors, samples_per_cell=250, random_state=42, first_sensor=1):
+    """
+    Generate raw rows for a synthetic fleet from the observed per-cell distributions.
+
+    Each sensor gets its own offset per cell, drawn from the spread of real sensor means.
+    Samples scatter around it with the typical within-sensor spread, and a cell-specific share
+    of samples are dropouts (0 us), as seen on defective sensors.
+
+    Parameters:
+    cells (DataFrame): Output of `observed_cell_distributions`.
+    n_sensors (int): Number of sensors in the fleet.
+    samples_per_cell (int): Samples per (sensor, range, delay) cell.
+    random_state (int or tuple): Random state for reproducibility.
+    first_sensor (int): Sensor ID of the first sensor.
+
+    Returns:
+    DataFrame: Raw rows with the columns used by the pipeline.
+    """
+    rng = np.random.default_rng(random_state)
+    n_cells = len(cells)
+    n_rows = n_sensors * n_cells * samples_per_cell
+
+    sensor_index = np.repeat(np.arange(n_sensors), n_cells * samples_per_cell)
+    cell_index = np.tile(np.repeat(np.arange(n_cells), samples_per_cell), n_sensors)
+
+    sensor_means = rng.normal(cells['sensor_mean'].to_numpy(), cells['sensor_spread'].to_numpy(), size=(n_sensors, n_cells))
+    ping_time = rng.normal(sensor_means[sensor_index, cell_index], cells['within_std'].to_numpy()[cell_index])
+    dropout = rng.random(n_rows) < cells['outlier_rate'].to_numpy()[cell_index]
+    ping_time = np.where(dropout, 0, np.clip(np.rint(ping_time), 0, None)).astype(np.int64)
+
+    return pd.DataFrame({
+        'Trial': np.tile(np.arange(samples_per_cell), n_sensors * n_cells),
+        'Ping Time (us)': ping_time,
+        'Delay (us)': cells['Delay (us)'].to_numpy()[cell_index],
+        'Sensor ID': sensor_index + first_sensor,
+        'Range (cm)': cells['Range (cm)'].to_numpy()[cell_index],
+    })
+
+
+def _filter_model_cells(df):
+    return df[df['Range (cm)'].isin(MODEL_RANGES) & df['Delay (us)'].isin(MODEL_DELAYS)]
+
+
+def benchmark_dataset(name, df, file_paths=None, verbose=True):
+    """
+    Benchmark every stage of the pipeline on one dataset.
+
+    Parameters:
+    name (str): Dataset name used in the results.
+    df (DataFrame): Raw rows of the dataset.
+    file_paths (list of str, optional): Source CSV files; `merge_csv_files` is only measured when given.
+    verbose (bool): Whether to print the dataset and its measurements.
+
+    Returns:
+    dict: Stage name mapped to its measurements.
+    """
+    results = {}
+    rows = len(df)
+    if verbose:
+        print(f"\n== {name}: {df['Sensor ID'].nunique()} sensors, {rows} rows")
+
+    if file_paths is not None:
+        results['merge_csv_files'] = measure(merge_csv_files, (file_paths,), rows)
+
+    # Inputs of the later stages are prepared here and inherited by the forked children
+    df_model = _filter_model_cells(df)
+    df_middle_quartile, _, _ = split_quartiles(df_model)
+    df_features = feature_engineering_quartile_means(df)
+    df_cluster = predict_KMeans(df_features)
+
+    results['split_quartiles'] = measure(split_quartiles, (df_model,), len(df_model))
+    results['create_range_delay_feature'] = measure(create_range_delay_feature, (df_middle_quartile, 'middle'), len(df_middle_quartile))
+    results['feature_engineering_quartile_means'] = measure(feature_engineering_quartile_means, (df,), rows)
+    results['predict_KMeans'] = measure(predict_KMeans, (df_features,), len(df_features))
+    results['average_variability_metrics'] = measure(average_variability_metrics, (df_cluster, df), rows)
+
+    if verbose:
+        _print_results(results)
+    return results
+
+
+def _print_results(results):
+    for stage, result in results.items():
+        print(f"{stage:<36} {result['wall_s']:>9.3f} s {result['peak_rss_mb']:>9.1f} MB "
+              f"{result['peak_rss_delta_mb']:>+9.1f} MB {result['rows_per_s']:>14.0f} rows/s")
+
+
+def benchmark_fleet(name, cells, n_sensors, samples_per_cell=250, chunk_rows=50_000_000):
+    """
+    Benchmark every stage of the pipeline on a synthetic fleet, in chunks of whole sensors
+    when the fleet has more than `chunk_rows` rows.
+
+    Parameters:
+    name (str): Dataset name used in the results.
+    cells (DataFrame): Output of `observed_cell_distributions`.
+    n_sensors (int): Number of sensors in the fleet.
+    samples_per_cell (int): Samples per (sensor, range, delay) cell.
+    chunk_rows (int): Largest number of rows generated and held at once.
+
+    Returns:
+    dict: Stage name mapped to its measurements: wall times and rows summed over the chunks,
+          peak RSS the largest of any chunk, and the number of 'chunks'.
+    """
+    rows_per_sensor = len(cells) * samples_per_cell
+    if n_sensors * rows_per_sensor <= chunk_rows:
+        return benchmark_dataset(name, synthetic_fleet(cells, n_sensors, samples_per_cell))
+
+    chunk_sensors = max(chunk_rows // rows_per_sensor, 1)
+    n_chunks = -(-n_sensors // chunk_sensors)
+    print(f"\n== {name}: {n_sensors} sensors, {n_sensors * rows_per_sensor} rows in {n_chunks} chunks of {chunk_sensors} sensors")
+    results = {}
+    for chunk, first in enumerate(range(0, n_sensors, chunk_sensors)):
+        df_chunk = synthetic_fleet(cells, min(chunk_sensors, n_sensors - first), samples_per_cell,
+                                   random_state=(42, chunk), first_sensor=first + 1)
+        for stage, result in benchmark_dataset(f"{name}[{chunk}]", df_chunk, verbose=False).items():
+            total = results.setdefault(stage, {'wall_s': 0.0, 'peak_rss_mb': 0.0, 'peak_rss_delta_mb': 0.0, 'rows': 0, 'chunks': 0})
+            total['wall_s'] += result['wall_s']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], result['peak_rss_mb'])
+            total['peak_rss_delta_mb'] = max(total['peak_rss_delta_mb'], result['peak_rss_delta_mb'])
+            total['rows'] += result['rows']
+            total['chunks'] += 1
+        del df_chunk
+    for result in results.values():
+        result['rows_per_s'] = result['rows'] / result['wall_s'] if result['wall_s'] > 0 else float('inf')
+    _print_results(results)
+    return results
+
+
+def compare_with_baseline(run, baseline, tolerance=0.25):
+    """
+    Compare a run against a stored baseline. Memory is compared on 'peak_rss_delta_mb', the
+    growth of the peak RSS during the stage, as the absolute peak of a forked child includes
+    whatever its parent had allocated. Growth within `RSS_SLACK_MB` of the baseline is ignored.
+
+    Parameters:
+    run (dict): Dataset name mapped to stage results.
+    baseline (dict): Same layout as `run`.
+    tolerance (float): Allowed relative slowdown or memory growth before a stage counts as regressed.
+
+    Returns:
+    list: Human-readable descriptions of the regressions found.
+    """
+    regressions = []
+    for dataset, stages in run.items():
+        for stage, result in stages.items():
+            reference = baseline.get(dataset, {}).get(stage)
+            if reference is None:
+                continue
+            for metric, slack in [('wall_s', 0.0), ('peak_rss_delta_mb', RSS_SLACK_MB)]:
+                # Baselines saved before a metric was recorded are not compared on it
+                if metric not in reference:
+                    continue
+                if result[metric] > reference[metric] * (1 + tolerance) + slack:
+                    regressions.append(f"{dataset}/{stage}: {metric} {result[metric]:.3f} vs baseline {reference[metric]:.3f}")
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-dir', default=DATA_DIR, help="Real data tree to benchmark.")
+    parser.add_argument('--fleets', type=int, nargs='*', default=[1000, 10000, 100000], help="Synthetic fleet sizes.")
+    parser.add_argument('--samples-per-cell', type=int, default=250, help="Samples per (sensor, range, delay) in synthetic fleets.")
+    parser.add_argument('--all-cells', action='store_true', help="Generate every observed cell instead of only the model's 15.")
+    parser.add_argument('--chunk-rows', type=int, default=50_000_000,
+                        help="Benchmark synthetic fleets larger than this many rows in chunks of whole sensors.")
+    parser.add_argument('--output', default=RESULTS_FILE, help="JSON-lines file the results are appended to.")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="Baseline to compare against.")
+    parser.add_argument('--save-baseline', action='store_true', help="Store this run as the new baseline.")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative regression.")
+    args = parser.parse_args()
+
+    run = {}
+    file_paths = get_all_files_in_directory(args.data_dir)
+    df_real = merge_csv_files(file_paths)
+    run['data_v4.1.1'] = benchmark_dataset('data_v4.1.1', df_real, file_paths)
+
+    cells = observed_cell_distributions(df_real if args.all_cells else _filter_model_cells(df_real))
+    for n_sensors in args.fleets:
+        run[f'synthetic_{n_sensors}'] = benchmark_fleet(f'synthetic_{n_sensors}', cells, n_sensors, args.samples_per_cell,
+                                                        args.chunk_rows)
+
+    record = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': run,
+    }
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    print(f"\nResults appended to {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against; run with --save-baseline first.")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(run, baseline, args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"\nNo regressions beyond {args.tolerance:.0%} against {args.baseline}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""
+Build the processed datasets (`Analysis/processed_data/all_data_<version>_cleaned_sensor<max id>.csv`)
+from the raw delay sequence recordings in `ultra_sonic_sensor/fully_automate/data_v*`.
+
+Steps, following `US_delay_sequence_feature_engineering.ipynb`:
+1. Per sensor, keep only the latest recording of each range (by the timestamp in the file name).
+2. Lower-case 'Color of sensor' and keep the delays used by the model.
+3. Fill missing categorical values with the column's mode over the whole dataset.
+
+Sensors are processed in parallel and each one is stored as a part next to the artifact. A
+manifest records the source files (size and modification time) behind every part, so a
+rebuild only reprocesses the sensors whose files changed. It also keeps ping time statistics
+per sensor, range and delay, which `dataset_store.py` uses to compare dataset versions.
+
+Usage (from the repository root):
+    python build_processed_dataset.py
+    python build_processed_dataset.py data_v4.1.2 --force
+"""
+import os
+import re
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from row_dtypes import compact_dtypes
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+RAW_DIR = os.path.join(script_dir, 'ultra_sonic_sensor', 'fully_automate')
+PROCESSED_DIR = os.path.join(script_dir, 'Analysis', 'processed_data')
+
+# Bump when the cleaning steps change so every part is rebuilt
+BUILD_VERSION = 3
+
+DELAYS = [16800, 10000, 8000, 6000, 3000]
+
+# e.g. test_delay_seq_ard1_sensor47_range33_16_13_00_09072024.csv
+FILE_PATTERN = re.compile(r'sensor(?P<sensor>\d+)_range(?P<range>\d+)_(?P<H>\d{2})_(?P<M>\d{2})_(?P<S>\d{2})_(?P<d>\d{2})(?P<m>\d{2})(?P<Y>\d{4})\.csv$')
+
+
+def version_tag(version):
+    """'data_v4.1.1' -> 'v4-1-1', as used in the processed file names."""
+    return version.replace('data_', '').replace('.', '-')
+
+
+def list_recordings(version_dir):
+    """
+    Find the delay sequence recordings of a dataset version.
+
+    Parameters:
+    version_dir (str): Folder of the version, e.g. `.../data_v4.1.1`.
+
+    Returns:
+    DataFrame: One row per file with 'path', 'sensor', 'range' and 'recorded_at'.
+    """
+    records = []
+    for root, dirs, files in os.walk(version_dir):
+        for file in files:
+            match = FILE_PATTERN.search(file)
+            if match is None:
+                continue
+            records.append({
+                'path': os.path.join(root, file),
+                'sensor': int(match['sensor']),
+                'range': int(match['range']),
+                'recorded_at': pd.Timestamp(int(match['Y']), int(match['m']), int(match['d']),
+                                            int(match['H']), int(match['M']), int(match['S'])),
+            })
+    return pd.DataFrame(records, columns=['path', 'sensor', 'range', 'recorded_at'])
+
+
+def dedupe_recordings(recordings):
+    """
+    Keep the latest recording of every (sensor, range).
+
+    Parameters:
+    recordings (DataFrame): Output of `list_recordings`.
+
+    Returns:
+    tuple: (kept, skipped) DataFrames.
+    """
+    recordings = recordings.sort_values(['sensor', 'range', 'recorded_at', 'path'])
+    latest = ~recordings.duplicated(['sensor', 'range'], keep='last')
+    return recordings[latest], recordings[~latest]
+
+
+def file_signature(paths):
+    """Name, size and modification time of each file, used to detect changed inputs."""
+    return [{'name': os.path.basename(path), 'size': os.path.getsize(path), 'mtime_ns': os.stat(path).st_mtime_ns}
+            for path in sorted(paths)]
+
+
+def clean_sensor(job):
+    """
+    Read and clean the recordings of one sensor and store them as a part.
+
+    Parameters:
+    job (tuple): (paths, part_path, delays).
+
+    Returns:
+    tuple: (rows, stats) with the number of rows in the part and its ping time count, mean,
+           std and median per range and delay (list of dicts).
+    """
+    paths, part_path, delays = job
+    df = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+    df["Color of sensor"] = df["Color of sensor"].str.lower()
+    df = compact_dtypes(df[df["Delay (us)"].isin(delays)])
+    df.to_pickle(part_path)
+    stats = df.groupby(['Range (cm)', 'Delay (us)'])['Ping Time (us)'].agg(['count', 'mean', 'std', 'median']).reset_index()
+    # Plain Python values, and None instead of NaN, so the stats are valid JSON
+    stats = stats.astype(object).where(stats.notna(), None)
+    return len(df), stats.to_dict('records')
+
+
+def fill_categorical_nans(df):
+    # Replace NaNs of categorical columns with the most frequent value, as in the notebook
+    for col in df.columns[df.isnull().any()]:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = df[col].fillna(df[col].mode()[0])
+    return df
+
+
+def build_processed_dataset(version='data_v4.1.1', raw_dir=RAW_DIR, output_dir=PROCESSED_DIR, delays=DELAYS,
+                            n_jobs=None, force=False):
+    """
+    Build (or incrementally rebuild) the processed dataset of one version.
+
+    Parameters:
+    version (str): Folder name of the dataset version inside `raw_dir`.
+    raw_dir (str): Folder containing the dataset versions.
+    output_dir (str): Folder of the processed artifact, its manifest and its parts.
+    delays (list): Delays kept in the processed dataset.
+    n_jobs (int, optional): Number of worker processes. Defaults to the number of CPUs.
+    force (bool): Whether to reprocess every sensor regardless of the manifest.
+
+    Returns:
+    dict: The manifest of the build.
+    """
+    tag = version_tag(version)
+    parts_dir = os.path.join(output_dir, 'parts', tag)
+    os.makedirs(parts_dir, exist_ok=True)
+    manifest_file = os.path.join(output_dir, f"all_data_{tag}_cleaned.manifest.json")
+    previous = {}
+    if os.path.exists(manifest_file) and not force:
+        with open(manifest_file) as f:
+            previous = json.load(f)
+
+    kept, skipped = dedupe_recordings(list_recordings(os.path.join(raw_dir, version)))
+    if kept.empty:
+        raise ValueError(f"No recordings found in {os.path.join(raw_dir, version)}")
+    settings = {'build_version': BUILD_VERSION, 'delays': delays, 'pandas': pd.__version__}
+    same_settings = all(previous.get(key) == value for key, value in settings.items())
+
+    sensors, jobs = {}, []
+    for sensor, group in kept.groupby('sensor'):
+        part_path = os.path.join(parts_dir, f"sensor{sensor}.pkl")
+        entry = {
+            'files': file_signature(group['path']),
+            'skipped': sorted(os.path.basename(path) for path in skipped.loc[skipped['sensor'] == sensor, 'path']),
+            'part': os.path.relpath(part_path, output_dir),
+        }
+        old = previous.get('sensors', {}).get(str(sensor))
+        if same_settings and old is not None and old['files'] == entry['files'] and os.path.exists(part_path):
+            entry['rows'] = old['rows']
+            entry['stats'] = old['stats']
+        else:
+            jobs.append((sensor, (list(group['path']), part_path, delays)))
+        sensors[str(sensor)] = entry
+
+    print(f"{version}: processing {len(jobs)} of {len(sensors)} sensors ({len(sensors) - len(jobs)} unchanged), "
+          f"{len(skipped)} superseded recordings skipped.")
+    if jobs:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            for (sensor, _), (rows, stats) in zip(jobs, executor.map(clean_sensor, [job for _, job in jobs])):
+                sensors[str(sensor)]['rows'] = rows
+                sensors[str(sensor)]['stats'] = stats
+
+    # Parts of sensors that no longer have recordings
+    for sensor in set(previous.get('sensors', {})) - set(sensors):
+        stale_part = os.path.join(output_dir, previous['sensors'][sensor]['part'])
+        if os.path.exists(stale_part):
+            os.remove(stale_part)
+
+    output_name = f"all_data_{tag}_cleaned_sensor{max(int(sensor) for sensor in sensors)}.csv"
+    output_path = os.path.join(output_dir, output_name)
+    if jobs or previous.get('sensors', {}).keys() != sensors.keys() or not os.path.exists(output_path):
+        ordered = sorted(sensors, key=int)
+        df = pd.concat([pd.read_pickle(os.path.join(output_dir, sensors[sensor]['part'])) for sensor in ordered],
+                       ignore_index=True)
+        # Parts with different categories concatenate to plain strings
+        df = fill_categorical_nans(compact_dtypes(df, validate=False))
+        tmp_path = output_path + '.tmp'
+        # Written with the index, like the file the analysis notebooks load
+        df.to_csv(tmp_path)
+        os.replace(tmp_path, output_path)
+        if previous.get('output') not in (None, output_name) and os.path.exists(os.path.join(output_dir, previous['output'])):
+            os.remove(os.path.join(output_dir, previous['output']))
+
+    digest = hashlib.sha256()
+    with open(output_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(chunk)
+
+    manifest = dict(settings, version=version, output=output_name, sha256=digest.hexdigest(),
+                    rows=sum(entry['rows'] for entry in sensors.values()), sensors=sensors)
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('versions', nargs='*', default=['data_v4.1.1', 'data_v4.1.2'])
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='Reprocess every sensor')
+    args = parser.parse_args()
+
+    for version in args.versions:
+        manifest = build_processed_dataset(version, n_jobs=args.jobs, force=args.force)
+        print(f"{version}: {manifest['rows']} rows from {len(manifest['sensors'])} sensors -> {manifest['output']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+One store over several dataset versions (data collection campaigns).
+
+The store is made of the per-sensor parts and manifests written by `build_processed_dataset.py`.
+The manifests act as the index: which sensors each version holds, their source files, and
+ping time statistics per range and delay. Per-version statistics and cross-version comparisons
+(the same sensor recollected in another campaign) are answered from the index alone. Rows are
+only read for the sensors and versions asked for, each part once, and `query` also skips the
+parts whose statistics or recording dates cannot match its predicates.
+
+Usage (from the repository root):
+    python dataset_store.py                       # ingest all versions, print statistics and overlap
+    python dataset_store.py --compare data_v4.1.1 data_v4.1.2
+"""
+import os
+import json
+import argparse
+
+import pandas as pd
+
+from build_processed_dataset import (BUILD_VERSION, FILE_PATTERN, RAW_DIR, PROCESSED_DIR, build_processed_dataset,
+                                     version_tag)
+from row_dtypes import compact_dtypes
+
+VERSION_COLUMN = 'Dataset Version'
+
+
+def available_versions(raw_dir=RAW_DIR):
+    """List the dataset version folders (`data_v*`) found in `raw_dir`."""
+    return sorted(name for name in os.listdir(raw_dir)
+                  if name.startswith('data_v') and os.path.isdir(os.path.join(raw_dir, name)))
+
+
+class DatasetStore:
+    """
+    Index over the processed parts of several dataset versions.
+
+    Parameters:
+    versions (list, optional): Dataset versions to include. Defaults to every `data_v*` folder.
+    processed_dir (str): Folder of the manifests and parts.
+    ingest (bool): Whether to (incrementally) build the versions first. Without it, versions
+                   without a manifest are skipped, and versions processed with another
+                   `BUILD_VERSION` are rebuilt.
+    """
+
+    def __init__(self, versions=None, processed_dir=PROCESSED_DIR, ingest=False):
+        self.processed_dir = processed_dir
+        self.manifests = {}
+        for version in versions or available_versions():
+            if ingest:
+                self.manifests[version] = build_processed_dataset(version, output_dir=processed_dir)
+                continue
+            manifest_file = os.path.join(processed_dir, f"all_data_{version_tag(version)}_cleaned.manifest.json")
+            if os.path.exists(manifest_file):
+                with open(manifest_file) as f:
+                    manifest = json.load(f)
+                if manifest.get('build_version') != BUILD_VERSION:
+                    # Parts of an older cleaning: rebuild them, as the builder does when its settings change
+                    print(f"{version}: processed with build version {manifest.get('build_version')}, rebuilding with {BUILD_VERSION}.")
+                    manifest = build_processed_dataset(version, output_dir=processed_dir, delays=manifest['delays'])
+                self.manifests[version] = manifest
+
+    @property
+    def versions(self):
+        return list(self.manifests)
+
+    def sensor_index(self):
+        """
+        Which sensors each version holds.
+
+        Returns:
+        DataFrame: One row per (version, sensor) with 'rows', 'files' and 'recollected'
+                   (whether the sensor is in more than one version).
+        """
+        index = pd.DataFrame([
+            {VERSION_COLUMN: version, 'Sensor ID': int(sensor), 'rows': entry['rows'], 'files': len(entry['files'])}
+            for version, manifest in self.manifests.items()
+            for sensor, entry in manifest['sensors'].items()
+        ], columns=[VERSION_COLUMN, 'Sensor ID', 'rows', 'files'])
+        index['recollected'] = index.groupby('Sensor ID')[VERSION_COLUMN].transform('size') > 1
+        return index
+
+    def versions_of_sensor(self, sensor_id):
+        """List the versions that hold `sensor_id`."""
+        return [version for version, manifest in self.manifests.items() if str(sensor_id) in manifest['sensors']]
+
+    def cell_statistics(self, sensors=None, versions=None):
+        """
+        Ping time statistics per version, sensor, range and delay, from the index.
+
+        Parameters:
+        sensors (list, optional): Sensor IDs to include. Defaults to all.
+        versions (list, optional): Versions to include. Defaults to all.
+
+        Returns:
+        DataFrame: 'Dataset Version', 'Sensor ID', 'Range (cm)', 'Delay (us)', 'count', 'mean', 'std', 'median'.
+        """
+        wanted = None if sensors is None else {str(sensor) for sensor in sensors}
+        records = [
+            dict(stat, **{VERSION_COLUMN: version, 'Sensor ID': int(sensor)})
+            for version in versions or self.versions
+            for sensor, entry in self.manifests[version]['sensors'].items()
+            if wanted is None or sensor in wanted
+            for stat in entry['stats']
+        ]
+        columns = [VERSION_COLUMN, 'Sensor ID', 'Range (cm)', 'Delay (us)', 'count', 'mean', 'std', 'median']
+        return pd.DataFrame(records, columns=columns)
+
+    def version_statistics(self):
+        """
+        Summary of each version: sensors, rows, and the spread of the per-cell mean ping times.
+
+        Returns:
+        DataFrame: One row per version.
+        """
+        stats = self.cell_statistics()
+        index = self.sensor_index()
+        summary = stats.groupby(VERSION_COLUMN).agg(cells=('mean', 'size'), mean_ping_time=('mean', 'mean'),
+                                                    median_cell_std=('std', 'median'))
+        summary['sensors'] = index.groupby(VERSION_COLUMN)['Sensor ID'].nunique()
+        summary['rows'] = index.groupby(VERSION_COLUMN)['rows'].sum()
+        summary['recollected_sensors'] = index[index['recollected']].groupby(VERSION_COLUMN)['Sensor ID'].nunique()
+        return summary.fillna({'recollected_sensors': 0}).reset_index()
+
+    def compare_versions(self, base, other, sensors=None):
+        """
+        Compare the sensors recollected in two versions, cell by cell, from the index.
+
+        Parameters:
+        base (str): Reference version.
+        other (str): Version compared with `base`.
+        sensors (list, optional): Sensor IDs to compare. Defaults to every sensor in both versions.
+
+        Returns:
+        DataFrame: One row per shared (sensor, range, delay) with both means and standard deviations,
+                   'mean_diff' (other - base) and 'z' (the difference in standard errors).
+        """
+        stats = self.cell_statistics(sensors, [base, other])
+        keys = ['Sensor ID', 'Range (cm)', 'Delay (us)']
+        merged = stats[stats[VERSION_COLUMN] == base].drop(columns=VERSION_COLUMN).merge(
+            stats[stats[VERSION_COLUMN] == other].drop(columns=VERSION_COLUMN), on=keys, suffixes=('_base', '_other'))
+        merged['mean_diff'] = merged['mean_other'] - merged['mean_base']
+        standard_error = (merged['std_base'] ** 2 / merged['count_base'] + merged['std_other'] ** 2 / merged['count_other']) ** 0.5
+        merged['z'] = merged['mean_diff'] / standard_error
+        return merged
+
+    def load(self, sensors=None, versions=None, columns=None):
+        """
+        Load the cleaned rows of some sensors and versions, with the version as a column.
+
+        Parameters:
+        sensors (list, optional): Sensor IDs to load. Defaults to all.
+        versions (list, optional): Versions to load. Defaults to all.
+        columns (list, optional): Columns to keep. Defaults to all.
+
+        Returns:
+        DataFrame: The rows of the requested parts and a categorical 'Dataset Version' column.
+        """
+        versions = versions or self.versions
+        wanted = None if sensors is None else {str(sensor) for sensor in sensors}
+        frames = []
+        for version in versions:
+            for sensor, entry in self.manifests[version]['sensors'].items():
+                if wanted is not None and sensor not in wanted:
+                    continue
+                df = pd.read_pickle(os.path.join(self.processed_dir, entry['part']))
+                if columns is not None:
+                    df = df[columns]
+                frames.append(df.assign(**{VERSION_COLUMN: version}))
+        if not frames:
+            return pd.DataFrame(columns=(columns or []) + [VERSION_COLUMN])
+        # Parts with different categories concatenate to plain strings
+        df = compact_dtypes(pd.concat(frames, ignore_index=True), validate=False)
+        df[VERSION_COLUMN] = pd.Categorical(df[VERSION_COLUMN], categories=versions)
+        return df
+
+    def query(self, sensors=None, ranges=None, delays=None, versions=None, recorded_after=None,
+              recorded_before=None, columns=None):
+        """
+        Rows matching predicates on sensor, range, delay, version and recording date.
+
+        The predicates are first checked against the manifests: a part is only read if its
+        sensor and version match, its per-cell statistics contain one of the requested
+        (range, delay) cells, and one of its recordings falls within the dates. Only the
+        matching rows and requested columns of the parts read are kept.
+
+        Parameters:
+        sensors (list, optional): Sensor IDs. Defaults to all.
+        ranges (list, optional): Ranges in cm. Defaults to all.
+        delays (list, optional): Delays in us. Defaults to all.
+        versions (list, optional): Versions. Defaults to all.
+        recorded_after (str or Timestamp, optional): Keep recordings made at or after this time.
+        recorded_before (str or Timestamp, optional): Keep recordings made before this time.
+        columns (list, optional): Columns to return. Defaults to all.
+
+        Returns:
+        DataFrame: The matching rows and a categorical 'Dataset Version' column.
+        """
+        versions = versions or self.versions
+        wanted_sensors = None if sensors is None else {str(sensor) for sensor in sensors}
+        wanted_ranges = None if ranges is None else {int(range_cm) for range_cm in ranges}
+        wanted_delays = None if delays is None else {int(delay) for delay in delays}
+        dated = recorded_after is not None or recorded_before is not None
+
+        frames = []
+        for version in versions:
+            for sensor, entry in self.manifests[version]['sensors'].items():
+                if wanted_sensors is not None and sensor not in wanted_sensors:
+                    continue
+                part_ranges = _recorded_ranges(entry, recorded_after, recorded_before) if dated else None
+                if part_ranges is not None and wanted_ranges is not None:
+                    part_ranges &= wanted_ranges
+                elif part_ranges is None:
+                    part_ranges = wanted_ranges
+                cells = [(int(stat['Range (cm)']), int(stat['Delay (us)'])) for stat in entry['stats']]
+                if not any((part_ranges is None or range_cm in part_ranges) and
+                           (wanted_delays is None or delay in wanted_delays) for range_cm, delay in cells):
+                    continue
+
+                df = pd.read_pickle(os.path.join(self.processed_dir, entry['part']))
+                mask = pd.Series(True, index=df.index)
+                if part_ranges is not None:
+                    mask &= df['Range (cm)'].isin(part_ranges)
+                if wanted_delays is not None:
+                    mask &= df['Delay (us)'].isin(wanted_delays)
+                df = df[mask] if columns is None else df.loc[mask, columns]
+                frames.append(df.assign(**{VERSION_COLUMN: version}))
+        if not frames:
+            return pd.DataFrame(columns=(columns or []) + [VERSION_COLUMN])
+        # Parts with different categories concatenate to plain strings
+        df = compact_dtypes(pd.concat(frames, ignore_index=True), validate=False)
+        df[VERSION_COLUMN] = pd.Categorical(df[VERSION_COLUMN], categories=versions)
+        return df
+
+
+def _recorded_ranges(entry, recorded_after=None, recorded_before=None):
+    # Ranges of a manifest entry whose recording falls within the dates (one file per range after deduplication)
+    ranges = set()
+    for file in entry['files']:
+        match = FILE_PATTERN.search(file['name'])
+        recorded_at = pd.Timestamp(int(match['Y']), int(match['m']), int(match['d']),
+                                   int(match['H']), int(match['M']), int(match['S']))
+        if (recorded_after is None or recorded_at >= pd.Timestamp(recorded_after)) and \
+                (recorded_before is None or recorded_at < pd.Timestamp(recorded_before)):
+            ranges.add(int(match['range']))
+    return ranges
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('versions', nargs='*', default=None)
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'OTHER'), help='Compare the sensors recollected in two versions')
+    args = parser.parse_args()
+
+    store = DatasetStore(args.versions or None, ingest=True)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(store.version_statistics().to_string(index=False))
+        if args.compare:
+            comparison = store.compare_versions(*args.compare)
+            per_sensor = comparison.groupby('Sensor ID').agg(cells=('z', 'size'), mean_abs_diff=('mean_diff', lambda d: d.abs().mean()),
+                                                             max_abs_z=('z', lambda z: z.abs().max()))
+            print(per_sensor.to_string())
+
+
+if __name__ == '__main__':
+    main()
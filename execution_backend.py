@@ -0,0 +1,220 @@
+"""
+Execution backends for the per-sensor group-bys of the characterization pipeline.
+
+`split_quartiles` and `create_range_delay_feature` group on ('Sensor ID', 'Delay (us)',
+'Range (cm)') and `average_variability_metrics` on clusters of sensors, so their work splits
+into independent partitions of whole sensors. A backend runs a function over such partitions:
+
+- `SerialBackend` runs them one after the other in this process;
+- `ProcessBackend` runs them in a local pool of worker processes (no cluster or scheduler).
+
+The data can be a DataFrame, a `RowIndex`, or a `DatasetStore`. With a store, each partition
+is only a list of sensors: the worker reads their parts itself, so no process ever holds the
+whole fleet (out of core). Partitions are sorted by sensor, rows keep their order within a
+sensor, and the results are combined in partition order, so every backend returns what the
+single-frame computation returns.
+
+Example:
+    backend = get_backend('processes', n_jobs=8)
+    df_middle, df_lower, df_upper = split_quartiles(DatasetStore(['data_v4.1.1']), backend=backend)
+    df_features = create_range_delay_feature(df_middle, 'middle', backend=backend)
+
+Usage (from the repository root):
+    python execution_backend.py --backend processes --jobs 8
+"""
+import os
+import time
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from raw_query import RowIndex
+from dataset_store import DatasetStore
+
+# Partitions per worker, so a slow partition does not leave the other workers idle
+PARTITIONS_PER_JOB = 4
+
+
+class SerialBackend:
+    """Run the partitions one after the other in this process."""
+
+    n_jobs = 1
+
+    def map(self, func, partitions):
+        return [func(partition) for partition in partitions]
+
+
+class ProcessBackend:
+    """
+    Run the partitions in a local pool of worker processes.
+
+    Parameters:
+    n_jobs (int, optional): Number of worker processes. Defaults to the number of CPUs.
+    """
+
+    def __init__(self, n_jobs=None):
+        self.n_jobs = n_jobs or os.cpu_count()
+
+    def map(self, func, partitions):
+        partitions = list(partitions)
+        if self.n_jobs == 1 or len(partitions) <= 1:
+            return SerialBackend().map(func, partitions)
+        with ProcessPoolExecutor(max_workers=min(self.n_jobs, len(partitions))) as executor:
+            return list(executor.map(func, partitions))
+
+
+BACKENDS = {'serial': SerialBackend, 'processes': ProcessBackend}
+
+
+def get_backend(backend=None, n_jobs=None):
+    """
+    Resolve a backend.
+
+    Parameters:
+    backend (str or backend, optional): 'serial', 'processes', or an object with a
+                                        `map(func, partitions)` method. Defaults to 'serial'.
+    n_jobs (int, optional): Number of worker processes of 'processes'.
+
+    Returns:
+    The backend.
+    """
+    if backend is None:
+        return SerialBackend()
+    if not isinstance(backend, str):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {sorted(BACKENDS)}")
+    return ProcessBackend(n_jobs) if backend == 'processes' else SerialBackend()
+
+
+class StorePartition:
+    """
+    Sensors of a `DatasetStore` whose rows are read by the worker that processes them.
+
+    Parameters:
+    store (DatasetStore): The store.
+    sensors (list): Sensor IDs of the partition.
+    versions (list, optional): Versions to read. Defaults to all.
+    columns (list, optional): Columns to read. Defaults to all.
+    """
+
+    def __init__(self, store, sensors, versions=None, columns=None):
+        self.store = store
+        self.sensors = [int(sensor) for sensor in sensors]
+        self.versions = versions
+        self.columns = columns
+
+    def load(self):
+        return self.store.load(self.sensors, self.versions, self.columns)
+
+
+def sensor_ids(source, versions=None):
+    """Sorted sensor IDs of a DataFrame, `RowIndex` or `DatasetStore`."""
+    if isinstance(source, DatasetStore):
+        index = source.sensor_index()
+        if versions is not None:
+            index = index[index['Dataset Version'].isin(versions)]
+        return np.unique(index['Sensor ID'].to_numpy())
+    if isinstance(source, RowIndex):
+        return source.distinct['Sensor ID']
+    return np.unique(source['Sensor ID'].to_numpy())
+
+
+def range_delay_cells(source, versions=None):
+    """Sorted distinct (range, delay) pairs of a DataFrame, `RowIndex` or `DatasetStore`."""
+    if isinstance(source, DatasetStore):
+        cells = source.cell_statistics(versions=versions)[['Range (cm)', 'Delay (us)']]
+    elif isinstance(source, RowIndex):
+        cells = pd.DataFrame({column: source.columns[column] for column in ('Range (cm)', 'Delay (us)')})
+    else:
+        cells = source[['Range (cm)', 'Delay (us)']]
+    cells = cells.drop_duplicates().sort_values(['Range (cm)', 'Delay (us)'])
+    return [(int(range_cm), int(delay)) for range_cm, delay in cells.itertuples(index=False, name=None)]
+
+
+def partition(source, groups, versions=None, columns=None):
+    """
+    Split the rows of some groups of sensors into one partition per group.
+
+    Parameters:
+    source (DataFrame, RowIndex or DatasetStore): The rows.
+    groups (list): Sensor IDs of each partition.
+    versions (list, optional): With a store, the versions to read.
+    columns (list, optional): Columns to keep. Defaults to all.
+
+    Returns:
+    list: DataFrames, or `StorePartition`s to be read by the workers. The rows of a sensor
+          keep their order in `source`.
+    """
+    if isinstance(source, DatasetStore):
+        return [StorePartition(source, group, versions, columns) for group in groups]
+    if isinstance(source, RowIndex):
+        return [source.frame(sensors=group, columns=columns) for group in groups]
+
+    df = source if columns is None else source[columns]
+    sensors = df['Sensor ID'].to_numpy()
+    order = np.argsort(sensors, kind='stable')
+    sorted_sensors = sensors[order]
+    partitions = []
+    for group in groups:
+        group = np.sort(np.asarray(group))
+        starts = np.searchsorted(sorted_sensors, group, side='left')
+        stops = np.searchsorted(sorted_sensors, group, side='right')
+        partitions.append(df.iloc[np.concatenate([order[start:stop] for start, stop in zip(starts, stops)])])
+    return partitions
+
+
+def _run_partition(func, part):
+    return func(part.load() if isinstance(part, StorePartition) else part)
+
+
+def map_sensors(func, source, backend=None, groups=None, n_partitions=None, versions=None, columns=None):
+    """
+    Run `func` on partitions of whole sensors.
+
+    Parameters:
+    func (callable): Function of a DataFrame. It must be defined at module level to run in worker processes.
+    source (DataFrame, RowIndex or DatasetStore): The rows.
+    backend (str or backend, optional): See `get_backend`. Defaults to 'serial'.
+    groups (list, optional): Sensor IDs of each partition, e.g. the sensors of each cluster.
+                             Defaults to `n_partitions` runs of consecutive sensor IDs.
+    n_partitions (int, optional): Number of partitions without `groups`. Defaults to
+                                  `PARTITIONS_PER_JOB` per worker.
+    versions (list, optional): With a store, the versions to read.
+    columns (list, optional): Columns passed to `func`. Defaults to all.
+
+    Returns:
+    list: The result of `func` on each partition, in order.
+    """
+    backend = get_backend(backend)
+    if groups is None:
+        ids = sensor_ids(source, versions)
+        n_partitions = min(n_partitions or backend.n_jobs * PARTITIONS_PER_JOB, len(ids))
+        groups = [group for group in np.array_split(ids, max(n_partitions, 1)) if len(group)]
+    return backend.map(partial(_run_partition, func), partition(source, groups, versions, columns))
+
+
+def main():
+    # Import here: the characterizer imports this module
+    from ultrasonic_characterizer import split_quartiles, create_range_delay_feature
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('versions', nargs='*', default=None)
+    parser.add_argument('--backend', default='processes', choices=sorted(BACKENDS))
+    parser.add_argument('--jobs', type=int, default=None)
+    args = parser.parse_args()
+
+    store = DatasetStore(args.versions or None)
+    backend = get_backend(args.backend, args.jobs)
+    start = time.perf_counter()
+    df_middle_quartile, _, _ = split_quartiles(store, backend=backend)
+    df_features = create_range_delay_feature(df_middle_quartile, 'middle', backend=backend)
+    print(f"{len(df_middle_quartile)} middle quartile rows, {len(df_features)} sensors x "
+          f"{df_features.shape[1] - 1} features with {backend.n_jobs} job(s) in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""
+Per-sensor cache of computed features.
+
+A sensor's recordings do not change once written, so its features only have to be computed
+once per feature spec. Each entry is keyed by a hash of the sensor's source file signatures
+(name, size and modification time, as in the dataset manifests), of the spec and, for rows of
+a `DatasetStore`, of the build version and delays they were cleaned with. A lookup never reads
+the recordings: only the sensors without an entry are read and computed.
+
+The entries of a spec are stored together as one columnar NumPy archive,
+`<cache dir>/features_<spec hash>.npz`, with the keys, the sensor IDs, one float64 column per
+feature and the time each entry was last used. When a table grows beyond `max_entries`, the
+least recently used entries are evicted.
+
+Example:
+    features = features_from_store(DatasetStore(['data_v4.1.1']), FEATURE_SPEC)
+    features = features_from_files(get_all_files_in_directory(data_dir), FEATURE_SPEC)
+"""
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from build_processed_dataset import FILE_PATTERN, PROCESSED_DIR, file_signature
+from feature_spec import compute_features
+from row_dtypes import read_rows
+
+CACHE_DIR = os.path.join(PROCESSED_DIR, 'feature_cache')
+MAX_ENTRIES = 100_000
+# Manifest settings that change the processed rows of a sensor
+BUILD_SETTINGS = ('build_version', 'delays')
+
+
+def spec_digest(spec):
+    """Hash of the features and fill value of a spec (its name does not change the values)."""
+    features = [feature._asdict() for feature in spec.features]
+    return hashlib.sha256(json.dumps([features, spec.fill_value]).encode()).hexdigest()[:16]
+
+
+def source_key(signatures, digest, settings=None):
+    """
+    Key of a sensor's features: hash of its source file signatures, of the spec and, for
+    processed rows, of the settings they were cleaned with (so a new cleaning invalidates them).
+
+    Parameters:
+    signatures (list): Signatures of the sensor's files, from `file_signature` or a manifest.
+    digest (str): Output of `spec_digest`.
+    settings (dict, optional): Cleaning settings of the rows, e.g. the manifest's 'build_version'
+                               and 'delays'. None for raw recordings.
+
+    Returns:
+    str: The key.
+    """
+    signatures = sorted(signatures, key=lambda signature: signature['name'])
+    payload = [signatures, digest] if settings is None else [signatures, digest, settings]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class FeatureCache:
+    """
+    Cached features of one spec.
+
+    Parameters:
+    spec (FeatureSpec): The features.
+    cache_dir (str): Folder of the cache tables.
+    max_entries (int): Number of sensors kept; the least recently used are evicted beyond it.
+    """
+
+    def __init__(self, spec, cache_dir=CACHE_DIR, max_entries=MAX_ENTRIES):
+        self.spec = spec
+        self.digest = spec_digest(spec)
+        self.path = os.path.join(cache_dir, f"features_{self.digest}.npz")
+        self.max_entries = max_entries
+        self.dirty = False
+        if os.path.exists(self.path):
+            with np.load(self.path, allow_pickle=False) as table:
+                self.keys = table['keys']
+                self.sensor_ids = table['sensor_ids']
+                self.values = table['values']
+                self.last_used = table['last_used']
+        else:
+            self.keys = np.empty(0, dtype='<U64')
+            self.sensor_ids = np.empty(0, dtype=np.int64)
+            self.values = np.empty((0, len(spec.columns)))
+            self.last_used = np.empty(0)
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """
+        Find cached entries and mark them as used. The use times are kept in memory and only
+        written with the next `add`, so read-only lookups never rewrite the table.
+
+        Parameters:
+        keys (list): Keys from `source_key`.
+
+        Returns:
+        ndarray: Position of each key in the table, -1 if it is not cached.
+        """
+        positions = np.array([self.positions.get(key, -1) for key in keys], dtype=np.int64)
+        self.last_used[positions[positions >= 0]] = time.time()
+        return positions
+
+    def frame(self, positions):
+        """Features of cached entries in the layout of `compute_features`. Sensors without rows in the spec's cells are left out."""
+        present = positions[~np.isnan(self.values[positions]).all(axis=1)]
+        df = pd.DataFrame(self.values[present], columns=self.spec.columns)
+        df['Sensor ID'] = self.sensor_ids[present]
+        return df
+
+    def add(self, keys, sensor_ids, df_features):
+        """
+        Cache the features of some sensors.
+
+        Parameters:
+        keys (list): Key of each sensor.
+        sensor_ids (list): Sensor IDs, in the order of `keys`.
+        df_features (DataFrame): Output of `compute_features` for these sensors. Sensors missing
+                                 from it (no rows in the spec's cells) are cached as absent.
+        """
+        rows = df_features.set_index('Sensor ID')[self.spec.columns]
+        values = rows.reindex(sensor_ids).to_numpy(dtype=np.float64)
+        new = np.array([key not in self.positions for key in keys], dtype=bool)
+        self.keys = np.concatenate([self.keys, np.asarray(keys, dtype='<U64')[new]])
+        self.sensor_ids = np.concatenate([self.sensor_ids, np.asarray(sensor_ids, dtype=np.int64)[new]])
+        self.values = np.concatenate([self.values, values[new]])
+        self.last_used = np.concatenate([self.last_used, np.full(new.sum(), time.time())])
+        if len(self.keys) > self.max_entries:
+            keep = np.sort(np.argsort(self.last_used, kind='stable')[-self.max_entries:])
+            self.keys, self.sensor_ids = self.keys[keep], self.sensor_ids[keep]
+            self.values, self.last_used = self.values[keep], self.last_used[keep]
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+        self.dirty = True
+
+    def save(self):
+        """Write the table (atomically) if entries were added or evicted."""
+        if not self.dirty:
+            return
+        cache_dir = os.path.dirname(self.path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # A temporary file of its own, so concurrent processes do not write into each other's
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=os.path.basename(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, keys=self.keys, sensor_ids=self.sensor_ids, values=self.values, last_used=self.last_used)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.dirty = False
+
+
+def _compute_features(df, spec):
+    # `compute_features`, also for rows without any of the spec's cells
+    if len(df) and pd.MultiIndex.from_frame(df[['Range (cm)', 'Delay (us)']]).isin(spec.cells).any():
+        return compute_features(df, spec)
+    return pd.DataFrame(columns=spec.columns + ['Sensor ID'])
+
+
+def _cached_features(cache, keys, sensor_ids, load):
+    # Features of the sensors, computing and caching those without an entry. `load(sensors)` reads their rows.
+    positions = cache.lookup(keys)
+    missing = np.flatnonzero(positions < 0)
+    frames = [cache.frame(positions[positions >= 0])] if (positions >= 0).any() else []
+    if len(missing):
+        missing_sensors = [sensor_ids[i] for i in missing]
+        df_features = _compute_features(load(missing_sensors), cache.spec)
+        cache.add([keys[i] for i in missing], missing_sensors, df_features)
+        frames.append(df_features)
+    cache.save()
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values('Sensor ID', ignore_index=True)
+
+
+def features_from_store(store, spec, version='data_v4.1.1', cache=None):
+    """
+    Features of every sensor of a dataset version, like `compute_features` on its rows.
+
+    Parameters:
+    store (DatasetStore): Store holding the version.
+    spec (FeatureSpec): The features.
+    version (str): Dataset version.
+    cache (FeatureCache, optional): Cache of the spec. Defaults to the one in `CACHE_DIR`.
+
+    Returns:
+    DataFrame: The spec's columns followed by 'Sensor ID', one row per sensor, sorted by sensor.
+
+    Raises:
+    ValueError: If the store has no manifest of the version.
+    """
+    if version not in store.manifests:
+        raise ValueError(f"No processed dataset for {version}: run `python build_processed_dataset.py {version}` "
+                         f"or open the store with ingest=True")
+    cache = FeatureCache(spec) if cache is None else cache
+    manifest = store.manifests[version]
+    entries = manifest['sensors']
+    settings = {key: manifest[key] for key in BUILD_SETTINGS}
+    sensor_ids = sorted(int(sensor) for sensor in entries)
+    keys = [source_key(entries[str(sensor)]['files'], cache.digest, settings) for sensor in sensor_ids]
+    columns = ['Sensor ID', 'Range (cm)', 'Delay (us)', 'Ping Time (us)']
+    return _cached_features(cache, keys, sensor_ids, lambda sensors: store.load(sensors, [version], columns))
+
+
+def features_from_files(file_paths, spec, cache=None):
+    """
+    Features of the sensors recorded in some delay sequence files, like `compute_features` on
+    the merged files. Files are grouped by the sensor in their name; the sensors of files not
+    named like a recording are always read and computed.
+
+    Parameters:
+    file_paths (list): Paths of the recordings.
+    spec (FeatureSpec): The features.
+    cache (FeatureCache, optional): Cache of the spec. Defaults to the one in `CACHE_DIR`.
+
+    Returns:
+    DataFrame: The spec's columns followed by 'Sensor ID', one row per sensor, sorted by sensor.
+    """
+    cache = FeatureCache(spec) if cache is None else cache
+    files, unnamed = {}, []
+    for path in file_paths:
+        match = FILE_PATTERN.search(os.path.basename(path))
+        if match is None:
+            unnamed.append(path)
+        else:
+            files.setdefault(int(match['sensor']), []).append(path)
+
+    # Sensors with rows in files that cannot be keyed are computed from all their files, uncached
+    df_unnamed = read_rows(unnamed) if unnamed else None
+    uncached = set() if df_unnamed is None else {int(sensor) for sensor in df_unnamed['Sensor ID'].unique()}
+
+    sensor_ids = sorted(set(files) - uncached)
+    keys = [source_key(file_signature(files[sensor]), cache.digest) for sensor in sensor_ids]
+    df = _cached_features(cache, keys, sensor_ids,
+                          lambda sensors: read_rows([path for sensor in sensors for path in files[sensor]]))
+    if uncached:
+        paths = [path for sensor in sorted(uncached & set(files)) for path in files[sensor]]
+        df_others = pd.concat([df_unnamed, read_rows(paths)], ignore_index=True) if paths else df_unnamed
+        others = _compute_features(df_others, spec)
+        df = pd.concat([df, others], ignore_index=True).sort_values('Sensor ID', ignore_index=True)
+    return df
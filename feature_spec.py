@@ -0,0 +1,213 @@
+"""
+Declarative feature specs for the sensor characterization.
+
+A feature is a statistic of the ping times of one sensor at one (range, delay), restricted to
+one quartile band of that cell:
+- 'middle': within 1.5 IQR of the quartiles (the rows `identify_and_remove_outliers` keeps),
+- 'lower': at or below the lower fence,
+- 'upper': at or above the upper fence,
+- 'all': every row of the cell (not one of the quartile bands of the full feature cube).
+Statistics are 'mean', 'var', 'std' and 'freq' (number of rows). Features are named
+'<range>_<delay>_<statistic>_<band>', e.g. '23_6000_mean_middle', as in the notebooks.
+
+A spec compiles into a single pass over the data. The quartiles are computed once per
+(sensor, range, delay) for the cells the spec uses, and each requested (band, statistic) is
+aggregated with `np.bincount`. `compute_feature_sets` evaluates several candidate specs in one
+pass over their union.
+"""
+import json
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from pipeline_profiler import span
+
+STATISTICS = ('mean', 'var', 'std', 'freq')
+BANDS = ('middle', 'lower', 'upper')
+ALL_BAND = 'all'
+
+# Integer code of a (range, delay) combination: range * CELL_KEY_FACTOR + delay
+CELL_KEY_FACTOR = 1_000_000
+
+Feature = namedtuple('Feature', ['range', 'delay', 'statistic', 'band'])
+
+
+def feature_name(feature):
+    return f"{feature.range}_{feature.delay}_{feature.statistic}_{feature.band}"
+
+
+def parse_feature(name):
+    """'23_6000_mean_middle' -> Feature(23, 6000, 'mean', 'middle')"""
+    range_cm, delay, statistic, band = name.split('_')
+    return Feature(int(range_cm), int(delay), statistic, band)
+
+
+class FeatureSpec:
+    """
+    Ordered list of features a model is trained on.
+
+    Parameters:
+    features (list): Feature tuples (range, delay, statistic, band), in model column order.
+    name (str, optional): Name of the spec.
+    fill_value (float): Value of features whose band has no rows (the notebooks fill them with 0).
+    """
+
+    def __init__(self, features, name=None, fill_value=0):
+        self.features = [Feature(*feature) for feature in features]
+        self.name = name
+        self.fill_value = fill_value
+        for feature in self.features:
+            if feature.statistic not in STATISTICS or feature.band not in BANDS + (ALL_BAND,):
+                raise ValueError(f"Unsupported feature {feature_name(feature)}: statistic must be one of "
+                                 f"{STATISTICS} and band one of {BANDS + (ALL_BAND,)}")
+
+    @property
+    def columns(self):
+        return [feature_name(feature) for feature in self.features]
+
+    @property
+    def cells(self):
+        """The (range, delay) combinations the features are computed from, without duplicates."""
+        return list(dict.fromkeys((feature.range, feature.delay) for feature in self.features))
+
+    @classmethod
+    def from_columns(cls, columns, name=None, fill_value=0):
+        return cls([parse_feature(column) for column in columns], name, fill_value)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            spec = json.load(f)
+        features = [(f['range'], f['delay'], f['statistic'], f['band']) for f in spec['features']]
+        return cls(features, spec.get('name'), spec.get('fill_value', 0))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'name': self.name, 'fill_value': self.fill_value,
+                       'features': [feature._asdict() for feature in self.features]}, f, indent=2)
+
+    def __repr__(self):
+        return f"FeatureSpec({self.name!r}, {len(self.features)} features)"
+
+
+def _band_statistics(group_codes, ping_times, mask, n_groups, statistics):
+    codes, values = group_codes[mask], ping_times[mask]
+    counts = np.bincount(codes, minlength=n_groups)
+    result = {'freq': counts.astype(float)}
+    if statistics & {'mean', 'var', 'std'}:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.bincount(codes, weights=values, minlength=n_groups) / counts
+            result['mean'] = means
+            if statistics & {'var', 'std'}:
+                # Sample variance (ddof=1) like pandas, NaN below two rows
+                squares = np.bincount(codes, weights=(values - means[codes]) ** 2, minlength=n_groups)
+                result['var'] = np.where(counts > 1, squares / (counts - 1), np.nan)
+                result['std'] = np.sqrt(result['var'])
+    return result
+
+
+def quartile_fences(ping_times, group_codes, n_groups):
+    """
+    Outlier fences (1.5 IQR beyond the quartiles) of the group of every row, as in
+    `identify_and_remove_outliers`.
+
+    Parameters:
+    ping_times (ndarray): Ping time of every row.
+    group_codes (ndarray): Group of every row, from 0 to `n_groups` - 1.
+    n_groups (int): Number of groups.
+
+    Returns:
+    tuple: Lower and upper fence of every row, NaN for groups without ping times.
+    """
+    q1 = np.full(n_groups, np.nan)
+    q3 = np.full(n_groups, np.nan)
+    if len(ping_times):
+        quartiles = pd.Series(ping_times).groupby(group_codes).quantile([0.25, 0.75]).unstack()
+        q1[quartiles.index] = quartiles[0.25]
+        q3[quartiles.index] = quartiles[0.75]
+    return (q1 - 1.5 * (q3 - q1))[group_codes], (q3 + 1.5 * (q3 - q1))[group_codes]
+
+
+def _compute(df, features):
+    # One pass over the rows of the cells used by `features`. Returns the raw feature values
+    # (NaN for empty bands), the sensor IDs and the number of rows per sensor and cell.
+    # Profiling spans keep the stage names of the former filter / quartile split / pivot pipeline
+    cells = list(dict.fromkeys((feature.range, feature.delay) for feature in features))
+    with span('filter') as s:
+        cell_keys = df['Range (cm)'].to_numpy(dtype=np.int64) * CELL_KEY_FACTOR + df['Delay (us)'].to_numpy(dtype=np.int64)
+        cell_codes = pd.Index([range_cm * CELL_KEY_FACTOR + delay for range_cm, delay in cells]).get_indexer(cell_keys)
+        keep = cell_codes >= 0
+        ping_times = df['Ping Time (us)'].to_numpy(dtype=np.float64)[keep]
+        sensor_codes, sensor_ids = pd.factorize(df['Sensor ID'].to_numpy()[keep], sort=True)
+        n_sensors, n_cells = len(sensor_ids), len(cells)
+        n_groups = n_sensors * n_cells
+        group_codes = sensor_codes * n_cells + cell_codes[keep]
+        s.rows = len(ping_times)
+
+    # Quartile fences of every (sensor, range, delay)
+    with span('quartile_split', rows=len(ping_times)):
+        lower_fence, upper_fence = quartile_fences(ping_times, group_codes, n_groups)
+    band_masks = {
+        'middle': lambda: (ping_times >= lower_fence) & (ping_times <= upper_fence),
+        'lower': lambda: ping_times <= lower_fence,
+        'upper': lambda: ping_times >= upper_fence,
+        ALL_BAND: lambda: np.ones(len(ping_times), dtype=bool),
+    }
+
+    # Statistics of every band, scattered into one column per feature
+    with span('pivot', rows=len(ping_times), features=len(features)):
+        columns = {}
+        for band in BANDS + (ALL_BAND,):
+            band_features = [feature for feature in features if feature.band == band]
+            if not band_features:
+                continue
+            statistics = _band_statistics(group_codes, ping_times, band_masks[band](), n_groups,
+                                          {feature.statistic for feature in band_features})
+            for feature in band_features:
+                values = statistics[feature.statistic].reshape(n_sensors, n_cells)[:, cells.index((feature.range, feature.delay))]
+                columns[feature_name(feature)] = values
+
+    cell_counts = np.bincount(group_codes, minlength=n_groups).reshape(n_sensors, n_cells)
+    return columns, sensor_ids, pd.DataFrame(cell_counts, columns=pd.MultiIndex.from_tuples(cells))
+
+
+def _select(spec, columns, sensor_ids, cell_counts):
+    # Sensors with rows in at least one of the spec's cells, and the spec's columns
+    present = (cell_counts[spec.cells].to_numpy() > 0).any(axis=1)
+    df_features = pd.DataFrame({column: columns[column][present] for column in spec.columns})
+    df_features = df_features.fillna(spec.fill_value)
+    df_features['Sensor ID'] = sensor_ids[present]
+    return df_features
+
+
+def compute_features(df, spec):
+    """
+    Compute the features of a spec for every sensor in one pass.
+
+    Parameters:
+    df (DataFrame): Rows with 'Sensor ID', 'Range (cm)', 'Delay (us)' and 'Ping Time (us)'.
+                    Rows of other (range, delay) combinations are ignored.
+    spec (FeatureSpec): The features to compute.
+
+    Returns:
+    DataFrame: The spec's columns in order followed by 'Sensor ID', one row per sensor with
+               rows in at least one of the spec's cells, sorted by sensor.
+    """
+    return _select(spec, *_compute(df, spec.features))
+
+
+def compute_feature_sets(df, specs):
+    """
+    Compute several candidate feature sets in a single pass over the union of their features.
+
+    Parameters:
+    df (DataFrame): Rows with 'Sensor ID', 'Range (cm)', 'Delay (us)' and 'Ping Time (us)'.
+    specs (dict): Name mapped to FeatureSpec.
+
+    Returns:
+    dict: Name mapped to the DataFrame `compute_features` would return for that spec.
+    """
+    union = list(dict.fromkeys(feature for spec in specs.values() for feature in spec.features))
+    computed = _compute(df, union)
+    return {name: _select(spec, *computed) for name, spec in specs.items()}
@@ -0,0 +1,229 @@
+"""
+Incremental retraining of the sensor characterization model when sensors are added or re-recorded.
+
+One update of a dataset version:
+1. Rebuilds the processed dataset incrementally (`build_processed_dataset`): only the sensors
+   whose recordings are new or changed, per the file manifest, are reprocessed.
+2. Recomputes the model features of only those sensors, through the feature cache, and
+   updates the persisted feature table. A state file next to the table records the source
+   files behind the features of every sensor.
+3. If any features changed, refits the scaler on the table and KMeans warm-started from the
+   current centroids (a single run), so the clusters keep their numbers and descriptions.
+4. Scores the current and the refitted model on all the cleaned rows with
+   `average_variability_metrics`, and promotes the refitted model (bundle, scaler and KMeans)
+   only if neither the outlier score nor the variability score gets worse.
+
+Usage (from the repository root):
+    python incremental_training.py
+    python incremental_training.py data_v4.1.1 --watch 3600
+    python incremental_training.py --dry-run
+
+A dry run only scans the recordings and reports the new, changed and removed sensors: it
+neither builds the dataset nor computes features, scores or writes anything.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+from joblib import dump
+from sklearn.cluster import KMeans
+from sklearn.preprocessing import StandardScaler
+
+from build_processed_dataset import RAW_DIR, build_processed_dataset, dedupe_recordings, file_signature, list_recordings
+from dataset_store import DatasetStore
+from feature_cache import features_from_store
+from model_bundle import BUNDLE_FILE, MODEL_DIR, ModelBundle
+from raw_query import RowIndex
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(script_dir, 'Analysis', 'Delay_sequence_data'))
+
+from clustering_helper import VARIABILITY_COLUMNS, average_variability_metrics  # noqa: E402
+
+FEATURE_TABLE = os.path.join(MODEL_DIR, 'df_mi_cluster_13.csv')
+STATE_FILE = os.path.join(MODEL_DIR, 'df_mi_cluster_13.state.json')
+SCALER_FILE = os.path.join(MODEL_DIR, 'scaler_final_mi.joblib')
+KMEANS_FILE = os.path.join(MODEL_DIR, 'kmeans_model_final_df_mi.joblib')
+
+SCORES = ('outlier_score', 'variability_score')
+
+
+def changed_sensors(manifest, state):
+    """
+    Compare a dataset manifest with the files behind the persisted features.
+
+    Parameters:
+    manifest (dict): Manifest of `build_processed_dataset`.
+    state (dict): Content of the state file (empty if there is none).
+
+    Returns:
+    list: Sensor IDs that are new or whose files changed.
+    list: Sensor IDs that no longer have recordings.
+    """
+    known = state.get('sensors', {}) if state.get('version') == manifest['version'] else {}
+    changed = sorted(int(sensor) for sensor, entry in manifest['sensors'].items() if known.get(sensor) != entry['files'])
+    removed = sorted(int(sensor) for sensor in set(known) - set(manifest['sensors']))
+    return changed, removed
+
+
+def scan_recordings(version, raw_dir=RAW_DIR):
+    """
+    Source files of every sensor of a dataset version, as the build would record them,
+    without building anything.
+
+    Parameters:
+    version (str): Folder name of the dataset version inside `raw_dir`.
+    raw_dir (str): Folder containing the dataset versions.
+
+    Returns:
+    dict: Like a manifest of `build_processed_dataset`, with the 'version' and the 'files' of each sensor.
+    """
+    kept, _ = dedupe_recordings(list_recordings(os.path.join(raw_dir, version)))
+    return {'version': version,
+            'sensors': {str(sensor): {'files': file_signature(group['path'])} for sensor, group in kept.groupby('sensor')}}
+
+
+def update_feature_table(table, store, version, spec):
+    """
+    Bring the feature table up to date with a dataset version. Features are read from the
+    feature cache, so only the sensors whose recordings are new or changed are computed.
+
+    Parameters:
+    table (DataFrame): Feature table with the spec's columns, 'Sensor ID' and 'cluster'.
+    store (DatasetStore): Store holding the version.
+    version (str): Dataset version.
+    spec (FeatureSpec): The model's features.
+
+    Returns:
+    DataFrame: The updated table, sorted by sensor. Rows of new sensors have no cluster yet.
+    list: Sensor IDs whose features were added, changed or removed.
+    """
+    columns = spec.columns
+    features = features_from_store(store, spec, version)
+
+    old = table.set_index('Sensor ID')
+    updated = [int(row[-1]) for row in features.itertuples(index=False)
+               if row[-1] not in old.index or not np.allclose(old.loc[row[-1], columns].to_numpy(dtype=np.float64), row[:-1])]
+    updated += [int(sensor) for sensor in old.index.difference(features['Sensor ID'])]
+
+    features['cluster'] = features['Sensor ID'].map(old['cluster'])
+    return features[table.columns], sorted(updated)
+
+
+def warm_start(bundle, table, random_state=42):
+    """
+    Refit the scaler and KMeans on the feature table, starting from the bundle's centroids.
+
+    Parameters:
+    bundle (ModelBundle): The current model.
+    table (DataFrame): Feature table with the bundle's feature columns.
+    random_state (int): Random state of KMeans.
+
+    Returns:
+    tuple: The fitted StandardScaler and KMeans.
+    """
+    features = table[bundle.spec.columns]
+    scaler = StandardScaler().fit(features)
+    # Current centroids in feature units, then in the refitted scaler's space
+    centroids = pd.DataFrame(bundle.centroids * bundle.scale + bundle.mean, columns=bundle.spec.columns)
+    kmeans = KMeans(n_clusters=bundle.n_clusters, init=scaler.transform(centroids), n_init=1,
+                    random_state=random_state).fit(scaler.transform(features))
+    return scaler, kmeans
+
+
+def variability_scores(sensor_ids, labels, rows):
+    """Outlier and variability scores of `average_variability_metrics` (lower is better)."""
+    df_cluster = pd.DataFrame({'Sensor ID': sensor_ids, 'cluster': labels})
+    _, outlier_score, variability_score = average_variability_metrics(df_cluster, rows)
+    return {'outlier_score': float(outlier_score), 'variability_score': float(variability_score)}
+
+
+def next_version(version):
+    """'final_mi-1' -> 'final_mi-2'."""
+    name, _, number = version.rpartition('-')
+    return f"{name}-{int(number) + 1}" if name and number.isdigit() else f"{version}-2"
+
+
+def update(version='data_v4.1.1', tolerance=0.0, dry_run=False, n_jobs=None):
+    """
+    Run one incremental update (see the module docstring).
+
+    Parameters:
+    version (str): Dataset version the model is trained on.
+    tolerance (float): Relative increase of a score still accepted for the promotion.
+    dry_run (bool): Whether to only report the new, changed and removed sensors, from a scan of
+                    the recordings, without building the dataset, computing features or writing.
+    n_jobs (int, optional): Number of worker processes of the dataset build.
+
+    Returns:
+    dict: What was done: 'changed', 'removed' and 'updated' sensors, the 'current' and
+          'candidate' scores, 'promoted' and the model 'version'.
+    """
+    manifest = scan_recordings(version) if dry_run else build_processed_dataset(version, n_jobs=n_jobs)
+    state = {}
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+    bundle = ModelBundle.load(BUNDLE_FILE)
+    changed, removed = changed_sensors(manifest, state)
+    report = {'changed': changed, 'removed': removed, 'updated': [], 'promoted': False, 'version': bundle.version}
+    if dry_run or (not changed and not removed):
+        return report
+
+    store = DatasetStore([version])
+    table = pd.read_csv(FEATURE_TABLE, index_col=0)
+    table, report['updated'] = update_feature_table(table, store, version, bundle.spec)
+    features = table[bundle.spec.columns].to_numpy(dtype=np.float64)
+    current_labels = bundle.predict(features)
+
+    if report['updated']:
+        rows = RowIndex(store.load(versions=[version], columns=VARIABILITY_COLUMNS), columns=['Ping Time (us)'])
+        scaler, kmeans = warm_start(bundle, table)
+        report['current'] = variability_scores(table['Sensor ID'], current_labels, rows)
+        report['candidate'] = variability_scores(table['Sensor ID'], kmeans.labels_, rows)
+        report['promoted'] = all(report['candidate'][score] <= report['current'][score] + tolerance * abs(report['current'][score])
+                                 for score in SCORES)
+
+    table['cluster'] = current_labels
+    if report['promoted']:
+        table['cluster'] = kmeans.labels_
+        report['version'] = next_version(bundle.version)
+    if report['promoted']:
+        dump(scaler, SCALER_FILE)
+        dump(kmeans, KMEANS_FILE)
+        ModelBundle.from_models(scaler, kmeans, bundle.spec, bundle.descriptions, report['version']).save(BUNDLE_FILE)
+    table.to_csv(FEATURE_TABLE)
+    with open(STATE_FILE, 'w') as f:
+        json.dump({'version': version, 'sensors': {sensor: entry['files'] for sensor, entry in manifest['sensors'].items()}},
+                  f, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('version', nargs='?', default='data_v4.1.1')
+    parser.add_argument('--tolerance', type=float, default=0.0, help='Relative score increase accepted for the promotion')
+    parser.add_argument('--dry-run', action='store_true', help='Only report the new, changed and removed sensors, without building or writing anything')
+    parser.add_argument('--watch', type=float, default=None, metavar='SECONDS', help='Check the data tree again every SECONDS')
+    parser.add_argument('--jobs', type=int, default=None)
+    args = parser.parse_args()
+
+    while True:
+        start = time.perf_counter()
+        report = update(args.version, args.tolerance, args.dry_run, args.jobs)
+        print(f"{len(report['changed'])} new or changed and {len(report['removed'])} removed sensors, "
+              f"{len(report['updated'])} with new features in {time.perf_counter() - start:.1f} s")
+        if 'candidate' in report:
+            print(f"Scores current {report['current']}, refitted {report['candidate']}: "
+                  f"{'promoted ' + report['version'] if report['promoted'] else 'kept ' + report['version']}")
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import pandas as pd
+
+from ultrasonic_characterizer import (FEATURE_COLUMNS, MIN_CONFIDENCE, feature_engineering_quartile_means,
+                                      load_models, predict_KMeans)
+
+
+# Refined categories for which the rest of a collection session can be skipped
+STOP_CATEGORIES = ['Defective Sensors']
+
+
+def required_cells(feature_columns=FEATURE_COLUMNS):
+    """
+    List the (range, delay) combinations the model features are computed from.
+
+    Parameters:
+    feature_columns (list): Feature names formatted as '<range>_<delay>_mean_middle'.
+
+    Returns:
+    list: (range_cm, delay_us) tuples.
+    """
+    return [tuple(int(value) for value in column.split('_')[:2]) for column in feature_columns]
+
+
+class LiveCharacterizer:
+    """
+    Incremental feature accumulator fed with rows while they are being recorded.
+
+    Ping times are kept per sensor and (range, delay). Only the combinations used by the
+    model features are kept. Once every one of them has `min_samples` samples, the
+    sensor's feature vector is computed with `feature_engineering_quartile_means`,
+    exactly as in the offline pipeline. The vector is classified with the pre-trained
+    KMeans model and the result is returned once.
+
+    Example:
+        characterizer = LiveCharacterizer()
+        record_data(metadata, filename, accumulator=characterizer)
+        result = characterizer.results.get(int(metadata['Sensor ID']))
+
+    Parameters:
+    min_samples (int): Samples needed per (range, delay) before the sensor is characterized.
+    models (ModelBundle, optional): Bundle from `load_models`, whose spec sets the features. Defaults to the pre-trained model.
+    descriptions (DataFrame, optional): Cluster descriptions. Defaults to those of the model bundle.
+    stop_categories (list): Refined categories for which `stop` is set in the result.
+    min_confidence (float): Confidence below which `retest` is set in the result.
+    """
+
+    def __init__(self, min_samples=50, models=None, descriptions=None, stop_categories=STOP_CATEGORIES,
+                 min_confidence=MIN_CONFIDENCE):
+        self.min_samples = min_samples
+        self.min_confidence = min_confidence
+        self.models = models or load_models()
+        if descriptions is None:
+            descriptions = self.models.descriptions
+        self.descriptions = descriptions.set_index('cluster')
+        self.stop_categories = stop_categories
+        self.required = set(required_cells(self.models.spec.columns))
+        self.samples = {}  # sensor ID -> {(range, delay): [ping times]}
+        self.complete_cells = {}  # sensor ID -> number of required cells with enough samples
+        self.results = {}  # sensor ID -> result of `characterize`
+
+    def add_row(self, row):
+        """
+        Add one recorded sample.
+
+        Parameters:
+        row (dict): A row as written by `record_data`, with 'Sensor ID', 'Range (cm)',
+                    'Delay (us)' and 'Ping Time (us)' (strings or numbers).
+
+        Returns:
+        dict: The characterization result when this row completes the sensor, otherwise None.
+        """
+        sensor_id = int(row['Sensor ID'])
+        if sensor_id in self.results:
+            return None
+        cell = (int(float(row['Range (cm)'])), int(float(row['Delay (us)'])))
+        if cell not in self.required:
+            return None
+
+        cell_samples = self.samples.setdefault(sensor_id, {}).setdefault(cell, [])
+        cell_samples.append(float(row['Ping Time (us)']))
+        if len(cell_samples) == self.min_samples:
+            self.complete_cells[sensor_id] = self.complete_cells.get(sensor_id, 0) + 1
+            if self.complete_cells[sensor_id] == len(self.required):
+                return self.characterize(sensor_id)
+        return None
+
+    def characterize(self, sensor_id):
+        """
+        Compute the feature vector and cluster of a sensor from the samples collected so far.
+
+        Parameters:
+        sensor_id (int): The sensor to characterize.
+
+        Returns:
+        dict: 'Sensor ID', 'cluster', 'features' (Series), the cluster's 'Refined Category',
+              'Edge Case Sensitivity' and 'Description', 'confidence', 'margin' and 'second_cluster'
+              (see `predict_KMeans`), 'retest' when the cluster is uncertain, and 'stop' when the
+              session can end early.
+        """
+        df = pd.DataFrame([
+            {'Sensor ID': sensor_id, 'Range (cm)': range_cm, 'Delay (us)': delay, 'Ping Time (us)': ping_time}
+            for (range_cm, delay), ping_times in self.samples[sensor_id].items()
+            for ping_time in ping_times
+        ])
+        df_features = feature_engineering_quartile_means(df, self.models.spec)
+        prediction = predict_KMeans(df_features, self.models, soft=True, min_confidence=self.min_confidence).iloc[0]
+        cluster = int(prediction['cluster'])
+
+        description = self.descriptions.loc[cluster]
+        result = {
+            'Sensor ID': sensor_id,
+            'cluster': cluster,
+            'features': df_features.iloc[0].drop('Sensor ID'),
+            'Refined Category': description['Refined Category'],
+            'Edge Case Sensitivity': description['Edge Case Sensitivity'],
+            'Description': description['Description'],
+            'confidence': float(prediction['confidence']),
+            'margin': float(prediction['margin']),
+            'second_cluster': int(prediction['second_cluster']),
+            'retest': bool(prediction['retest']),
+            'stop': description['Refined Category'] in self.stop_categories,
+        }
+        self.results[sensor_id] = result
+        del self.samples[sensor_id]
+        return result
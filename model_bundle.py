@@ -0,0 +1,346 @@
+"""
+Single-file bundle of the sensor characterization model.
+
+A bundle holds everything `predict_KMeans` needs: the scaler's mean and scale, the KMeans
+centroids, the share of training sensors in each cluster, the within-cluster variance, the
+feature spec (model column order) and the cluster descriptions. Layout:
+
+    MAGIC (8 bytes) | header length (8 bytes, little endian) | JSON header | padding | arrays
+
+The header records the bundle version, the spec, the descriptions, the offset, dtype and
+shape of each array, and the sha256 of the array section. Arrays are stored raw and 64-byte
+aligned, so they can be memory-mapped. Loading checks the magic, the format and the file
+size (no hashing); `verify=True` also checks the hash.
+
+Prediction is plain NumPy, no joblib or pickle is involved. `get_bundle` loads each bundle
+file once per process.
+
+Usage (from the repository root), to rebuild the bundle from the trained models and
+check it against scikit-learn:
+    python model_bundle.py
+    python model_bundle.py --check Analysis/Delay_sequence_data/best_models/final/df_mi_cluster_13.csv
+"""
+import os
+import json
+import struct
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from feature_spec import FeatureSpec
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.path.join(script_dir, 'Analysis', 'Delay_sequence_data', 'best_models', 'final')
+BUNDLE_FILE = os.path.join(MODEL_DIR, 'model_final_mi.bundle')
+DESCRIPTIONS_FILE = os.path.join(script_dir, 'Analysis', 'Delay_sequence_data', 'characteristic_figure', 'cluster_desc.csv')
+
+MAGIC = b'USMB\x00\x00\x00\x01'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+ARRAYS = ('mean', 'scale', 'centroids', 'weights')
+
+
+class BundleError(ValueError):
+    """Raised when a bundle file is malformed, truncated or does not match its hash."""
+
+
+class ModelBundle:
+    """
+    Scaler parameters, centroids, feature spec and cluster descriptions of a model.
+
+    Parameters:
+    mean (ndarray): Per-feature mean of the scaler.
+    scale (ndarray): Per-feature scale of the scaler.
+    centroids (ndarray): KMeans cluster centers in the scaled space (n_clusters x n_features).
+    spec (FeatureSpec): The features, in model column order.
+    descriptions (DataFrame): Cluster descriptions with a 'cluster' column.
+    version (str): Version of the model.
+    weights (ndarray, optional): Share of the training sensors in each cluster. Defaults to uniform.
+    variance (float): Within-cluster variance per feature of the training sensors, in the scaled space.
+    sha256 (str, optional): Hash of the array section, set when saved or loaded.
+    """
+
+    def __init__(self, mean, scale, centroids, spec, descriptions, version, weights=None, variance=1.0, sha256=None):
+        self.mean = mean
+        self.scale = scale
+        self.centroids = centroids
+        self.weights = np.full(len(centroids), 1 / len(centroids)) if weights is None else weights
+        self.variance = variance
+        self.spec = spec
+        self.descriptions = descriptions
+        self.version = version
+        self.sha256 = sha256
+        if not (len(mean) == len(scale) == centroids.shape[1] == len(spec.columns)):
+            raise BundleError(f"Bundle arrays do not match the {len(spec.columns)} features of the spec")
+
+    @property
+    def n_clusters(self):
+        return len(self.centroids)
+
+    @classmethod
+    def from_models(cls, scaler, kmeans, spec, descriptions, version):
+        """
+        Bundle a fitted StandardScaler and KMeans model.
+
+        Parameters:
+        scaler (StandardScaler): The fitted scaler.
+        kmeans (KMeans): The fitted KMeans model.
+        spec (FeatureSpec): The features the models were trained on, in order.
+        descriptions (DataFrame): Cluster descriptions with a 'cluster' column.
+        version (str): Version of the model.
+
+        Returns:
+        ModelBundle: The bundle.
+        """
+        feature_names = getattr(scaler, 'feature_names_in_', None)
+        if feature_names is not None and list(feature_names) != spec.columns:
+            raise BundleError("The spec's columns differ from the features the scaler was fitted on")
+        scale = scaler.scale_ if scaler.scale_ is not None else np.ones(len(spec.columns))
+        centroids = np.asarray(kmeans.cluster_centers_, dtype=np.float64)
+        counts = np.bincount(kmeans.labels_, minlength=len(centroids))
+        variance = kmeans.inertia_ / (len(kmeans.labels_) * centroids.shape[1])
+        return cls(np.asarray(scaler.mean_, dtype=np.float64), np.asarray(scale, dtype=np.float64), centroids,
+                   spec, descriptions, version, weights=counts / counts.sum(), variance=float(variance))
+
+    def save(self, path):
+        """
+        Write the bundle to `path` (atomically) and set its hash.
+
+        Returns:
+        str: The sha256 of the array section.
+        """
+        arrays, layout, offset = [], {}, 0
+        for name in ARRAYS:
+            array = np.ascontiguousarray(getattr(self, name), dtype='<f8')
+            layout[name] = {'offset': offset, 'dtype': '<f8', 'shape': list(array.shape)}
+            data = array.tobytes()
+            padding = -len(data) % ALIGNMENT
+            arrays.append(data + b'\x00' * padding)
+            offset += len(data) + padding
+        payload = b''.join(arrays)
+        self.sha256 = hashlib.sha256(payload).hexdigest()
+
+        header = {
+            'format': FORMAT_VERSION,
+            'version': self.version,
+            'sha256': self.sha256,
+            'variance': self.variance,
+            'payload_bytes': len(payload),
+            'arrays': layout,
+            'spec': {'name': self.spec.name, 'fill_value': self.spec.fill_value,
+                     'features': [feature._asdict() for feature in self.spec.features]},
+            'descriptions': json.loads(self.descriptions.to_json(orient='split', index=False)),
+        }
+        header = json.dumps(header).encode()
+        header += b' ' * (-(len(MAGIC) + 8 + len(header)) % ALIGNMENT)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC + struct.pack('<Q', len(header)) + header + payload)
+        os.replace(tmp_path, path)
+        return self.sha256
+
+    @classmethod
+    def load(cls, path, mmap=False, verify=False):
+        """
+        Read a bundle.
+
+        Parameters:
+        path (str): Path of the bundle file.
+        mmap (bool): Whether to memory-map the arrays instead of reading them.
+        verify (bool): Whether to check the sha256 of the arrays.
+
+        Returns:
+        ModelBundle: The bundle.
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise BundleError(f"{path} is not a model bundle")
+            (header_length,) = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_length))
+            start = len(MAGIC) + 8 + header_length
+            if header.get('format') != FORMAT_VERSION:
+                raise BundleError(f"Unsupported bundle format {header.get('format')} in {path}")
+            if os.fstat(f.fileno()).st_size != start + header['payload_bytes']:
+                raise BundleError(f"{path} is truncated or has trailing data")
+            payload = None if mmap else f.read(header['payload_bytes'])
+
+        if mmap:
+            payload = np.memmap(path, dtype=np.uint8, mode='r', offset=start, shape=(header['payload_bytes'],))
+        if verify and hashlib.sha256(payload).hexdigest() != header['sha256']:
+            raise BundleError(f"{path} does not match its sha256")
+
+        arrays = {}
+        for name, entry in header['arrays'].items():
+            count = int(np.prod(entry['shape']))
+            arrays[name] = np.frombuffer(payload, dtype=entry['dtype'], count=count,
+                                         offset=entry['offset']).reshape(entry['shape'])
+
+        spec = header['spec']
+        spec = FeatureSpec([(f['range'], f['delay'], f['statistic'], f['band']) for f in spec['features']],
+                           spec['name'], spec['fill_value'])
+        descriptions = pd.DataFrame(header['descriptions']['data'], columns=header['descriptions']['columns'])
+        return cls(arrays['mean'], arrays['scale'], arrays['centroids'], spec, descriptions, header['version'],
+                   weights=arrays.get('weights'), variance=header.get('variance', 1.0), sha256=header['sha256'])
+
+    def transform(self, features):
+        """Standardize a feature matrix in model column order, like `StandardScaler.transform`."""
+        return (np.asarray(features, dtype=np.float64) - self.mean) / self.scale
+
+    def predict(self, features):
+        """
+        Closest centroid of each row, like `KMeans.predict`.
+
+        Parameters:
+        features (ndarray): Unscaled feature matrix in model column order (n_samples x n_features).
+
+        Returns:
+        ndarray: Cluster label of each row.
+        """
+        return self.assign(self.transform(features))
+
+    def _relative_distances(self, features_scaled):
+        # |x - c|^2 without the |x|^2 term, which is the same for every centroid: |c|^2 - 2 x.c,
+        # rounded as in scikit-learn's KMeans.predict (einsum norms, as its row_norms, and one
+        # matrix product), so near-ties get the same labels
+        return np.einsum('ij,ij->i', self.centroids, self.centroids) - 2 * (features_scaled @ self.centroids.T)
+
+    def distances(self, features_scaled):
+        """
+        Squared Euclidean distance of each row of a standardized feature matrix to every centroid.
+
+        Parameters:
+        features_scaled (ndarray): Standardized feature matrix (n_samples x n_features).
+
+        Returns:
+        ndarray: Squared distances (n_samples x n_clusters).
+        """
+        features_scaled = np.asarray(features_scaled, dtype=np.float64)
+        squared = self._relative_distances(features_scaled) + np.einsum('ij,ij->i', features_scaled, features_scaled)[:, None]
+        return np.maximum(squared, 0)
+
+    def assign(self, features_scaled):
+        """Closest centroid of each row of an already standardized feature matrix, like `KMeans.predict`."""
+        return self._relative_distances(np.asarray(features_scaled, dtype=np.float64)).argmin(axis=1)
+
+    def membership(self, features_scaled, temperature=1.0):
+        """
+        Soft assignment of each row to every cluster, from a single distance pass.
+
+        The membership is the posterior of a Gaussian mixture with the KMeans centroids as
+        means, the training cluster shares as weights and the within-cluster variance (times
+        `temperature`) as the shared isotropic variance.
+
+        Parameters:
+        features_scaled (ndarray): Standardized feature matrix (n_samples x n_features).
+        temperature (float): Multiplier of the variance; larger values give softer memberships.
+
+        Returns:
+        dict: 'cluster' (closest centroid), 'distances' (Euclidean, n_samples x n_clusters),
+              'membership' (posterior, rows sum to 1), 'second_cluster' (next closest centroid),
+              'margin' (distance to the second minus to the closest centroid) and 'confidence'
+              (posterior of the assigned cluster).
+        """
+        features_scaled = np.asarray(features_scaled, dtype=np.float64)
+        relative = self._relative_distances(features_scaled)
+        squared = np.maximum(relative + np.einsum('ij,ij->i', features_scaled, features_scaled)[:, None], 0)
+        # Ranked on the relative distances, so 'cluster' is the label of `assign`
+        order = np.argsort(relative, axis=1, kind='stable')[:, :2]
+        rows = np.arange(len(squared))
+        with np.errstate(divide='ignore'):
+            logits = np.log(self.weights) - squared / (2 * self.variance * temperature)
+        logits -= logits.max(axis=1, keepdims=True)
+        membership = np.exp(logits)
+        membership /= membership.sum(axis=1, keepdims=True)
+        distances = np.sqrt(squared)
+        return {
+            'cluster': order[:, 0],
+            'distances': distances,
+            'membership': membership,
+            'second_cluster': order[:, 1],
+            'margin': distances[rows, order[:, 1]] - distances[rows, order[:, 0]],
+            'confidence': membership[rows, order[:, 0]],
+        }
+
+    def __repr__(self):
+        return (f"ModelBundle({self.version!r}, {len(self.spec.columns)} features, {self.n_clusters} clusters, "
+                f"sha256={self.sha256[:12] if self.sha256 else None})")
+
+
+def near_ties(centroids, n_rows=200_000, epsilon=1e-12, random_state=0):
+    """
+    Standardized rows halfway between two centroids, nudged by up to `epsilon`: the rows
+    whose labels depend on how the distances are rounded.
+
+    Parameters:
+    centroids (ndarray): Cluster centers (n_clusters x n_features).
+    n_rows (int): Number of rows.
+    epsilon (float): Largest nudge of each coordinate.
+    random_state (int): Seed of the pairs and nudges.
+
+    Returns:
+    ndarray: Rows (n_rows x n_features).
+    """
+    rng = np.random.default_rng(random_state)
+    first = rng.integers(len(centroids), size=n_rows)
+    second = (first + rng.integers(1, len(centroids), size=n_rows)) % len(centroids)
+    midpoints = (centroids[first] + centroids[second]) / 2
+    return midpoints + rng.uniform(-epsilon, epsilon, midpoints.shape)
+
+
+_bundles = {}
+
+
+def get_bundle(path=BUNDLE_FILE, mmap=False):
+    """
+    Load a bundle once per process.
+
+    Parameters:
+    path (str): Path of the bundle file.
+    mmap (bool): Whether to memory-map the arrays on first load.
+
+    Returns:
+    ModelBundle: The cached bundle.
+    """
+    path = os.path.abspath(path)
+    if path not in _bundles:
+        _bundles[path] = ModelBundle.load(path, mmap=mmap)
+    return _bundles[path]
+
+
+def main():
+    from joblib import load
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scaler', default=os.path.join(MODEL_DIR, 'scaler_final_mi.joblib'))
+    parser.add_argument('--kmeans', default=os.path.join(MODEL_DIR, 'kmeans_model_final_df_mi.joblib'))
+    parser.add_argument('--spec', default=os.path.join(MODEL_DIR, 'feature_spec_final_mi.json'))
+    parser.add_argument('--descriptions', default=DESCRIPTIONS_FILE)
+    parser.add_argument('--version', default='final_mi-1')
+    parser.add_argument('--output', default=BUNDLE_FILE)
+    parser.add_argument('--check', metavar='CSV', default=None,
+                        help="Compare the bundle's labels with scikit-learn on the feature rows of a CSV, "
+                             "and on near-tie rows, instead of building")
+    args = parser.parse_args()
+
+    scaler, kmeans = load(args.scaler), load(args.kmeans)
+    if args.check:
+        bundle = ModelBundle.load(args.output, verify=True)
+        features = pd.read_csv(args.check)[bundle.spec.columns]
+        expected = kmeans.predict(scaler.transform(features))
+        labels = bundle.predict(features.to_numpy(dtype=np.float64))
+        print(f"{bundle}: {int((labels == expected).sum())} of {len(labels)} labels match scikit-learn")
+        ties = near_ties(bundle.centroids)
+        matches = int((bundle.assign(ties) == kmeans.predict(ties)).sum())
+        print(f"{matches} of {len(ties)} near-tie rows (midpoints of two centroids) match scikit-learn")
+        return
+
+    bundle = ModelBundle.from_models(scaler, kmeans, FeatureSpec.load(args.spec), pd.read_csv(args.descriptions), args.version)
+    bundle.save(args.output)
+    print(f"Wrote {bundle} to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
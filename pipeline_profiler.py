@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import uuid
+import cProfile
+import tracemalloc
+
+
+# Set to a file path to write stage spans there as JSON lines, e.g.
+#   US_CHARACTERIZER_PROFILE=profile.jsonl python ultrasonic_characterizer.py
+PROFILE_ENV = 'US_CHARACTERIZER_PROFILE'
+# Set to 1 to also capture a cProfile dump per top-level stage
+CPROFILE_ENV = 'US_CHARACTERIZER_CPROFILE'
+# Set to 1 to also record the tracemalloc peak of each stage
+TRACEMALLOC_ENV = 'US_CHARACTERIZER_TRACEMALLOC'
+
+_config = None
+
+
+class _NullSpan:
+    """Stand-in returned by `span` while profiling is disabled; every operation is a no-op."""
+
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, stage, fields):
+        self.stage = stage
+        self.fields = fields
+        self.rows = None
+
+    def __enter__(self):
+        self.depth = _config['depth']
+        _config['depth'] += 1
+        self.profiler = None
+        if _config['cprofile'] and self.depth == 0:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if _config['tracemalloc']:
+            # Resetting the peak would lose what the enclosing span measured so far: keep it on the stack
+            peaks = _config['peaks']
+            if peaks:
+                peaks[-1] = max(peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            peaks.append(0)
+        self.start = time.time()
+        self.start_counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        wall = time.perf_counter() - self.start_counter
+        _config['depth'] -= 1
+        record = {
+            'run_id': _config['run_id'],
+            'pid': os.getpid(),
+            'stage': self.stage,
+            'depth': self.depth,
+            'start': self.start,
+            'wall_s': wall,
+            'rows': self.rows,
+            'rss_mb': _rss_mb(),
+            'ok': exc_type is None,
+        }
+        if _config['tracemalloc']:
+            peaks = _config['peaks']
+            peak = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if peaks:
+                peaks[-1] = max(peaks[-1], peak)
+            record['tracemalloc_peak_mb'] = peak / 2 ** 20
+        if self.profiler is not None:
+            self.profiler.disable()
+            record['cprofile'] = f"{_config['output_path']}.{_config['run_id']}.{self.stage}.prof"
+            self.profiler.dump_stats(record['cprofile'])
+        record.update(self.fields)
+        _config['file'].write(json.dumps(record, default=str) + '\n')
+        _config['file'].flush()
+        return False
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return None
+
+
+def enable_profiling(output_path, cprofile=False, trace_memory=False):
+    """
+    Start writing one JSON line per pipeline stage to `output_path`.
+
+    Parameters:
+    output_path (str): JSON-lines file the spans are appended to.
+    cprofile (bool): Whether to dump a cProfile capture per top-level stage next to `output_path`.
+    trace_memory (bool): Whether to record the tracemalloc peak of each stage (slows allocation-heavy code).
+    """
+    global _config
+    disable_profiling()
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _config = {
+        'output_path': output_path,
+        'file': open(output_path, 'a'),
+        'run_id': uuid.uuid4().hex[:12],
+        'cprofile': cprofile,
+        'tracemalloc': trace_memory,
+        'started_tracing': started_tracing,  # Only stop tracing that the profiler started
+        'depth': 0,
+        'peaks': [],  # tracemalloc peak of each open span before its innermost open child started
+    }
+
+
+def disable_profiling():
+    """Stop profiling and close the span file."""
+    global _config
+    if _config is None:
+        return
+    _config['file'].close()
+    if _config['started_tracing']:
+        tracemalloc.stop()
+    _config = None
+
+
+def span(stage, **fields):
+    """
+    Time a pipeline stage. Set `rows` on the returned span to record how many rows it handled.
+
+    Example:
+        with span('parse', files=len(file_paths)) as s:
+            df = merge_csv_files(file_paths)
+            s.rows = len(df)
+
+    Parameters:
+    stage (str): Name of the stage.
+    **fields: Extra JSON-serializable values stored with the span.
+
+    Returns:
+    A context manager. While profiling is disabled this is a shared no-op object.
+    """
+    if _config is None:
+        return _NULL_SPAN
+    return _Span(stage, fields)
+
+
+if os.environ.get(PROFILE_ENV):
+    enable_profiling(
+        os.environ[PROFILE_ENV],
+        cprofile=os.environ.get(CPROFILE_ENV) == '1',
+        trace_memory=os.environ.get(TRACEMALLOC_ENV) == '1',
+    )
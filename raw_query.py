@@ -0,0 +1,155 @@
+"""
+Columnar queries over raw delay sequence rows.
+
+`RowIndex` sorts the rows once by (Sensor ID, Range (cm), Delay (us)) and keeps every column
+as a contiguous NumPy array. A query on sensors, ranges and delays is resolved to row slices
+with binary searches on the sorted key instead of scanning whole columns, and returns only
+the projected columns. A query that maps to a single slice (e.g. one sensor, or one sensor
+at one range) returns NumPy views without copying.
+
+`DatasetStore.query` applies the same predicates, plus dataset version and recording date,
+across the store: parts whose manifest entry cannot match are never read.
+
+Example:
+    rows = RowIndex(all_cleaned_df)
+    ping_times = rows.select(sensors=[5], delays=[3000], columns=['Ping Time (us)'])['Ping Time (us)']
+    df = rows.frame(sensors=cluster_sensors)
+"""
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ('Sensor ID', 'Range (cm)', 'Delay (us)')
+# Factor of each key level in the composite key, larger than any range (cm) or delay (us)
+KEY_FACTOR = 1 << 20
+
+
+def _values(values):
+    # None stays None (no predicate), scalars become one-element lists
+    if values is None:
+        return None
+    if np.isscalar(values):
+        return [values]
+    return list(values)
+
+
+class RowIndex:
+    """
+    Rows sorted by (Sensor ID, Range (cm), Delay (us)), stored column by column.
+
+    Parameters:
+    df (DataFrame): Raw rows with at least the key columns.
+    columns (list, optional): Columns to keep (projection at build time). Defaults to all.
+    """
+
+    def __init__(self, df, columns=None):
+        columns = list(df.columns) if columns is None else list(dict.fromkeys(list(KEY_COLUMNS) + list(columns)))
+        keys = [df[column].to_numpy(dtype=np.int64) for column in KEY_COLUMNS]
+        composite = (keys[0] * KEY_FACTOR + keys[1]) * KEY_FACTOR + keys[2]
+        order = np.argsort(composite, kind='stable')
+        self.key = composite[order]
+        self.columns = {column: df[column].to_numpy()[order] for column in columns}
+        self.distinct = {column: np.unique(self.columns[column]) for column in KEY_COLUMNS}
+
+    def __len__(self):
+        return len(self.key)
+
+    def slices(self, sensors=None, ranges=None, delays=None):
+        """
+        Row slices matching the predicates, in key order, adjacent slices merged.
+
+        Parameters:
+        sensors (list, optional): Sensor IDs. Defaults to all.
+        ranges (list, optional): Ranges in cm. Defaults to all.
+        delays (list, optional): Delays in us. Defaults to all.
+
+        Returns:
+        list: (start, stop) pairs.
+        """
+        levels = [_values(sensors), _values(ranges), _values(delays)]
+        # Trailing levels without a predicate are covered by a prefix of the key
+        depth = max((i + 1 for i, values in enumerate(levels) if values is not None), default=0)
+        if depth == 0:
+            return [(0, len(self.key))] if len(self.key) else []
+        grids = np.meshgrid(*[np.unique(np.asarray(levels[i] if levels[i] is not None else self.distinct[KEY_COLUMNS[i]],
+                                                   dtype=np.int64))
+                              for i in range(depth)], indexing='ij')
+        prefix = np.zeros(grids[0].size, dtype=np.int64)
+        for grid in grids:
+            prefix = prefix * KEY_FACTOR + grid.ravel()
+        span = KEY_FACTOR ** (3 - depth)
+        starts = np.searchsorted(self.key, prefix * span, side='left')
+        stops = np.searchsorted(self.key, (prefix + 1) * span, side='left')
+
+        merged = []
+        for start, stop in zip(starts[stops > starts], stops[stops > starts]):
+            if merged and merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], stop)
+            else:
+                merged.append((start, stop))
+        return merged
+
+    def select(self, sensors=None, ranges=None, delays=None, columns=None):
+        """
+        Columns of the rows matching the predicates.
+
+        Parameters:
+        sensors (list, optional): Sensor IDs. Defaults to all.
+        ranges (list, optional): Ranges in cm. Defaults to all.
+        delays (list, optional): Delays in us. Defaults to all.
+        columns (list, optional): Columns to return. Defaults to all kept columns.
+
+        Returns:
+        dict: Column name mapped to a NumPy array. The arrays are read-only views of the index
+              when the rows form a single slice, and copies otherwise.
+        """
+        columns = list(self.columns) if columns is None else list(columns)
+        slices = self.slices(sensors, ranges, delays)
+        if len(slices) == 1:
+            start, stop = slices[0]
+            result = {}
+            for column in columns:
+                view = self.columns[column][start:stop]
+                view.flags.writeable = False
+                result[column] = view
+            return result
+        if not slices:
+            return {column: self.columns[column][:0].copy() for column in columns}
+        rows = np.concatenate([np.arange(start, stop) for start, stop in slices])
+        return {column: self.columns[column][rows] for column in columns}
+
+    def frame(self, sensors=None, ranges=None, delays=None, columns=None):
+        """Rows matching the predicates as a DataFrame, in key order. See `select`."""
+        return pd.DataFrame(self.select(sensors, ranges, delays, columns))
+
+    def sensors(self, columns=None):
+        """
+        Iterate over the rows one sensor at a time, without scanning.
+
+        Parameters:
+        columns (list, optional): Columns to return. Defaults to all kept columns.
+
+        Yields:
+        tuple: (sensor ID, dict of column views).
+        """
+        if len(self.key) == 0:
+            return
+        columns = list(self.columns) if columns is None else list(columns)
+        sensor_keys = self.key // KEY_FACTOR ** 2
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(sensor_keys)) + 1, [len(sensor_keys)]])
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            yield self.columns['Sensor ID'][start], {column: self.columns[column][start:stop] for column in columns}
+
+
+def to_arrow(result):
+    """
+    Convert the output of `RowIndex.select` to an Arrow table. Requires pyarrow.
+
+    Parameters:
+    result (dict): Column name mapped to a NumPy array.
+
+    Returns:
+    pyarrow.Table: The table.
+    """
+    import pyarrow as pa
+
+    return pa.table({column: pa.array(values) for column, values in result.items()})
@@ -0,0 +1,99 @@
+"""
+Compact dtypes for the delay sequence rows.
+
+pandas reads every integer column of a recording as int64, every float as float64 and every
+string as an object or string column, about 330 bytes per row. `compact_dtypes` stores:
+- the columns bounded by the firmware with a fixed width, after checking their values
+  ('Range (cm)' uint8 up to MAX_DISTANCE, 'Delay (us)' and 'Ping Time (us)' uint16,
+  'Sensor ID' uint16),
+- the other integer columns with the narrowest integer type holding their values,
+- floats as float32,
+- strings as categoricals,
+which brings a row to about 60 bytes. Every frame of rows is read (`read_rows`) or built
+(`build_processed_dataset`, `DatasetStore`, `merge_csv_files`) through it.
+
+Integer columns are unsigned where possible: convert them (as the pipeline does with
+`to_numpy(dtype=...)`) before subtracting them from each other.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+# Limits of the recorded values, from the Arduino sketch
+# (`ultra_sonic_sensor/fully_automate/Automate_data_collection_v2`)
+MAX_DISTANCE_CM = 200  # MAX_DISTANCE of NewPing
+MAX_DELAY_US = 16800  # Longest delay between pings
+MAX_PING_TIME_US = 65535  # NewPing's echo time is 16-bit; 65535 is a capped reading
+
+# Columns with a fixed dtype, and the inclusive range of their values
+COLUMN_LIMITS = {
+    'Sensor ID': ('uint16', 0, np.iinfo(np.uint16).max),
+    'Range (cm)': ('uint8', 0, MAX_DISTANCE_CM),
+    'Delay (us)': ('uint16', 0, MAX_DELAY_US),
+    'Ping Time (us)': ('uint16', 0, MAX_PING_TIME_US),
+}
+
+INTEGER_DTYPES = ('uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'int64')
+
+
+def _narrowest_integer(values):
+    low, high = values.min(), values.max()
+    return next(dtype for dtype in INTEGER_DTYPES if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max)
+
+
+def compact_dtypes(df, validate=True):
+    """
+    Convert the columns of a frame of rows to compact dtypes.
+
+    Parameters:
+    df (DataFrame): Rows, e.g. as read from recordings.
+    validate (bool): Whether to check the columns of `COLUMN_LIMITS` against the firmware limits.
+
+    Returns:
+    DataFrame: A frame with the same values and compact dtypes.
+
+    Raises:
+    ValueError: If a column of `COLUMN_LIMITS` has missing values, or values outside its limits.
+    """
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if column in COLUMN_LIMITS and pd.api.types.is_numeric_dtype(values):
+            dtype, low, high = COLUMN_LIMITS[column]
+            if validate:
+                invalid = values.isna() | (values < low) | (values > high) | (values % 1 != 0)
+                if invalid.any():
+                    raise ValueError(f"{int(invalid.sum())} values of '{column}' are missing or outside the firmware "
+                                     f"limits [{low}, {high}], e.g. {values[invalid].iloc[0]}")
+            columns[column] = values.astype(dtype)
+        elif pd.api.types.is_bool_dtype(values) or isinstance(values.dtype, pd.CategoricalDtype):
+            columns[column] = values
+        elif pd.api.types.is_integer_dtype(values):
+            columns[column] = values.astype(_narrowest_integer(values)) if len(values) else values
+        elif pd.api.types.is_float_dtype(values):
+            columns[column] = values.astype('float32')
+        elif pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+            columns[column] = values.astype('category')
+        else:
+            columns[column] = values
+    return pd.DataFrame(columns, index=df.index)
+
+
+def read_rows(paths, **kwargs):
+    """
+    `pd.read_csv` of one or more files of rows, with compact dtypes (see `compact_dtypes`).
+
+    Several files are concatenated and compacted once: converting every small recording on its
+    own costs more than reading it.
+
+    Parameters:
+    paths (str or list): Path of a file, or paths of files to concatenate.
+    **kwargs: Passed to `pd.read_csv`.
+
+    Returns:
+    DataFrame: The rows, with a new range index when several files are read.
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        return compact_dtypes(pd.read_csv(paths, **kwargs))
+    return compact_dtypes(pd.concat([pd.read_csv(path, **kwargs) for path in paths], ignore_index=True))
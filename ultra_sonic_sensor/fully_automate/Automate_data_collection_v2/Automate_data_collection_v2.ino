@@ -116,12 +116,38 @@ void collectSamples() {
     unsigned long pingDuration = endTime - startTime;
     sampleTimes[i] = pingDuration;
   }
-  printSamples();
+  printSamples(numSamples);
   Serial.println("Sample collection complete.");
 }
 
-void printSamples() {
-  for (int i = 0; i < numSamples; i++) {
+// Collect a batch of samples at the current delay, used by the host's adaptive sampling mode
+void collectBatch(int batchSize) {
+  if (batchSize <= 0 || batchSize > numSamples) {
+    Serial.println("Invalid batch size.");
+    return;
+  }
+  memset(sampleTimes, 0, sizeof(sampleTimes));
+
+  for (int i = 0; i < batchSize; i++) {
+    unsigned long startTime = micros();
+    unsigned long uS = sonar.ping(); // Send ping, get ping time in microseconds (uS).
+
+    samples[i] = (double)uS;
+
+    if (delayInMicroseconds) {
+      delayMicroseconds(delayBetweenPings); // Delay in microseconds
+    } else {
+      delay(delayBetweenPings); // Delay in milliseconds
+    }
+    unsigned long endTime = micros();
+    sampleTimes[i] = endTime - startTime;
+  }
+  printSamples(batchSize);
+  Serial.println("Sample collection complete.");
+}
+
+void printSamples(int count) {
+  for (int i = 0; i < count; i++) {
     Serial.print(i);
     Serial.print(",");
     Serial.print(sampleTimes[i]);
@@ -265,6 +291,8 @@ void processCommand(String command) {
     else if (command.startsWith("D")) {
       unsigned long delay = command.substring(1).toInt();
       updateDelay(delay);
+    } else if (command.startsWith("B")) { // adaptive sampling batch
+      collectBatch(command.substring(1).toInt());
     } else {
       char directionChar = command[0];
       float rotations = command.substring(1).toFloat();
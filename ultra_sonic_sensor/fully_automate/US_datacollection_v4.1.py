@@ -1,14 +1,17 @@
-import serial
+import sys
 import time
 import csv
 import datetime
 import os
 
-# Set up the serial connection (adjust '/dev/cu.usbserial-120' to your specific port)
-ser = serial.Serial('/dev/cu.usbserial-10', 9600, timeout=1)
+from adaptive_sampling import CellEstimator, tolerances_from_scaler
+from capture_log import CaptureLog, find_interrupted, recover, remaining_delays, write_output
 
-# Give the connection a second to settle
-time.sleep(2)
+# Serial connection to the Arduino, opened when the script is run
+ser = None
+
+# Folder the recordings (and their capture logs) are written to
+DATA_DIR = "ultra_sonic_sensor/fully_automate/data_v4"
 
 # Function to prompt user for metadata
 def get_user_defined_metadata():
@@ -35,31 +38,50 @@ def get_user_defined_metadata():
 # Function to automatically generate filename for sequence recording
 def generate_sequence_filename(metadata):
     current_date = datetime.datetime.now().strftime("%H_%M_%S_%d%m%Y")
-    return f"ultra_sonic_sensor/fully_automate/data_v4/test_seq_ard{metadata['Arduino ID']}_sensor{metadata['Sensor ID']}_{current_date}.csv"
+    return f"{DATA_DIR}/test_seq_ard{metadata['Arduino ID']}_sensor{metadata['Sensor ID']}_{current_date}.csv"
 
 def generate_delay_sequence_filename(metadata):
     current_date = datetime.datetime.now().strftime("%H_%M_%S_%d%m%Y")
-    return f"ultra_sonic_sensor/fully_automate/data_v4/test_delay_seq_ard{metadata['Arduino ID']}_sensor{metadata['Sensor ID']}_range{metadata['Range (cm)']}_{current_date}.csv"
+    return f"{DATA_DIR}/test_delay_seq_ard{metadata['Arduino ID']}_sensor{metadata['Sensor ID']}_range{metadata['Range (cm)']}_{current_date}.csv"
+
+# Columns of the recorded CSV files
+FIELDNAMES = [
+    'Trial', 'Ping Duration', 'Distance (cm)', 'Ping Time (us)', 'Delay (us)','Steps',
+    'Arduino ID', 'Sensor ID', 'Range (cm)', 'Sensor length (cm)', 'Color of sensor', 
+    'Angle on XY plane', 'side a (cm)', 'side b (cm)', 'side c (cm)', 
+    'Angle on YZ plane', 'Sensor Configuration', 'Sensor Angle', 
+    'Surface material', 'Surface Length (cm)', 'Surface Width (cm)'
+]
+
+# Delays and samples per delay of the delay sequence, as recorded in data_v4.1.1
+DELAY_SEQUENCE = [16800, 10000, 8000, 6000, 3000]
+SAMPLES_PER_BLOCK = 50
+# Consecutive batches without samples (firmware error, timed-out read) after which the adaptive sequence gives up on a delay
+MAX_EMPTY_BATCHES = 3
+
 
 # Function to record data
-def record_data(metadata, output_file):
+# `device` defaults to the Arduino connection; pass a serial_replay.ReplaySerial to run without hardware
+# Rows are also pushed to `accumulator` (e.g. live_characterizer.LiveCharacterizer); its result is returned
+# With a `capture_log` (capture_log.CaptureLog) every row is logged and each delay block checkpointed,
+# so an interrupted sequence can be finished with `resume_sequence`
+def record_data(metadata, output_file, device=None, settle_time=3, accumulator=None, capture_log=None):
+    device = device or ser
+    result = None
+    block_delay = None
     with open(output_file, 'w', newline='') as csvfile:
-        fieldnames = [
-            'Trial', 'Ping Duration', 'Distance (cm)', 'Ping Time (us)', 'Delay (us)','Steps',
-            'Arduino ID', 'Sensor ID', 'Range (cm)', 'Sensor length (cm)', 'Color of sensor', 
-            'Angle on XY plane', 'side a (cm)', 'side b (cm)', 'side c (cm)', 
-            'Angle on YZ plane', 'Sensor Configuration', 'Sensor Angle', 
-            'Surface material', 'Surface Length (cm)', 'Surface Width (cm)'
-        ]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
         writer.writeheader()
 
         while True:
-            line = ser.readline().decode('utf-8').strip()
+            line = device.readline().decode('utf-8').strip()
             if line:
                 print(line)
                 if line == "Sample collection complete.":
-                    time.sleep(3)
+                    if capture_log is not None and block_delay is not None:
+                        capture_log.checkpoint(block_delay)
+                        block_delay = None
+                    time.sleep(settle_time)
                 data = line.split(',')
                 if len(data) == 7:  # Ensure we have all the parts of the data
                     row = {
@@ -72,10 +94,134 @@ def record_data(metadata, output_file):
                     }
                     row.update(metadata)
                     writer.writerow(row)
+                    if capture_log is not None:
+                        capture_log.append_row(row)
+                        block_delay = data[6]
+                    if accumulator is not None:
+                        result = accumulator.add_row(row) or result
             else:
                 break
+    if capture_log is not None:
+        capture_log.complete()
+    return result
+
+
+# Function to read the sample lines of one batch ("B<n>") up to the completion marker
+def read_batch(device):
+    samples = []
+    while True:
+        line = device.readline().decode('utf-8').strip()
+        if not line or line == "Sample collection complete.":
+            return samples
+        data = line.split(',')
+        if len(data) == 7:  # Ensure we have all the parts of the data
+            samples.append(data)
+
+
+# Function to finish a delay sequence interrupted mid-way from its capture log: the completed blocks are
+# kept, the remaining delays are recorded with "D<delay>"/"B<n>" and the output CSV is rebuilt from the log
+def resume_sequence(log_path, device=None):
+    device = device or ser
+    recovered = recover(log_path)
+    session = recovered['session']
+    samples_per_block = session['samples_per_block'] or next(
+        (len(rows) for rows in recovered['blocks'].values() if rows), SAMPLES_PER_BLOCK)
+    delays = remaining_delays(recovered)
+    print(f"Resuming {session['output_file']}: {len(recovered['blocks'])} blocks done, "
+          f"{recovered['discarded_rows']} rows of an unfinished block discarded, delays left: {delays}")
+
+    if hasattr(device, 'reset_input_buffer'):
+        device.reset_input_buffer()  # Drop what the firmware sent after the crash
+    capture_log = CaptureLog(log_path)
+    device.write(b'U\n')
+    device.readline()
+    for delay in delays:
+        device.write(f"D{delay}\n".encode())
+        device.readline()
+        trial = 0
+        while trial < samples_per_block:
+            device.write(f"B{min(samples_per_block - trial, 100)}\n".encode())  # The firmware buffers 100 samples
+            batch = read_batch(device)
+            if not batch:
+                break
+            for data in batch:
+                row = {
+                    'Trial': str(trial),
+                    'Ping Duration': data[1],
+                    'Distance (cm)': data[2],
+                    'Ping Time (us)': data[3],
+                    'Steps': data[5],
+                    'Delay (us)': data[6],
+                }
+                row.update(session['metadata'])
+                capture_log.append_row(row)
+                trial += 1
+        capture_log.checkpoint(delay)
+
+    output_file = write_output(recover(log_path))
+    capture_log.complete()
+    capture_log.close()
+    os.remove(log_path)
+    return output_file
             
 
+# Function to record the delay sequence adaptively: each delay used by the model for this range is sampled
+# in batches of `batch_size` until the confidence interval of its middle-quartile mean is within the
+# cell's tolerance (see adaptive_sampling.py). Returns a per-delay summary.
+def record_adaptive_data(metadata, output_file, tolerances, device=None, batch_size=10, min_samples=20,
+                         max_samples=100, confidence=0.95, verbose=True):
+    device = device or ser
+    range_cm = int(float(metadata['Range (cm)']))
+    delays = sorted((delay for cell_range, delay in tolerances if cell_range == range_cm), reverse=True)
+    if not delays:
+        print(f"Range {range_cm} cm is not used by the model, nothing to collect.")
+        return {}
+
+    summary = {}
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+        writer.writeheader()
+
+        device.write(b'U\n')
+        device.readline()
+        for delay in delays:
+            device.write(f"D{delay}\n".encode())
+            device.readline()
+            estimator = CellEstimator(tolerances[(range_cm, delay)], min_samples, max_samples, confidence)
+            bench_time_us = 0
+            empty_batches = 0
+            while not estimator.done():
+                requested = min(batch_size, max_samples - len(estimator.ping_times))
+                device.write(f"B{requested}\n".encode())
+                batch = read_batch(device)
+                for data in batch:
+                    row = {
+                        'Trial': len(estimator.ping_times),
+                        'Ping Duration': data[1],
+                        'Distance (cm)': data[2],
+                        'Ping Time (us)': data[3],
+                        'Steps': data[5],
+                        'Delay (us)': data[6],
+                    }
+                    row.update(metadata)
+                    writer.writerow(row)
+                    estimator.add(float(data[3]))
+                    bench_time_us += int(data[1])
+                # A short or empty batch (e.g. "Invalid batch size." or a timed-out read) is requested again,
+                # until the device has sent no samples for this delay MAX_EMPTY_BATCHES times in a row
+                empty_batches = 0 if batch else empty_batches + 1
+                if empty_batches == MAX_EMPTY_BATCHES:
+                    break
+
+            mean, half_width = estimator.estimate()
+            summary[delay] = {'samples': len(estimator.ping_times), 'mean': mean, 'half_width': half_width,
+                              'converged': estimator.converged(), 'bench_time_s': bench_time_us / 1e6}
+            if verbose:
+                print(f"\t>>> Delay {delay} us: {len(estimator.ping_times)} samples, "
+                      f"mean {mean:.1f} +/- {half_width:.1f} us (tolerance {tolerances[(range_cm, delay)]:.1f} us)")
+    return summary
+
+
 # Function to send commands to the Arduino
 def send_command(command):
     ser.write((command + '\n').encode())
@@ -88,52 +234,94 @@ def rotate_stepper():
     send_command(command)
     print(f"Rotation command '{command}' sent.")
 
-try:
-    print(f"\n==================={os.path.basename(__file__)}===================")
-    print("CAUTION: For Millisecond delay try not to go over 20ms data may not recorded.")
-    print("CAUTION: Microsecond max is 16800.")
-    while True:
-        lines = ser.readlines()
-        for line in lines:
-            print("\t>>> "+line.decode('utf-8').strip())
-
-        user_input = input("Enter 'M' to set delay in milliseconds, 'U' to set delay in microseconds, 'S' to run sequence, 'T' to rotate stepper motor, 'reset' to reset stepper motor, or 'q' to quit: ")
-        if user_input.lower() == 'q':
-            break
-        elif user_input in ['M', 'U', 'S', 'T','P', 'reset']:
-            send_command(user_input)
-            if user_input in ['M', 'U']:
-                delay_value = input(f"Enter the delay value in {'milliseconds' if user_input == 'M' else 'microseconds'}: ")
-                send_command(f"D{delay_value}")
-                lines = ser.readlines()
-                for line in lines:
-                    print("\t>>> "+line.decode('utf-8').strip())
-            elif user_input.lower() == 's':
-                metadata = get_user_defined_metadata()
-                filename = generate_sequence_filename(metadata)
-                send_command("run")
-                record_data(metadata, filename)
-                print("Motor Sequence complete. Data recorded.")
-            elif user_input.lower() == 'p':
+if __name__ == '__main__':
+    # Set up the serial connection (adjust '/dev/cu.usbserial-10' to your specific port, or pass it as the first argument)
+    import serial
+
+    port = sys.argv[1] if len(sys.argv) > 1 else '/dev/cu.usbserial-10'
+    ser = serial.Serial(port, 9600, timeout=1)
+
+    # Give the connection a second to settle
+    time.sleep(2)
+
+    # Characterize each sensor as soon as its ranges 13, 18 and 23 are recorded
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    from live_characterizer import LiveCharacterizer
+    characterizer = LiveCharacterizer()
+    # Per-cell tolerances of the adaptive delay sequence, loaded on first use
+    tolerances = None
+
+    try:
+        print(f"\n==================={os.path.basename(__file__)}===================")
+        print("CAUTION: For Millisecond delay try not to go over 20ms data may not recorded.")
+        print("CAUTION: Microsecond max is 16800.")
+        interrupted = find_interrupted(DATA_DIR) if os.path.isdir(DATA_DIR) else []
+        if interrupted:
+            print(f"{len(interrupted)} interrupted delay sequence(s) found, enter 'R' to resume them.")
+        while True:
+            lines = ser.readlines()
+            for line in lines:
+                print("\t>>> "+line.decode('utf-8').strip())
+
+            user_input = input("Enter 'M' to set delay in milliseconds, 'U' to set delay in microseconds, 'S' to run sequence, 'T' to rotate stepper motor, 'P' to run delay sequence, 'A' to run adaptive delay sequence, 'R' to resume an interrupted delay sequence, 'reset' to reset stepper motor, or 'q' to quit: ")
+            if user_input.lower() == 'q':
+                break
+            elif user_input == 'R':
+                for log_path in find_interrupted(DATA_DIR):
+                    if input(f"Resume {log_path}? (y/n): ").strip().lower() == 'y':
+                        print(f"Delay Sequence complete. Data recorded in {resume_sequence(log_path)}.")
+            elif user_input == 'A':
                 metadata = get_user_defined_metadata()
                 filename = generate_delay_sequence_filename(metadata)
-                #send_command("p")
-                record_data(metadata, filename)
-                print("Delay Sequence complete. Data recorded.")
-            elif user_input.lower() == 't':
-                rotate_stepper()
-                lines = ser.readlines()
-                for line in lines:
-                    print("\t>>> "+line.decode('utf-8').strip())
-            elif user_input.lower() == 'reset':
-                send_command("reset")
-                lines = ser.readlines()
-                for line in lines:
-                    print("\t>>> "+line.decode('utf-8').strip())
-                print("Stepper motor reset.")
-        else:
-            print("Invalid command")
-except KeyboardInterrupt:
-    print("Exiting...")
-finally:
-    ser.close()
+                tolerances = tolerances or tolerances_from_scaler()
+                record_adaptive_data(metadata, filename, tolerances)
+                print("Adaptive Delay Sequence complete. Data recorded.")
+            elif user_input in ['M', 'U', 'S', 'T','P', 'reset']:
+                send_command(user_input)
+                if user_input in ['M', 'U']:
+                    delay_value = input(f"Enter the delay value in {'milliseconds' if user_input == 'M' else 'microseconds'}: ")
+                    send_command(f"D{delay_value}")
+                    lines = ser.readlines()
+                    for line in lines:
+                        print("\t>>> "+line.decode('utf-8').strip())
+                elif user_input.lower() == 's':
+                    metadata = get_user_defined_metadata()
+                    filename = generate_sequence_filename(metadata)
+                    send_command("run")
+                    record_data(metadata, filename)
+                    print("Motor Sequence complete. Data recorded.")
+                elif user_input.lower() == 'p':
+                    metadata = get_user_defined_metadata()
+                    filename = generate_delay_sequence_filename(metadata)
+                    #send_command("p")
+                    capture_log = CaptureLog.create(filename, metadata, FIELDNAMES, DELAY_SEQUENCE)
+                    result = record_data(metadata, filename, accumulator=characterizer, capture_log=capture_log)
+                    capture_log.close()
+                    os.remove(capture_log.path)
+                    print("Delay Sequence complete. Data recorded.")
+                    if result is not None:
+                        print(f"\t>>> Sensor {result['Sensor ID']} characterized: cluster {result['cluster']}, "
+                              f"{result['Refined Category']} ({result['Edge Case Sensitivity']}), "
+                              f"confidence {result['confidence']:.2f}")
+                        if result['retest']:
+                            print(f"\t>>> Borderline between clusters {result['cluster']} and {result['second_cluster']}: "
+                                  "re-test this sensor.")
+                        elif result['stop']:
+                            print("\t>>> The remaining ranges of this sensor can be skipped.")
+                elif user_input.lower() == 't':
+                    rotate_stepper()
+                    lines = ser.readlines()
+                    for line in lines:
+                        print("\t>>> "+line.decode('utf-8').strip())
+                elif user_input.lower() == 'reset':
+                    send_command("reset")
+                    lines = ser.readlines()
+                    for line in lines:
+                        print("\t>>> "+line.decode('utf-8').strip())
+                    print("Stepper motor reset.")
+            else:
+                print("Invalid command")
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        ser.close()
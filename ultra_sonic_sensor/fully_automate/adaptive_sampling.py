@@ -0,0 +1,188 @@
+"""
+Sequential sampling rules for the adaptive delay sequence of `US_datacollection_v4.1.py`.
+
+Instead of a fixed number of trials per (range, delay), the host requests small batches
+("B<n>") and stops once the confidence interval of the cell's middle-quartile mean (the
+statistic the model features are built from) is tighter than the cell's tolerance. Only
+the (range, delay) cells used by the classifier are sampled.
+
+Tolerances are a fraction of the standard deviation the pre-trained scaler divides each
+feature by, so the stopping rule bounds the error of the standardized features.
+
+Usage (from ultra_sonic_sensor/fully_automate), to evaluate the rule on recorded runs:
+    python adaptive_sampling.py data_v4.1.1 --fraction 0.05 --max-files 60
+"""
+import os
+import csv
+import math
+import argparse
+import tempfile
+from statistics import NormalDist
+
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(os.path.dirname(script_dir))
+SCALER_FILE = os.path.join(repo_dir, 'Analysis', 'Delay_sequence_data', 'best_models', 'final', 'scaler_final_mi.joblib')
+
+
+def middle_quartile_mean(ping_times, confidence=0.95):
+    """
+    Mean of the ping times within 1.5 IQR of the quartiles and its confidence interval half-width.
+
+    Uses the same outlier rule as `identify_and_remove_outliers` in `ultrasonic_characterizer.py`.
+
+    Parameters:
+    ping_times (array-like): Ping times of one (range, delay) cell.
+    confidence (float): Confidence level of the interval.
+
+    Returns:
+    tuple: (mean, half_width). The mean is NaN without samples and the half-width is infinite
+           with fewer than two samples kept.
+    """
+    ping_times = np.asarray(ping_times, dtype=float)
+    if len(ping_times) < 2:
+        return float(ping_times.mean()) if len(ping_times) else math.nan, math.inf
+    q1, q3 = np.percentile(ping_times, [25, 75])
+    iqr = q3 - q1
+    kept = ping_times[(ping_times >= q1 - 1.5 * iqr) & (ping_times <= q3 + 1.5 * iqr)]
+    if len(kept) < 2:
+        return float(kept.mean()) if len(kept) else math.nan, math.inf
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    return float(kept.mean()), float(z * kept.std(ddof=1) / math.sqrt(len(kept)))
+
+
+class CellEstimator:
+    """
+    Running estimate of one (range, delay) cell with a sequential stopping rule.
+
+    Parameters:
+    tolerance (float): Largest acceptable confidence interval half-width, in microseconds.
+    min_samples (int): Samples always collected before the rule is checked.
+    max_samples (int): Samples after which sampling stops regardless of convergence.
+    confidence (float): Confidence level of the interval.
+    """
+
+    def __init__(self, tolerance, min_samples=20, max_samples=100, confidence=0.95):
+        self.tolerance = tolerance
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.confidence = confidence
+        self.ping_times = []
+
+    def add(self, ping_time):
+        self.ping_times.append(ping_time)
+
+    def estimate(self):
+        return middle_quartile_mean(self.ping_times, self.confidence)
+
+    def converged(self):
+        if len(self.ping_times) < self.min_samples:
+            return False
+        return self.estimate()[1] <= self.tolerance
+
+    def done(self):
+        return len(self.ping_times) >= self.max_samples or self.converged()
+
+
+def tolerances_from_scaler(fraction=0.05, scaler_file=SCALER_FILE):
+    """
+    Derive per-cell tolerances from the pre-trained scaler.
+
+    Parameters:
+    fraction (float): Tolerance as a fraction of each feature's standard deviation.
+    scaler_file (str): Path of the fitted StandardScaler.
+
+    Returns:
+    dict: (range_cm, delay_us) mapped to the tolerance in microseconds, for the cells used by the model.
+    """
+    from joblib import load
+
+    scaler = load(scaler_file)
+    return {
+        tuple(int(value) for value in name.split('_')[:2]): fraction * scale
+        for name, scale in zip(scaler.feature_names_in_, scaler.scale_)
+    }
+
+
+def evaluate_against_replay(csv_files, tolerances, **sampling_args):
+    """
+    Replay recorded runs through the adaptive sequence and compare it with the fixed protocol.
+
+    Parameters:
+    csv_files (list): Recorded CSVs, one range of one sensor each.
+    tolerances (dict): Output of `tolerances_from_scaler`.
+    **sampling_args: Passed to `record_adaptive_data` (batch_size, min_samples, max_samples, confidence).
+
+    Returns:
+    dict: Samples and bench time (sum of ping durations) of the fixed protocol, of the fixed
+          protocol restricted to the cells used by the model, and of the adaptive one, and the error of
+          the adaptive cell means against the means of all recorded samples, in tolerances.
+    """
+    from serial_replay import ReplaySerial, load_acquisition_module
+
+    acquisition = load_acquisition_module()
+    output_dir = tempfile.mkdtemp(prefix='adaptive_sampling_')
+    fixed_samples = fixed_time = model_cell_samples = model_cell_time = adaptive_samples = adaptive_time = 0
+    errors = []
+    for i, csv_file in enumerate(csv_files):
+        with open(csv_file, newline='') as f:
+            rows = list(csv.DictReader(f))
+        fixed_samples += len(rows)
+        fixed_time += sum(int(row['Ping Duration']) for row in rows) / 1e6
+        range_cm = int(float(rows[0]['Range (cm)']))
+        model_rows = [row for row in rows if (range_cm, int(row['Delay (us)'])) in tolerances]
+        if not model_rows:
+            continue
+        model_cell_samples += len(model_rows)
+        model_cell_time += sum(int(row['Ping Duration']) for row in model_rows) / 1e6
+
+        device = ReplaySerial([csv_file], speedup=0, timeout=0.01)
+        device.load_next_file()
+        metadata = {'Sensor ID': rows[0]['Sensor ID'], 'Range (cm)': rows[0]['Range (cm)']}
+        summary = acquisition.record_adaptive_data(metadata, os.path.join(output_dir, f"{i}.csv"), tolerances,
+                                                   device=device, verbose=False, **sampling_args)
+        for delay, cell in summary.items():
+            adaptive_samples += cell['samples']
+            adaptive_time += cell['bench_time_s']
+            reference = [float(row['Ping Time (us)']) for row in rows if int(row['Delay (us)']) == delay]
+            if reference and cell['samples']:
+                errors.append(abs(cell['mean'] - middle_quartile_mean(reference)[0]) / tolerances[(range_cm, delay)])
+
+    errors = np.array(errors)
+    return {
+        'files': len(csv_files),
+        'cells': len(errors),
+        'fixed_samples': fixed_samples,
+        'adaptive_samples': adaptive_samples,
+        'fixed_bench_time_s': fixed_time,
+        'fixed_model_cell_samples': model_cell_samples,
+        'fixed_model_cell_bench_time_s': model_cell_time,
+        'adaptive_bench_time_s': adaptive_time,
+        'error_mean_tolerances': float(errors.mean()) if len(errors) else None,
+        'error_p95_tolerances': float(np.percentile(errors, 95)) if len(errors) else None,
+        'within_tolerance': float((errors <= 1).mean()) if len(errors) else None,
+    }
+
+
+def main():
+    from serial_replay import find_csv_files
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='CSV file or folder of recorded runs')
+    parser.add_argument('--fraction', type=float, default=0.05, help='Tolerance as a fraction of the feature standard deviation')
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--min-samples', type=int, default=20)
+    parser.add_argument('--max-samples', type=int, default=100)
+    parser.add_argument('--max-files', type=int, default=None)
+    args = parser.parse_args()
+
+    results = evaluate_against_replay(find_csv_files(args.path)[:args.max_files], tolerances_from_scaler(args.fraction),
+                                      batch_size=args.batch_size, min_samples=args.min_samples,
+                                      max_samples=args.max_samples)
+    for key, value in results.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == '__main__':
+    main()
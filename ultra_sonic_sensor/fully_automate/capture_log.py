@@ -0,0 +1,186 @@
+"""
+Append-only capture log (write-ahead log) of a delay sequence recording.
+
+Every recorded row is appended to `<output file>.wal` as a JSON line before it is used,
+and a checkpoint record is appended after each completed (range, delay) block. The log
+is fsynced every `fsync_every` rows and at every checkpoint. Only rows followed by a
+checkpoint are trusted on recovery. If the acquisition script dies mid-sequence, the
+sequence can be resumed from the last completed block and the final CSV rebuilt from
+the log.
+
+Record types:
+    {"type": "session", "output_file", "metadata", "fieldnames", "delays", "samples_per_block"}
+    {"type": "row", "row": {...}}
+    {"type": "checkpoint", "delay": 16800, "rows": 50}
+    {"type": "complete"}
+"""
+import os
+import csv
+import glob
+import json
+
+WAL_SUFFIX = '.wal'
+
+
+class CaptureLog:
+    """
+    Writer of a capture log.
+
+    Parameters:
+    path (str): Path of the log file. Records are appended to it.
+    fsync_every (int): Number of rows between two fsyncs. Checkpoints are always fsynced.
+    """
+
+    def __init__(self, path, fsync_every=100):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.file = open(path, 'a')
+        # Terminate a line torn by a crash so the records appended on resume stay readable
+        if self.file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+        self.unsynced_rows = 0
+        self.block_rows = 0
+
+    @classmethod
+    def create(cls, output_file, metadata, fieldnames, delays, samples_per_block=None, fsync_every=100):
+        """
+        Start the log of a new recording next to its output file.
+
+        Parameters:
+        output_file (str): The CSV the recording ends up in.
+        metadata (dict): The sensor metadata written with every row.
+        fieldnames (list): Columns of the output CSV.
+        delays (list): Delays of the sequence, in recording order.
+        samples_per_block (int, optional): Samples per delay block, if known in advance.
+        fsync_every (int): Number of rows between two fsyncs.
+
+        Returns:
+        CaptureLog: The open log.
+        """
+        log = cls(output_file + WAL_SUFFIX, fsync_every)
+        log._write({'type': 'session', 'output_file': output_file, 'metadata': metadata, 'fieldnames': fieldnames,
+                    'delays': delays, 'samples_per_block': samples_per_block})
+        log.sync()
+        return log
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced_rows = 0
+
+    def append_row(self, row):
+        self._write({'type': 'row', 'row': row})
+        self.block_rows += 1
+        self.unsynced_rows += 1
+        if self.unsynced_rows >= self.fsync_every:
+            self.sync()
+
+    def checkpoint(self, delay):
+        """Mark the rows appended since the previous checkpoint as the completed block of `delay`."""
+        self._write({'type': 'checkpoint', 'delay': int(delay), 'rows': self.block_rows})
+        self.sync()
+        self.block_rows = 0
+
+    def complete(self):
+        self._write({'type': 'complete'})
+        self.sync()
+
+    def close(self):
+        self.file.close()
+
+
+def recover(path):
+    """
+    Read a capture log back, keeping only the blocks closed by a checkpoint.
+
+    Lines torn by a crash are skipped.
+
+    Parameters:
+    path (str): Path of the log file.
+
+    Returns:
+    dict: 'session' (the session record), 'blocks' (delay mapped to its rows, in recording
+          order), 'complete' (whether the recording finished) and 'discarded_rows' (rows of
+          the unfinished block).
+    """
+    session, blocks, pending, complete = None, {}, [], False
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record['type'] == 'session':
+                session = record
+            elif record['type'] == 'row':
+                pending.append(record['row'])
+            elif record['type'] == 'checkpoint':
+                blocks[record['delay']] = pending[-record['rows']:] if record['rows'] else []
+                pending = []
+            elif record['type'] == 'complete':
+                complete = True
+    return {'session': session, 'blocks': blocks, 'complete': complete, 'discarded_rows': len(pending)}
+
+
+def remaining_delays(recovered):
+    """
+    Delays of the sequence that have no completed block yet.
+
+    Parameters:
+    recovered (dict): Output of `recover`.
+
+    Returns:
+    list: Delays still to record, in sequence order.
+    """
+    return [delay for delay in recovered['session']['delays'] if delay not in recovered['blocks']]
+
+
+def write_output(recovered, output_file=None):
+    """
+    Rebuild the output CSV from the completed blocks of a capture log.
+
+    The file is written next to its destination and renamed into place, so a crash never
+    leaves a half-written CSV behind.
+
+    Parameters:
+    recovered (dict): Output of `recover`.
+    output_file (str, optional): Destination. Defaults to the output file of the session.
+
+    Returns:
+    str: The path of the written CSV.
+    """
+    session = recovered['session']
+    output_file = output_file or session['output_file']
+    # Blocks recorded outside the planned sequence are kept after it
+    delays = [delay for delay in session['delays'] if delay in recovered['blocks']]
+    delays += [delay for delay in recovered['blocks'] if delay not in delays]
+
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=session['fieldnames'])
+        writer.writeheader()
+        for delay in delays:
+            writer.writerows(recovered['blocks'][delay])
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    os.replace(tmp_file, output_file)
+    return output_file
+
+
+def find_interrupted(directory):
+    """
+    List the capture logs of recordings that did not finish.
+
+    Parameters:
+    directory (str): Folder searched for `*.wal` files.
+
+    Returns:
+    list: Paths of the logs without a completion record.
+    """
+    return [path for path in sorted(glob.glob(os.path.join(directory, '*' + WAL_SUFFIX))) if not recover(path)['complete']]
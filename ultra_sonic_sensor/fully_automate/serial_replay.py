@@ -0,0 +1,335 @@
+"""
+Software stand-in for the Arduino running `Automate_data_collection_v2.ino`.
+
+Replays recorded `data_v4.1.1` CSVs as the firmware's serial output: one
+`trial,pingDuration,distance,pingTime,range,steps,delay` line per sample and a
+"Sample collection complete." marker after each delay block. The replay can be
+paced like the real device (sample collection time plus serial transmission time
+at the given baud rate), accelerated by a speedup factor, or unpaced.
+
+Two transports are provided:
+- `ReplaySerial`, an in-memory object with the subset of the `serial.Serial` API
+  used by `US_datacollection_v4.1.py` (readline, readlines, write, close).
+- `serve_pty`, which exposes the replay on a pseudo terminal so the acquisition
+  script can open it as a regular port.
+
+Usage (from ultra_sonic_sensor/fully_automate):
+    python serial_replay.py data_v4.1.1/sensor1 --speedup 10
+    python serial_replay.py data_v4.1.1 --benchmark --speedup 0
+"""
+import os
+import sys
+import csv
+import glob
+import time
+import argparse
+import itertools
+import tempfile
+import contextlib
+import importlib.util
+from collections import deque
+
+COMPLETE_MARKER = "Sample collection complete."
+
+# 1 start bit + 8 data bits + 1 stop bit per byte
+BITS_PER_BYTE = 10
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def find_csv_files(path):
+    """
+    Collect the CSV files to replay.
+
+    Parameters:
+    path (str): A CSV file or a folder searched recursively for CSV files.
+
+    Returns:
+    list: Sorted CSV file paths.
+    """
+    if os.path.isfile(path):
+        return [path]
+    return sorted(glob.glob(os.path.join(path, '**', '*.csv'), recursive=True))
+
+
+def read_delay_samples(csv_path):
+    """
+    Rebuild the firmware's serial sample lines of one recorded delay sequence, per delay.
+
+    Parameters:
+    csv_path (str): A CSV written by `record_data`.
+
+    Returns:
+    dict: Delay (us) mapped to a list of (ping_duration_us, line) tuples in recording order.
+    """
+    samples = {}
+    with open(csv_path, newline='') as f:
+        for row in csv.DictReader(f):
+            # The firmware prints the range as a float with two decimals
+            range_cm = f"{float(row['Range (cm)']):.2f}"
+            line = ','.join([row['Trial'], row['Ping Duration'], row['Distance (cm)'], row['Ping Time (us)'],
+                             range_cm, row['Steps'], row['Delay (us)']])
+            samples.setdefault(int(row['Delay (us)']), []).append((int(row['Ping Duration']), line))
+    return samples
+
+
+def read_delay_blocks(csv_path):
+    """
+    Rebuild the firmware's serial output of one recorded delay sequence.
+
+    Parameters:
+    csv_path (str): A CSV written by `record_data`.
+
+    Returns:
+    list: One (collection_time_s, lines) tuple per delay block, where `collection_time_s`
+          is how long the firmware spent pinging before printing the block and `lines`
+          are the serial lines it printed, marker included.
+    """
+    return [
+        (sum(duration for duration, _ in samples) / 1e6, [line for _, line in samples] + [COMPLETE_MARKER])
+        for samples in read_delay_samples(csv_path).values()
+    ]
+
+
+class ReplaySerial:
+    """
+    In-memory serial device that replays recorded CSVs like the data collection firmware.
+
+    Each "P" command written to the device starts the delay sequence of the next CSV.
+    With `autostart=True` every CSV is queued right away instead. "B<n>" sends the next
+    n recorded samples of the delay set with "D<delay>", from the CSV loaded with
+    `load_next_file` (the next one by default). The other firmware commands
+    (M, U, reset, run) are acknowledged with the firmware's replies.
+
+    Lines become readable when the simulated device would have finished sending them.
+    `latencies` keeps, for every line read, the seconds between the line becoming
+    available and the host reading it, and `max_backlog_bytes` the largest number of
+    bytes waiting to be read. Together they show whether the host keeps up.
+
+    Parameters:
+    csv_files (list): CSVs to replay, in order.
+    baudrate (int): Simulated baud rate, 9600 like the firmware.
+    speedup (float): Time compression factor. 1 is real time, 0 disables pacing.
+    timeout (float): Seconds `readline` waits for a line, like `serial.Serial(timeout=...)`.
+    autostart (bool): Whether to queue every CSV without waiting for "P" commands.
+    """
+
+    def __init__(self, csv_files, baudrate=9600, speedup=1.0, timeout=1, autostart=False):
+        self.csv_files = deque(csv_files)
+        self.baudrate = baudrate
+        self.speedup = speedup
+        self.timeout = timeout
+        self.is_open = True
+        self.latencies = []
+        self.max_backlog_bytes = 0
+        self.lines_sent = 0
+        self.bytes_sent = 0
+        self._pending = deque()  # (ready_time, encoded line)
+        self._device_time = time.perf_counter()
+        self._command_buffer = b''
+        self._delay = 16800
+        self._batch_samples = None
+        if autostart:
+            while self.csv_files:
+                self._start_delay_sequence()
+
+    def _scale(self, seconds):
+        return seconds / self.speedup if self.speedup else 0.0
+
+    def _emit(self, line, collection_time=0.0):
+        data = (line + '\r\n').encode('utf-8')
+        self._device_time = max(self._device_time, time.perf_counter())
+        self._device_time += self._scale(collection_time + len(data) * BITS_PER_BYTE / self.baudrate)
+        self._pending.append((self._device_time, data))
+
+    def _start_delay_sequence(self):
+        if not self.csv_files:
+            return
+        for collection_time, lines in read_delay_blocks(self.csv_files.popleft()):
+            self._emit(lines[0], collection_time)
+            for line in lines[1:]:
+                self._emit(line)
+
+    def load_next_file(self):
+        """Make the next CSV the source of "B<n>" batches."""
+        self._batch_samples = {delay: deque(samples) for delay, samples in read_delay_samples(self.csv_files.popleft()).items()}
+
+    def _send_batch(self, batch_size):
+        if self._batch_samples is None:
+            self.load_next_file()
+        available = self._batch_samples.get(self._delay, deque())
+        batch = [available.popleft() for _ in range(min(batch_size, len(available)))]
+        collection_time = sum(duration for duration, _ in batch) / 1e6
+        for i, (_, line) in enumerate(batch):
+            self._emit(line, collection_time if i == 0 else 0.0)
+        self._emit(COMPLETE_MARKER, 0.0 if batch else collection_time)
+
+    def _process_command(self, command):
+        if command == 'reset':
+            self._emit("Reset command received. Moving backward until button is pressed.")
+            self._emit("Reset complete, button pressed.")
+        elif command == 'run':
+            self._emit("Run motor sequence command received.")
+        elif command.startswith('M'):
+            self._emit("Delay set to milliseconds.")
+        elif command == 'P':
+            self._emit("Run Delay sequence command received.")
+            self._start_delay_sequence()
+        elif command.startswith('U'):
+            self._emit("Delay set to microseconds.")
+        elif command.startswith('D'):
+            self._delay = int(command[1:])
+            self._emit(f"Delay updated to: {command[1:]} us")
+        elif command.startswith('B'):
+            self._send_batch(int(command[1:]))
+
+    @property
+    def in_waiting(self):
+        now = time.perf_counter()
+        # Pending lines are ordered by ready time, so stop at the first one still in flight
+        return sum(len(data) for ready, data in itertools.takewhile(lambda item: item[0] <= now, self._pending))
+
+    def write(self, data):
+        self._command_buffer += data
+        *commands, self._command_buffer = self._command_buffer.split(b'\n')
+        for command in commands:
+            self._process_command(command.decode('utf-8').strip())
+        return len(data)
+
+    def readline(self):
+        deadline = time.perf_counter() + self.timeout
+        if not self._pending or self._pending[0][0] > deadline:
+            time.sleep(self.timeout)
+            return b''
+        ready, data = self._pending[0]
+        now = time.perf_counter()
+        if ready > now:
+            time.sleep(ready - now)
+            now = time.perf_counter()
+        backlog = self.in_waiting
+        self.max_backlog_bytes = max(self.max_backlog_bytes, backlog)
+        self._pending.popleft()
+        self.latencies.append(now - ready)
+        self.lines_sent += 1
+        self.bytes_sent += len(data)
+        return data
+
+    def readlines(self):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                return lines
+            lines.append(line)
+
+    def reset_input_buffer(self):
+        self._pending.clear()
+
+    def close(self):
+        self.is_open = False
+
+
+def serve_pty(csv_files, baudrate=9600, speedup=1.0):
+    """
+    Expose a `ReplaySerial` on a pseudo terminal until interrupted.
+
+    The slave device path is printed; pass it as the port of `US_datacollection_v4.1.py`.
+
+    Parameters:
+    csv_files (list): CSVs to replay, one per "P" command.
+    baudrate (int): Simulated baud rate.
+    speedup (float): Time compression factor. 1 is real time, 0 disables pacing.
+    """
+    import tty
+    import select
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    device = ReplaySerial(csv_files, baudrate=baudrate, speedup=speedup, timeout=0)
+    print(f"Replaying {len(csv_files)} files on {os.ttyname(slave)}")
+    try:
+        while True:
+            readable, _, _ = select.select([master], [], [], 0.001)
+            if readable:
+                device.write(os.read(master, 1024))
+            while device._pending and device._pending[0][0] <= time.perf_counter():
+                os.write(master, device.readline())
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def load_acquisition_module():
+    # The acquisition script name contains dots, so it is loaded from its path
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    spec = importlib.util.spec_from_file_location('US_datacollection', os.path.join(script_dir, 'US_datacollection_v4.1.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def benchmark_acquisition(csv_files, baudrate=9600, speedup=0, output_dir=None):
+    """
+    Run `record_data` against the replay device and measure acquisition throughput.
+
+    Parameters:
+    csv_files (list): CSVs to replay, one `record_data` call each.
+    baudrate (int): Simulated baud rate.
+    speedup (float): Time compression factor. 0 replays as fast as the host reads.
+    output_dir (str, optional): Where the recorded CSVs are written. Defaults to a temporary folder.
+
+    Returns:
+    dict: Lines, bytes, wall time, lines per second, latency percentiles and the largest backlog.
+    """
+    acquisition = load_acquisition_module()
+    output_dir = output_dir or tempfile.mkdtemp(prefix='serial_replay_')
+    device = ReplaySerial(csv_files, baudrate=baudrate, speedup=speedup, timeout=0.05)
+
+    start = time.perf_counter()
+    for i, csv_file in enumerate(csv_files):
+        device.write(b'P\n')
+        device.readline()  # "Run Delay sequence command received."
+        output_file = os.path.join(output_dir, f"replay_{i}_{os.path.basename(csv_file)}")
+        # The host waits for the next block after each marker; scale that wait like the device
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            acquisition.record_data({}, output_file, device=device, settle_time=device._scale(3))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(device.latencies) or [0.0]
+    return {
+        'files': len(csv_files),
+        'lines': device.lines_sent,
+        'bytes': device.bytes_sent,
+        'wall_s': wall,
+        'lines_per_s': device.lines_sent / wall if wall else None,
+        'latency_p50_ms': latencies[len(latencies) // 2] * 1000,
+        'latency_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        'max_backlog_bytes': device.max_backlog_bytes,
+        'output_dir': output_dir,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='CSV file or folder of CSVs to replay')
+    parser.add_argument('--baudrate', type=int, default=9600)
+    parser.add_argument('--speedup', type=float, default=1.0, help='1 is real time, 0 disables pacing')
+    parser.add_argument('--benchmark', action='store_true', help='Run record_data against the replay and report throughput')
+    parser.add_argument('--max-files', type=int, default=None)
+    args = parser.parse_args()
+
+    csv_files = find_csv_files(args.path)[:args.max_files]
+    if not csv_files:
+        sys.exit(f"No CSV files found in {args.path}")
+    if args.benchmark:
+        for key, value in benchmark_acquisition(csv_files, args.baudrate, args.speedup).items():
+            print(f"{key}: {value}")
+    else:
+        serve_pty(csv_files, args.baudrate, args.speedup)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,16 @@
 import os
+from functools import partial
+
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 
-from joblib import load
+from pipeline_profiler import span
+from feature_spec import ALL_BAND, CELL_KEY_FACTOR, compute_features, quartile_fences
+from model_bundle import BUNDLE_FILE, get_bundle
+from execution_backend import map_sensors, range_delay_cells
+from dataset_store import DatasetStore
+from feature_cache import features_from_files, features_from_store
+from row_dtypes import read_rows
 
 
 # Merge the data
@@ -11,11 +18,20 @@ from joblib import load
 # Define `file_path` as a global variable
 script_dir = os.path.dirname(os.path.abspath(__file__))  # Get the directory of the current script
 
+# Features of the pre-trained model, stored in its bundle
+FEATURE_SPEC = get_bundle(BUNDLE_FILE).spec
+FEATURE_COLUMNS = FEATURE_SPEC.columns
+
+# Sensors whose membership of their cluster is below this are flagged for a re-test
+MIN_CONFIDENCE = 0.6
+
 def get_all_files_in_directory(root_directory):
-    file_paths = []
-    for root, dirs, files in os.walk(root_directory):
-        for file in files:
-            file_paths.append(os.path.join(root, file))
+    with span('file_discovery') as s:
+        file_paths = []
+        for root, dirs, files in os.walk(root_directory):
+            for file in files:
+                file_paths.append(os.path.join(root, file))
+        s.rows = len(file_paths)
     return file_paths
 
 
@@ -29,13 +45,9 @@ def merge_csv_files(file_paths):
     Returns:
     DataFrame: Merged DataFrame containing data from all input CSV files.
     """
-    dataframes = []
-    for file in file_paths:
-        df = pd.read_csv(file)
-        dataframes.append(df)
-
-    # Concatenate all DataFrames
-    merged_df = pd.concat(dataframes, ignore_index=True)
+    with span('parse', files=len(file_paths)) as s:
+        merged_df = read_rows(file_paths)
+        s.rows = len(merged_df)
     
     return merged_df
 
@@ -51,161 +63,301 @@ def identify_and_remove_outliers(df, column):
     df_outliers_upper = df[(df[column] >= upper_bound)]
     return df_no_outliers,df_outliers_lower,df_outliers_upper
 
-def split_quartiles(df):
-    # Group the data by 'Sensor ID', 'Delay (us)', and 'Range (cm)'
-    df_copy = df.copy()
-    grouped = df_copy.groupby(['Sensor ID', 'Delay (us)', 'Range (cm)'])
-
-    # Identify and remove outliers for each group
-    middle_quartile = []
-    lower_quartile = []
-    upper_quartile = []
-
-    for name, group in grouped:
-        cleaned_group = group.copy()
-        for column in ['Ping Time (us)']:
-            middle_quartile_group,lower_quartile_group,upper_quartile_group = identify_and_remove_outliers(cleaned_group, column)
-        middle_quartile.append(middle_quartile_group)
-        lower_quartile.append(lower_quartile_group)
-        upper_quartile.append(upper_quartile_group)
-    # Combine the cleaned groups into a single DataFrame
-    df_middle_quartile= pd.concat(middle_quartile)
-    df_lower_quartile = pd.concat(lower_quartile)
-    df_upper_quartile = pd.concat(upper_quartile)
-    
-    return df_middle_quartile, df_lower_quartile, df_upper_quartile
-
-
-def create_range_delay_feature(df_quartile,bound):
-    # Step 1: Group and calculate mean
-    df_grouped = df_quartile.groupby(['Sensor ID', 'Range (cm)', 'Delay (us)'])['Ping Time (us)'].mean().reset_index()
-
-    # Step 2: Create `range_delay` column
-    df_grouped['range_delay'] = df_grouped['Range (cm)'].astype(str) + '_' + df_grouped['Delay (us)'].astype(str)+'_'+'mean'+'_'+bound
+def split_quartiles(df, backend=None):
+    """
+    Split the ping times of every sensor, delay and range into the middle quartiles and the
+    outliers below and above them.
 
-    # Step 3: Pivot the table
-    df_pivot = df_grouped.pivot(index='Sensor ID', columns='range_delay', values='Ping Time (us)').reset_index()
-    
-    return df_pivot
+    Parameters:
+    df (DataFrame, RowIndex or DatasetStore): Rows with 'Sensor ID', 'Range (cm)', 'Delay (us)' and 'Ping Time (us)'.
+    backend (str or backend, optional): Execution backend (see `execution_backend.py`) running the
+                                        split per partition of sensors. Required for a `DatasetStore`.
 
+    Returns:
+    DataFrame: Rows within the quartile bounds of their group.
+    DataFrame: Rows below the lower bound.
+    DataFrame: Rows above the upper bound.
+    """
+    if backend is not None or not isinstance(df, pd.DataFrame):
+        parts = map_sensors(split_quartiles, df, backend=backend)
+        return tuple(pd.concat([part[i] for part in parts]) for i in range(3))
+
+    # Group the data by 'Sensor ID', 'Delay (us)', and 'Range (cm)'; rows with a missing key belong to no group
+    grouped = df.groupby(['Sensor ID', 'Delay (us)', 'Range (cm)'])
+    group_codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    valid = group_codes >= 0
+    ping_times = df['Ping Time (us)'].to_numpy(dtype=np.float64)
+
+    # Quartile fences of every row's group, computed for all groups at once. Comparisons with
+    # NaN fences or ping times are False, so such rows fall in no band, as before.
+    lower_fence = np.full(len(df), np.nan)
+    upper_fence = np.full(len(df), np.nan)
+    lower_fence[valid], upper_fence[valid] = quartile_fences(ping_times[valid], group_codes[valid], grouped.ngroups)
+
+    # Rows ordered by group, keeping their order within a group: the order of the former
+    # per-group concatenation. Each band is then taken from `df` once, without copying the groups.
+    order = np.flatnonzero(valid)[np.argsort(group_codes[valid], kind='stable')]
+    ping_times, lower_fence, upper_fence = ping_times[order], lower_fence[order], upper_fence[order]
+    df_middle_quartile = df.take(order[(ping_times >= lower_fence) & (ping_times <= upper_fence)])
+    df_lower_quartile = df.take(order[ping_times <= lower_fence])
+    df_upper_quartile = df.take(order[ping_times >= upper_fence])
 
-def feature_engineering_quartile_means(df):
-    df=df[df["Range (cm)"].isin([13,18,23])] # this is necessary features.
-    values_to_keep = [16800,10000,8000,6000,3000]
-    df = df[df["Delay (us)"].isin(values_to_keep)]
+    return df_middle_quartile, df_lower_quartile, df_upper_quartile
 
-    df_middle_quartile, _, df_upper_quartile = split_quartiles(df)
-    df_range_delay_middle = create_range_delay_feature(df_middle_quartile,"middle")
-    #df_range_delay_upper = create_range_delay_feature(df_upper_quartile,"upper")
 
-    # List of DataFrames
-    df_pivots = [df_range_delay_middle]
+def create_range_delay_feature(df_quartile,bound,feature_columns=None,backend=None):
+    """
+    Mean ping time per sensor and (range, delay), one column per (range, delay).
 
-    # Initialize the merged DataFrame with the first DataFrame in the list
-    df_range_delay_all = df_pivots[0]
+    Rows are mapped to their column by an integer (range, delay) code and the means are
+    scattered into a preallocated sensors x columns matrix, instead of building a string key
+    per row and pivoting on it.
 
-    # Iteratively merge each DataFrame in the list
-    for df in df_pivots[1:]:
-        df_range_delay_all = df_range_delay_all.merge(df, on='Sensor ID')
-        
-    # Replace all NaN values with 0 in the merged DataFrame
-    df_range_delay_all.fillna(0, inplace=True)
+    Parameters:
+    df_quartile (DataFrame): Rows with 'Sensor ID', 'Range (cm)', 'Delay (us)' and 'Ping Time (us)'.
+    bound (str): Suffix of the column names, e.g. "middle".
+    feature_columns (list, optional): Columns to compute, named '<range>_<delay>_mean_<bound>', in
+                                      output order. Defaults to every (range, delay) in the data,
+                                      sorted by name as the former pivot did.
+    backend (str or backend, optional): Execution backend (see `execution_backend.py`) computing the
+                                        features per partition of sensors. `df_quartile` may then
+                                        also be a `RowIndex`, or a `DatasetStore` for the 'all' band
+                                        (a store holds unsplit rows).
 
-    # Define the column list
-    column_list = [
-        '23_6000_mean_middle', '23_16800_mean_middle', '18_3000_mean_middle',
-       '18_16800_mean_middle', '23_10000_mean_middle', '13_6000_mean_middle',
-       '18_6000_mean_middle', '13_3000_mean_middle', '18_8000_mean_middle',
-       '13_10000_mean_middle', 'Sensor ID'
-    ]
+    Returns:
+    DataFrame: 'Sensor ID' followed by the feature columns. Combinations without samples are NaN.
 
-    # Select columns that are only in the list
-    df_range_delay_all = df_range_delay_all[[col for col in df_range_delay_all.columns if col in column_list]]
+    Raises:
+    ValueError: If `df_quartile` is a `DatasetStore` and `bound` is not 'all'.
+    """
+    if isinstance(df_quartile, DatasetStore) and bound != ALL_BAND:
+        raise ValueError(f"A DatasetStore holds unsplit rows, so it only gives '{ALL_BAND}' features, not '{bound}'; "
+                         f"pass split_quartiles(store)[...] instead")
+    if backend is not None or not isinstance(df_quartile, pd.DataFrame):
+        if feature_columns is None:
+            feature_columns = sorted(f"{range_cm}_{delay}_mean_{bound}" for range_cm, delay in range_delay_cells(df_quartile))
+        parts = map_sensors(partial(create_range_delay_feature, bound=bound, feature_columns=feature_columns),
+                            df_quartile, backend=backend, columns=['Sensor ID', 'Range (cm)', 'Delay (us)', 'Ping Time (us)'])
+        return pd.concat(parts, ignore_index=True)
+
+    ranges = df_quartile['Range (cm)'].to_numpy(dtype=np.int64)
+    delays = df_quartile['Delay (us)'].to_numpy(dtype=np.int64)
+    ping_times = df_quartile['Ping Time (us)'].to_numpy(dtype=np.float64)
+    sensor_codes, sensor_ids = pd.factorize(df_quartile['Sensor ID'], sort=True)
+
+    cell_keys = ranges * CELL_KEY_FACTOR + delays
+    if feature_columns is None:
+        feature_columns = sorted(f"{key // CELL_KEY_FACTOR}_{key % CELL_KEY_FACTOR}_mean_{bound}" for key in np.unique(cell_keys))
+    column_keys = [int(range_cm) * CELL_KEY_FACTOR + int(delay)
+                   for range_cm, delay in (column.split('_')[:2] for column in feature_columns)]
+
+    # Column of every row, -1 for (range, delay) combinations that are not requested
+    column_codes = pd.Index(column_keys).get_indexer(cell_keys)
+    keep = (column_codes >= 0) & ~np.isnan(ping_times)
+    n_sensors, n_columns = len(sensor_ids), len(feature_columns)
+    flat_index = sensor_codes[keep] * n_columns + column_codes[keep]
+    sums = np.bincount(flat_index, weights=ping_times[keep], minlength=n_sensors * n_columns)
+    counts = np.bincount(flat_index, minlength=n_sensors * n_columns)
+    with np.errstate(invalid='ignore'):
+        means = (sums / counts).reshape(n_sensors, n_columns)
+
+    df_features = pd.DataFrame(means, columns=pd.Index(feature_columns, name='range_delay'))
+    df_features.insert(0, 'Sensor ID', sensor_ids)
+    return df_features
+
+
+def feature_engineering_quartile_means(df, spec=None):
+    """
+    Compute the model features of every sensor.
 
-    df = df_range_delay_all[column_list]
+    Parameters:
+    df (DataFrame): Recorded rows with 'Sensor ID', 'Range (cm)', 'Delay (us)' and 'Ping Time (us)'.
+    spec (FeatureSpec, optional): Features to compute. Defaults to the spec of the pre-trained model.
 
-    df = df.reindex(columns=column_list)
+    Returns:
+    DataFrame: The spec's feature columns followed by 'Sensor ID', one row per sensor.
+    """
+    spec = spec or FEATURE_SPEC
+    with span('features', rows=len(df), features=len(spec.features)):
+        df = compute_features(df, spec)
     return df
 
 
-def predict_KMeans(df):
+def feature_engineering_files(file_paths, spec=None):
+    """
+    Compute the model features of the sensors recorded in some files, reading only the files of
+    sensors that are not in the feature cache (see `feature_cache.py`).
 
-    # Standardize the features
-    df = df.copy()
-    sensor_ids = df.index if 'Sensor ID' not in df.columns else df['Sensor ID']
-    scaler = load(f"{script_dir}/Analysis/Delay_sequence_data/best_models/final/scaler_final_mi.joblib")
-    features_scaled = scaler.transform(df.drop(columns=['Sensor ID']))
+    Parameters:
+    file_paths (list of str): Paths of the delay sequence recordings.
+    spec (FeatureSpec, optional): Features to compute. Defaults to the spec of the pre-trained model.
 
-    kmeans = load(f"{script_dir}/Analysis/Delay_sequence_data/best_models/final/kmeans_model_final_df_mi.joblib")
-    print("Loaded pre-trained KMeans model.")
+    Returns:
+    DataFrame: The spec's feature columns followed by 'Sensor ID', one row per sensor.
+    """
+    spec = spec or FEATURE_SPEC
+    with span('features', files=len(file_paths), features=len(spec.features)) as s:
+        df = features_from_files(file_paths, spec)
+        s.rows = len(df)
+    return df
 
-    # Predict cluster labels
-    cluster_labels = kmeans.predict(features_scaled)
-    df['cluster'] = cluster_labels
 
-    # Define the column list
-    column_list = ['Sensor ID', 'cluster']
+def load_models(path=BUNDLE_FILE, mmap=False):
+    """
+    Load the pre-trained model bundle (scaler, KMeans centroids, feature spec and cluster
+    descriptions). The bundle is read once per process.
 
-    # Select columns that are only in the list
-    df = df[[col for col in df.columns if col in column_list]]
+    Parameters:
+    path (str): Path of the bundle file.
+    mmap (bool): Whether to memory-map the bundle's arrays.
 
-    return df
+    Returns:
+    ModelBundle: The bundle.
+    """
+    with span('load_model'):
+        return get_bundle(path, mmap=mmap)
 
 
+def predict_KMeans(df, models=None, soft=False, min_confidence=MIN_CONFIDENCE):
+    """
+    Predict the cluster of each sensor.
 
+    Parameters:
+    df (DataFrame): Output of `feature_engineering_quartile_means`.
+    models (ModelBundle, optional): Bundle from `load_models`. Defaults to the pre-trained model.
+    soft (bool): Whether to add the distances to every centroid, the soft membership and the confidence.
+    min_confidence (float): With `soft`, sensors whose confidence is below it are flagged for a re-test.
 
-def display_cluster_figures(cluster_num, refined_category, edge_case_sensitivity, description):
+    Returns:
+    DataFrame: 'Sensor ID' and 'cluster' columns. With `soft`, also 'second_cluster', 'margin'
+               (distance to the second minus to the closest centroid, in standardized units),
+               'confidence' (membership of the assigned cluster), 'retest', and 'distance_<k>' and
+               'membership_<k>' for every cluster k.
+    """
+    bundle = models or load_models()
+
+    # Standardize the features and assign each sensor to the closest centroid
+    with span('scale', rows=len(df)):
+        features_scaled = bundle.transform(df[bundle.spec.columns].to_numpy(dtype=np.float64))
+    with span('predict', rows=len(df)):
+        if not soft:
+            return pd.DataFrame({'Sensor ID': df['Sensor ID'].to_numpy(), 'cluster': bundle.assign(features_scaled)},
+                                index=df.index)
+        result = bundle.membership(features_scaled)
+
+    columns = {
+        'Sensor ID': df['Sensor ID'].to_numpy(),
+        'cluster': result['cluster'],
+        'second_cluster': result['second_cluster'],
+        'margin': result['margin'],
+        'confidence': result['confidence'],
+        'retest': result['confidence'] < min_confidence,
+    }
+    for k in range(bundle.n_clusters):
+        columns[f'distance_{k}'] = result['distances'][:, k]
+    for k in range(bundle.n_clusters):
+        columns[f'membership_{k}'] = result['membership'][:, k]
+    return pd.DataFrame(columns, index=df.index)
+
+
+def display_cluster_figures(cluster_num, refined_category, edge_case_sensitivity, description, show=True, output_path=None):
     """
     Display PNG figures from a folder where filenames are prefixed with a specific string,
     along with annotations for the refined category, edge case sensitivity, and description.
 
+    The figures are regenerated by `Analysis/Delay_sequence_data/figure_export_helper.py`.
+    With `show=False` nothing is displayed and no GUI backend is needed: the annotated figure is
+    written to `output_path` if given, otherwise the path of the cached cluster figure is returned.
+
     Parameters:
     cluster_num (int): Cluster number to display the corresponding figure.
     refined_category (str): Refined category of the cluster.
     edge_case_sensitivity (str): Edge case sensitivity of the cluster.
     description (str): Description of the cluster.
+    show (bool): Whether to display the figure in a window.
+    output_path (str, optional): Path to save the annotated figure to.
+
+    Returns:
+    str: Path of the annotated figure if saved, otherwise of the cluster figure. None if the figure is missing.
     """
     cluster_file = f"{script_dir}/Analysis/Delay_sequence_data/characteristic_figure/cluster_{cluster_num}.png"
 
-    try:
-        # Load and display the image
-        img = mpimg.imread(cluster_file)
-        fig, ax = plt.subplots(figsize=(8, 8))
-        ax.imshow(img)
-        ax.axis('off')  # Turn off axis
-        
-        # Add annotations below the figure
-        text = (
-            f"Refined Category: {refined_category}\n"
-            f"Edge Case Sensitivity: {edge_case_sensitivity}\n"
-            f"Description: {description}"
-        )
-        plt.figtext(0.5, 0.01, text, wrap=True, horizontalalignment='center', fontsize=10)
-        plt.show()
-    except FileNotFoundError:
+    if not os.path.exists(cluster_file):
         print(f"No PNG file found for cluster {cluster_num}.")
+        return None
+    if not show and output_path is None:
+        return cluster_file
+
+    # Imported here so that predicting does not pay for loading matplotlib
+    import matplotlib.image as mpimg
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    # Load and display the image
+    img = mpimg.imread(cluster_file)
+    # Without a window, draw on a bare Agg canvas so no GUI backend is touched
+    if show:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(8, 8))
+    else:
+        fig = Figure(figsize=(8, 8))
+        FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.imshow(img)
+    ax.axis('off')  # Turn off axis
+
+    # Add annotations below the figure
+    text = (
+        f"Refined Category: {refined_category}\n"
+        f"Edge Case Sensitivity: {edge_case_sensitivity}\n"
+        f"Description: {description}"
+    )
+    fig.text(0.5, 0.01, text, wrap=True, horizontalalignment='center', fontsize=10)
+
+    if output_path is not None:
+        fig.savefig(output_path)
+    if show:
+        plt.show()
+    return output_path or cluster_file
+
+
 
+def describe_clusters(predicted_cluster, df_characterization=None):
+    """
+    Join the predicted clusters with their refined category, edge case sensitivity and description.
+
+    Parameters:
+    predicted_cluster (DataFrame): Output of `predict_KMeans` with 'Sensor ID' and 'cluster' columns.
+    df_characterization (DataFrame, optional): Cluster descriptions. Defaults to those of the model bundle.
+
+    Returns:
+    DataFrame: One row per sensor with its cluster and the cluster's description columns.
+    """
+    if df_characterization is None:
+        df_characterization = load_models().descriptions
+    with span('description_join', rows=len(predicted_cluster)):
+        return predicted_cluster.merge(df_characterization, on='cluster', how='left')
 
 
 if __name__ == '__main__':
-    file_path = f"{script_dir}/Analysis/processed_data/all_data_v4-1-1_cleaned_sensor211.csv"
-    print(file_path)
-    df_data_v4_1_1 = pd.read_csv(file_path)
-    df_range_delay_all = feature_engineering_quartile_means(df_data_v4_1_1)
+    # Features of the processed data_v4.1.1 sensors (built first if needed), from the feature cache
+    with span('features', features=len(FEATURE_SPEC.features)) as s:
+        df_range_delay_all = features_from_store(DatasetStore(['data_v4.1.1'], ingest=True), FEATURE_SPEC)
+        s.rows = len(df_range_delay_all)
     df_range_delay_all = df_range_delay_all.sample(n=3)
     predicted_cluster = predict_KMeans(df_range_delay_all)
 
-    df_characterization = pd.read_csv(f"{script_dir}/Analysis/Delay_sequence_data/characteristic_figure/cluster_desc.csv") 
+    df_described = describe_clusters(predicted_cluster)
     
     with pd.option_context('display.max_colwidth', None):
-        for _, row in predicted_cluster.iterrows():
+        for _, row in df_described.iterrows():
             print("\n====================")
             print(f"Sensor ID: {row['Sensor ID']}, Cluster: {row['cluster']}")
             
             # Extract relevant details
-            refined_category = df_characterization[df_characterization["cluster"] == row["cluster"]]["Refined Category"].values[0]
-            edge_case_sensitivity = df_characterization[df_characterization["cluster"] == row["cluster"]]["Edge Case Sensitivity"].values[0]
-            description = df_characterization[df_characterization["cluster"] == row["cluster"]]["Description"].values[0]
+            refined_category = row["Refined Category"]
+            edge_case_sensitivity = row["Edge Case Sensitivity"]
+            description = row["Description"]
             
             # Print details
             print(f"Refined Cluster: {refined_category}")
@@ -216,4 +368,4 @@ if __name__ == '__main__':
             print("\nDisplaying figure for the cluster...")
             display_cluster_figures(row["cluster"], refined_category, edge_case_sensitivity, description)
             
-            print("====================\n")
+            print("====================\n")
\ No newline at end of file